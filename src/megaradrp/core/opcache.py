@@ -0,0 +1,114 @@
+#
+# Copyright 2025 Universidad Complutense de Madrid
+#
+# This file is part of Megara DRP
+#
+# SPDX-License-Identifier: GPL-3.0-or-later
+# License-Filename: LICENSE.txt
+#
+
+"""On-disk cache of precomputed arrays.
+
+Each entry is a directory with one .npy file per array, so that
+the arrays can be loaded as read-only memory maps. The cache is
+enabled by setting the environment variable MEGARADRP_CACHE_DIR
+to the directory of the cache.
+"""
+
+import hashlib
+import json
+import logging
+import os
+import pathlib
+import shutil
+import tempfile
+
+import numpy
+
+CACHE_VERSION = 1
+CACHE_ENV = 'MEGARADRP_CACHE_DIR'
+
+_logger = logging.getLogger(__name__)
+
+
+def _key_default(obj):
+    if isinstance(obj, numpy.ndarray):
+        return obj.tolist()
+    if isinstance(obj, numpy.generic):
+        return obj.item()
+    raise TypeError(f'object of type {type(obj)} cannot be used in a key')
+
+
+def cache_key(*parts):
+    """Hash of the parts that define a cache entry"""
+    token = json.dumps([CACHE_VERSION, *parts], default=_key_default)
+    return hashlib.sha256(token.encode('utf-8')).hexdigest()
+
+
+class ArrayCache:
+    """Arrays stored on disk, grouped by kind and key"""
+
+    def __init__(self, path):
+        self.path = pathlib.Path(path)
+
+    @classmethod
+    def from_environ(cls):
+        """Create the cache from MEGARADRP_CACHE_DIR, None if not set"""
+        path = os.environ.get(CACHE_ENV)
+        if not path:
+            return None
+        return cls(path)
+
+    def entry_path(self, kind, key):
+        return self.path / kind / key
+
+    def load(self, kind, key):
+        """Load the arrays of an entry as memory maps.
+
+        Returns
+        -------
+        dict or None
+            Arrays of the entry, None if the entry does not exist
+        """
+        entry = self.entry_path(kind, key)
+        meta_file = entry / 'meta.json'
+        if not meta_file.is_file():
+            return None
+        try:
+            with open(meta_file) as fd:
+                meta = json.load(fd)
+            if meta['version'] != CACHE_VERSION:
+                return None
+            result = {}
+            for name in meta['arrays']:
+                result[name] = numpy.load(entry / f'{name}.npy', mmap_mode='r')
+        except (OSError, ValueError, KeyError) as error:
+            _logger.warning('unable to load cache entry %s: %s', entry, error)
+            return None
+        _logger.debug('loaded cache entry %s', entry)
+        return result
+
+    def save(self, kind, key, arrays):
+        """Store the arrays of an entry.
+
+        The entry is written in a temporary directory and
+        renamed, so that readers never see partial entries.
+        """
+        entry = self.entry_path(kind, key)
+        entry.parent.mkdir(parents=True, exist_ok=True)
+        tmpdir = pathlib.Path(tempfile.mkdtemp(dir=entry.parent, prefix='.tmp'))
+        try:
+            for name, arr in arrays.items():
+                numpy.save(tmpdir / f'{name}.npy', numpy.asarray(arr))
+            meta = {'version': CACHE_VERSION, 'arrays': list(arrays)}
+            # meta.json is written last, it marks a complete entry
+            with open(tmpdir / 'meta.json', 'w') as fd:
+                json.dump(meta, fd)
+            os.replace(tmpdir, entry)
+        except OSError as error:
+            # another process may have written the entry first
+            _logger.debug('unable to store cache entry %s: %s', entry, error)
+            shutil.rmtree(tmpdir, ignore_errors=True)
+        else:
+            _logger.debug('stored cache entry %s', entry)
+        return entry
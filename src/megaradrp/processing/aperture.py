@@ -1,5 +1,5 @@
 #
-# Copyright 2011-2023 Universidad Complutense de Madrid
+# Copyright 2011-2025 Universidad Complutense de Madrid
 #
 # This file is part of Megara DRP
 #
@@ -17,6 +17,8 @@ if sys.version_info[:2] <= (3, 10):
 import numpy
 import numpy.polynomial.polynomial as nppol
 import astropy.io.fits as fits
+from scipy.ndimage import gaussian_filter1d, map_coordinates, spline_filter1d
+from scipy.sparse import csr_matrix
 import numina.array.trace.extract as extract
 import numina.processing
 
@@ -36,7 +38,7 @@ def apextract(data, trace):
     return rss
 
 
-def apextract_tracemap(data, tracemap):
+def apextract_tracemap(data, tracemap, pixels=None):
     """Extract apertures using a tracemap.
 
     Consider that the nearest fiber could be far away if there
@@ -46,77 +48,210 @@ def apextract_tracemap(data, tracemap):
     ----------
 
     data: ndarray
+        2D image, or 3D stack of images of shape (nframes, nrow, ncol)
     tracemap: TraceMap
+    pixels: tuple, optional
+        Pixels covered by the apertures, computed if not given,
+        see calc_extraction_pixels
 
     """
-
-    existing = [None]
-    for t in tracemap.contents:
-        if t.valid:
-            existing.append(t)
-
-    existing.append(None)
-    # Compute borders
-    borders = []
-    far_dist = 100
-
-    # Handle the first and last using centinels
-    for t1, t2, t3 in zip(existing, existing[1:], existing[2:]):
-        # Distance to contfibers # in box
-        if t1 is None:
-            d21 = far_dist
-        else:
-            d21 = (t2.fibid - t1.fibid) + (t2.boxid - t1.boxid)
-        if t3 is None:
-            d32 = far_dist
-        else:
-            d32 = (t3.fibid - t2.fibid) + (t3.boxid - t2.boxid)
-
-        y2_off = t2.polynomial(tracemap.ref_column)
-        t2_off = tracemap.global_offset(y2_off)
-        t2_pol_off = t2.polynomial + t2_off
-
-        # Right border
-        pix_32 = None
-        if d32 <= 2:
-            y3_off = t3.polynomial(tracemap.ref_column)
-            t3_off = tracemap.global_offset(y3_off)
-            pix_32 = 0.5 * (t2_pol_off + t3.polynomial + t3_off)
-            if d32 == 2:
-                pix_32 = 0.5 * (pix_32 + t2_pol_off)
-        elif d32 > 2:
-            pix_32 = None
-
-        pix_21 = None
-        if d21 <= 2:
-            y1_off = t1.polynomial(tracemap.ref_column)
-            t1_off = tracemap.global_offset(y1_off)
-            pix_21 = 0.5 * (t2_pol_off + t1.polynomial + t1_off)
-            if d21 == 2:
-                pix_21 = 0.5 * (pix_21 + t2_pol_off)
-        elif d21 > 2:
-            pix_21 = None
-
-        if pix_32 is None and pix_21 is None:
-            continue
-
-        if pix_32 is None:
-            # Recompute pix32 using pix_21
-            pix_32 = t2_pol_off + (t2_pol_off - pix_21)
-
-        if pix_21 is None:
-            # Recompute pix21 using pix_32
-            pix_21 = t2_pol_off - (pix_32 - t2_pol_off)
-
-        borders.append((t2.fibid, pix_21, pix_32))
+    if pixels is None:
+        borders = calc_borders(tracemap, numpy.arange(data.shape[1]))
+        pixels = calc_extraction_pixels(*borders, data.shape[-2])
 
     nfibers = tracemap.total_fibers
-    out = numpy.zeros((nfibers, data.shape[1]), dtype='float')
-    rss = extract_simple_rss2(data, borders, out=out)
+    out = numpy.zeros(data.shape[:-2] + (nfibers, data.shape[-1]), dtype='float')
+    rss = extract_pixels(data, pixels, out=out)
 
     return rss
 
 
+def calc_borders(tracemap, xx):
+    """Compute the borders of the apertures of a tracemap.
+
+    The borders are placed halfway to the neighbouring fibers, or
+    at a quarter of the distance if one fiber is missing in between.
+    If both neighbours are farther, the border is the reflection of
+    the other border. Fibers without neighbours are not extracted.
+
+    All the fibers are evaluated at once, with the global
+    offset of the tracemap applied. See TraceMap.borders.
+
+    Parameters
+    ----------
+    tracemap: TraceMap
+    xx: ndarray
+        Columns where the borders are computed
+
+    Returns
+    -------
+    tuple
+        Fiber ids (nfib,), lower and upper borders (nfib, len(xx))
+    """
+    return tracemap.borders(xx)
+
+
+def calc_extraction_pixels(fibids, bb1, bb2, nrow):
+    """Pixels and fractions of pixel covered by the apertures.
+
+    Parameters
+    ----------
+    fibids: ndarray
+        Fiber ids
+    bb1, bb2: ndarray
+        Lower and upper borders of each fiber in each column
+    nrow: int
+        Number of rows of the image
+
+    Returns
+    -------
+    tuple
+        Fiber ids, the first and last pixels and the fractions
+        of the first and last pixels, used by extract_pixels
+    """
+    bb1 = numpy.maximum(bb1, -0.5)
+    bb2 = numpy.minimum(bb2, nrow - 0.5)
+    pa = numpy.clip(numpy.floor(bb1 + 0.5).astype('int'), 0, nrow)
+    pb = numpy.clip(numpy.floor(bb2 + 0.5).astype('int'), 0, nrow)
+    # Borders in the last half pixel have pa or pb == nrow
+    wa = numpy.where(pa < nrow, pa + 0.5 - bb1, 0.0)
+    wb = numpy.where(pb < nrow, bb2 - pb + 0.5, 0.0)
+    # Empty apertures
+    empty = pb < pa
+    pb[empty] = pa[empty] + 1
+    wa[empty] = 0.0
+    wb[empty] = 0.0
+    return fibids, pa, pb, wa, wb
+
+
+def extract_pixels(arr, pixels, out=None):
+    """Sum the flux inside the apertures, with fractional pixels.
+
+    Equivalent to numina's extract_simple_intl, for all
+    fibers at once, using the cumulative sum of each column.
+
+    Parameters
+    ----------
+    arr: ndarray
+        2D image, or 3D stack of images of shape (nframes, nrow, ncol)
+    pixels: tuple
+        Pixels covered by the apertures, see calc_extraction_pixels
+    out: ndarray, optional
+        Output RSS, the row of fiber fibid is fibid - 1
+
+    Returns
+    -------
+    ndarray
+    """
+    fibids, pa, pb, wa, wb = pixels
+    nrow, ncol = arr.shape[-2:]
+    if out is None:
+        out = numpy.zeros(arr.shape[:-2] + (max(fibids, default=0), ncol), dtype='float')
+
+    if len(fibids) == 0:
+        return out
+
+    if arr.ndim == 3:
+        # the pixels are shared by all the images
+        for frame, frame_out in zip(arr, out):
+            extract_pixels(frame, pixels, out=frame_out)
+        return out
+
+    # Cumulative sum along the rows, row by row is
+    # faster than numpy.cumsum along axis 0
+    cum = numpy.empty((nrow + 2, ncol))
+    cum[0] = 0.0
+    for row in range(nrow):
+        numpy.add(cum[row], arr[row], out=cum[row + 1])
+    cum[nrow + 1] = cum[nrow]
+
+    # Full pixels between pa and pb, and fractions of pa and pb
+    acc = numpy.take_along_axis(cum, pb, axis=0)
+    acc -= numpy.take_along_axis(cum, pa + 1, axis=0)
+    val = numpy.take_along_axis(arr, numpy.minimum(pa, nrow - 1), axis=0)
+    acc += val * wa
+    val = numpy.take_along_axis(arr, numpy.minimum(pb, nrow - 1), axis=0)
+    acc += val * wb
+    out[fibids - 1] = acc
+    return out
+
+
+def calc_extraction_operator(pixels, shape, nfibers, block=64):
+    """Sparse operator of the extraction of the apertures.
+
+    The operator is equivalent to extract_pixels, applied to
+    the flattened image.
+
+    Parameters
+    ----------
+    pixels: tuple
+        Pixels covered by the apertures, see calc_extraction_pixels
+    shape: tuple
+        Shape (nrow, ncol) of the image
+    nfibers: int
+        Number of rows of the RSS
+    block: int
+        Number of fibers processed together
+
+    Returns
+    -------
+    scipy.sparse.csr_matrix
+        Matrix of shape (nfibers * ncol, nrow * ncol)
+    """
+    fibids, pa, pb, wa, wb = pixels
+    nrow, ncol = shape
+    cols = numpy.arange(ncol)
+    all_rows, all_cols, all_weights = [], [], []
+    for start in range(0, len(fibids), block):
+        sl = slice(start, start + block)
+        fa = pa[sl, :, numpy.newaxis]
+        fb = pb[sl, :, numpy.newaxis]
+        npixels = int((pb[sl] - pa[sl]).max()) + 1
+        rows = fa + numpy.arange(npixels)
+        # full pixels between pa and pb, and fractions of pa and pb
+        weights = numpy.where(rows < fb, 1.0, 0.0)
+        weights = numpy.where(rows == fa, wa[sl, :, numpy.newaxis], weights)
+        weights = numpy.where(rows == fb, wb[sl, :, numpy.newaxis], weights)
+        # the aperture is inside one pixel
+        weights = numpy.where((rows == fa) & (fa == fb),
+                              wa[sl, :, numpy.newaxis] + wb[sl, :, numpy.newaxis] - 1, weights)
+        valid = (rows <= fb) & (rows < nrow) & (weights != 0)
+        rss_rows = (fibids[sl, numpy.newaxis, numpy.newaxis] - 1) * ncol + cols[:, numpy.newaxis]
+        all_rows.append(numpy.broadcast_to(rss_rows, rows.shape)[valid])
+        all_cols.append((rows * ncol + cols[:, numpy.newaxis])[valid])
+        all_weights.append(weights[valid])
+
+    if not all_rows:
+        return csr_matrix((nfibers * ncol, nrow * ncol))
+
+    return csr_matrix(
+        (numpy.concatenate(all_weights), (numpy.concatenate(all_rows), numpy.concatenate(all_cols))),
+        shape=(nfibers * ncol, nrow * ncol)
+    )
+
+
+def extract_borders(arr, fibids, bb1, bb2, out=None):
+    """Sum the flux between borders, with fractional pixels.
+
+    Parameters
+    ----------
+    arr: ndarray
+        2D image
+    fibids: ndarray
+        Fiber ids, the row of fiber fibid in out is fibid - 1
+    bb1, bb2: ndarray
+        Lower and upper borders of each fiber in each column
+    out: ndarray, optional
+        Output RSS
+
+    Returns
+    -------
+    ndarray
+    """
+    pixels = calc_extraction_pixels(fibids, bb1, bb2, arr.shape[0])
+    return extract_pixels(arr, pixels, out=out)
+
+
 def extract_simple_rss(arr, borders2, axis=0, out=None):
 
     # FIXME, this should be changed in numina
@@ -148,15 +283,146 @@ def extract_simple_rss(arr, borders2, axis=0, out=None):
     return out
 
 
+def calc_profile_shift(profile, centers, nsearch=10, sigma=1.5):
+    """Shift of a cross-dispersion profile, by cross-correlation.
+
+    The profile is correlated with a comb of gaussians, placed
+    at the predicted centers of the fibers. The correlation is
+    computed in steps of 1 pixel, refined around the maximum
+    in steps of 0.05 pixels and interpolated with a parabola.
+
+    The correlation with the comb is the sum of the profile,
+    smoothed with the gaussian, at the centers of the fibers.
+    The smoothed profile is interpolated with a cubic spline.
+
+    Parameters
+    ----------
+    profile : numpy.ndarray
+        Cross-dispersion profile of the image
+    centers : numpy.ndarray
+        Predicted centers of the fibers
+    nsearch : int
+        Maximum shift, in pixels
+    sigma : float
+        Width of the gaussians
+
+    Returns
+    -------
+    float or None
+        Shift of the profile with respect to the prediction,
+        None if the maximum is at the border of the search range
+    """
+    smoothed = gaussian_filter1d(numpy.asarray(profile, dtype='float'), sigma)
+    coeffs = spline_filter1d(smoothed, order=3)
+    centers = numpy.asarray(centers, dtype='float')
+
+    def correlation(shifts):
+        pos = centers + shifts[:, numpy.newaxis]
+        values = map_coordinates(coeffs, pos.reshape(1, -1), order=3,
+                                 prefilter=False, mode='constant')
+        return values.reshape(pos.shape).sum(axis=1)
+
+    coarse = numpy.arange(-nsearch, nsearch + 1, dtype='float')
+    imax = numpy.argmax(correlation(coarse))
+    if imax == 0 or imax == len(coarse) - 1:
+        return None
+    step = 0.05
+    fine = coarse[imax] + numpy.arange(-20, 21) * step
+    corr = correlation(fine)
+    imax = numpy.argmax(corr)
+    shift = fine[imax]
+    if 0 < imax < len(fine) - 1:
+        c0, c1, c2 = corr[imax - 1:imax + 2]
+        den = c0 - 2 * c1 + c2
+        if den < 0:
+            shift += 0.5 * step * (c0 - c2) / den
+    return shift
+
+
+def aperture_centers(trace_repr, columns):
+    """Centers of the valid apertures, with the global offset applied.
+
+    Parameters
+    ----------
+    trace_repr : TraceMap or ModelMap
+    columns : numpy.ndarray
+
+    Returns
+    -------
+    numpy.ndarray
+        Array (nvalid, len(columns))
+    """
+    if hasattr(trace_repr, 'centers'):
+        centers = trace_repr.centers(columns)
+        return centers[~numpy.isnan(centers[:, 0])]
+    valid = [aper.aper_center() for aper in trace_repr.contents if aper.valid]
+    if not valid:
+        return numpy.empty((0, len(columns)))
+    centers = numpy.array([center(columns) for center in valid])
+    y_ref = numpy.array([center(trace_repr.ref_column) for center in valid])
+    return centers + trace_repr.global_offset(y_ref)[:, numpy.newaxis]
+
+
+def estimate_extraction_offset(data, trace_repr, ncolumns=5, hw=10, nsearch=10, sigma=1.5):
+    """Offset between the apertures and an image.
+
+    The image is collapsed in `ncolumns` windows of 2 * hw + 1 columns.
+    The profile of each window is cross-correlated with the profile
+    predicted by the apertures, see calc_profile_shift. The offset is
+    the median of the shifts of the windows.
+
+    Parameters
+    ----------
+    data : numpy.ndarray
+        Image
+    trace_repr : TraceMap or ModelMap
+    ncolumns : int
+        Number of windows
+    hw : int
+        Half width of the windows
+    nsearch : int
+        Maximum offset, in pixels
+    sigma : float
+        Width of the profile of the fibers
+
+    Returns
+    -------
+    float or None
+        The offset, to be added to the global offset of the
+        apertures. None if it cannot be measured
+    """
+    ncol = data.shape[1]
+    margin = ncol // 10
+    columns = numpy.linspace(margin + hw, ncol - margin - hw - 1, ncolumns).astype('int')
+    centers = aperture_centers(trace_repr, columns)
+    if len(centers) == 0:
+        return None
+    shifts = []
+    for idx, col in enumerate(columns):
+        profile = numpy.nan_to_num(data[:, col - hw:col + hw + 1].mean(axis=1))
+        shift = calc_profile_shift(profile, centers[:, idx], nsearch=nsearch, sigma=sigma)
+        if shift is not None:
+            shifts.append(shift)
+    _logger.debug('shifts in columns %s are %s', columns.tolist(), shifts)
+    if not shifts:
+        return None
+    return float(numpy.median(shifts))
+
+
 apextract_tracemap_2 = apextract_tracemap
 extract_simple_rss2 = extract_simple_rss
 
 
 class ApertureExtractor(numina.processing.Corrector):
-    """A Node that extracts apertures."""
+    """A Node that extracts apertures.
+
+    With auto_offset, the offset between the apertures and each
+    image is measured with estimate_extraction_offset, and added
+    to the global offset of the apertures before the extraction.
+    """
 
     def __init__(self, trace_repr, datamodel=None, dtype='float32',
-                 processes=0, offset=None):
+                 processes=0, offset=None, auto_offset=False):
 
         if offset:
             trace_repr.global_offset = trace_repr.global_offset + \
@@ -164,23 +430,89 @@ class ApertureExtractor(numina.processing.Corrector):
 
         self.trace_repr = trace_repr
         self.processes = processes
+        # If True, the offset is measured in each image
+        self.auto_offset = auto_offset
+        self.base_offset = trace_repr.global_offset
+        self.measured_offset = None
+        self._pixels = None
+        self._pixels_key = None
         super(ApertureExtractor, self).__init__(
             datamodel=datamodel,
             calibid=trace_repr.uuid,
             dtype=dtype
         )
 
+    def calc_pixels(self, shape):
+        """Pixels covered by the apertures, for images of this shape.
+
+        The pixels are computed once and reused while
+        the shape and the global offset do not change.
+        """
+        key = (tuple(shape), tuple(self.trace_repr.global_offset.coef))
+        if self._pixels is None or self._pixels_key != key:
+            borders = calc_borders(self.trace_repr, numpy.arange(shape[1]))
+            self._pixels = calc_extraction_pixels(*borders, shape[0])
+            self._pixels_key = key
+        return self._pixels
+
+    def extraction_operator(self, shape):
+        """Sparse operator of the extraction, for images of this shape.
+
+        Only the simple extraction is linear with
+        a sparse operator, see calc_extraction_operator.
+        """
+        if self.method_name != 'simple':
+            raise ValueError('extraction operator requires a trace map')
+        pixels = self.calc_pixels(shape)
+        return calc_extraction_operator(pixels, shape, self.trace_repr.total_fibers)
+
+    @property
+    def method_name(self):
+        if hasattr(self.trace_repr, 'aper_extract'):
+            return 'advanced'
+        else:
+            return 'simple'
+
+    def extract_data(self, data):
+        """Extract the apertures of an image, or of a stack of images.
+
+        Parameters
+        ----------
+        data : numpy.ndarray
+            2D image, or 3D stack of images of shape (nframes, nrow, ncol)
+
+        Returns
+        -------
+        numpy.ndarray
+            RSS, or 3D stack of RSS of shape (nframes, nfibers, ncol)
+        """
+        _logger.debug('offsets are %s', self.trace_repr.global_offset.coef)
+        if self.method_name == 'simple':
+            pixels = self.calc_pixels(data.shape[-2:])
+            return apextract_tracemap(data, self.trace_repr, pixels=pixels)
+        else:
+            return self.trace_repr.aper_extract(data, processes=self.processes)
+
+    def update_offset(self, data):
+        """Measure the offset in an image and update the global offset"""
+        if not self.auto_offset:
+            return
+        # the offset is measured with respect to the base offset
+        self.trace_repr.global_offset = self.base_offset
+        offset = estimate_extraction_offset(data, self.trace_repr)
+        if offset is None:
+            _logger.warning('unable to measure the extraction offset, using 0')
+            offset = 0.0
+        _logger.info('measured extraction offset is %f', offset)
+        self.measured_offset = offset
+        self.trace_repr.global_offset = self.base_offset + nppol.Polynomial([offset])
+
     def run(self, img):
         # workaround
         imgid = self.get_imgid(img)
+        self.update_offset(img[0].data)
 
-        method_name = 'simple'
-        simple = True
-        if hasattr(self.trace_repr, 'aper_extract'):
-            simple = False
-            method_name = 'advanced'
-
-        if simple:
+        if self.method_name == 'simple':
             _logger.debug('simple aperture extraction')
             _logger.debug('extracting (apextract_tracemap) in image %s', imgid)
             _logger.debug('with trace map %s', self.calibid)
@@ -189,36 +521,83 @@ class ApertureExtractor(numina.processing.Corrector):
             _logger.debug('extracting (apextract_model) in image %s', imgid)
             _logger.debug('with model map %s', self.calibid)
 
-        _logger.debug('offsets are %s', self.trace_repr.global_offset.coef)
-        if simple:
-            rssdata = apextract_tracemap(img[0].data, self.trace_repr)
-        else:
-            rssdata = self.trace_repr.aper_extract(
-                img[0].data, processes=self.processes)
+        rssdata = self.extract_data(img[0].data)
+        return self.update_img(img, rssdata)
+
+    def run_stack(self, imgs):
+        """Extract the apertures of several images at once.
+
+        The geometry of the apertures is computed once, and
+        the images are extracted together.
+
+        Parameters
+        ----------
+        imgs : list of HDUList or numpy.ndarray
+            Images, or 3D stack of images of shape (nframes, nrow, ncol)
+
+        Returns
+        -------
+        list of HDUList or numpy.ndarray
+            Extracted images, or 3D stack of RSS
+        """
+        if self.auto_offset:
+            # the offset is different in each image
+            if isinstance(imgs, numpy.ndarray):
+                result = []
+                for data in imgs:
+                    self.update_offset(data)
+                    result.append(self.extract_data(data))
+                return numpy.stack(result)
+            return [self.run(img) for img in imgs]
+        if isinstance(imgs, numpy.ndarray):
+            return self.extract_data(imgs)
+        if not imgs:
+            return []
+
+        for img in imgs:
+            _logger.debug('extracting image %s', self.get_imgid(img))
+        _logger.debug('%s aperture extraction of %d images with %s',
+                      self.method_name, len(imgs), self.calibid)
+        stack = numpy.stack([img[0].data for img in imgs])
+        rssdata = self.extract_data(stack)
+        return [self.update_img(img, rss) for img, rss in zip(imgs, rssdata)]
+
+    def update_img(self, img, rssdata):
+        """Replace the data of img with the RSS and update the headers"""
 
         img[0].data = rssdata
 
         hdr = img[0].header
 
         hdr['NUM-APE'] = self.calibid
-        hdr['history'] = f'Aperture extraction method {method_name}'
+        hdr['history'] = f'Aperture extraction method {self.method_name}'
         hdr['history'] = f'Aperture extraction with {self.calibid}'
         hdr['history'] = f'Aperture extraction offsets are {self.trace_repr.global_offset.coef.tolist()}'
+        if self.auto_offset and self.measured_offset is not None:
+            hdr['APE-OFF'] = (self.measured_offset, '[pix] Measured aperture extraction offset')
         tnow = datetime.datetime.now(datetime.UTC)
         hdr['history'] = f'Aperture extraction time {tnow.isoformat()}'
 
         # Update Fibers
         fibers_ext = img['FIBERS']
         fibers_ext_headers = fibers_ext.header
-        for aper in self.trace_repr.contents:
+        if hasattr(self.trace_repr, 'arrays'):
+            # do not build the traces of a loaded TraceMap
+            arrays = self.trace_repr.arrays
+            apertures = zip(arrays.fibid.tolist(), arrays.valid.tolist(),
+                            arrays.start.tolist(), arrays.stop.tolist())
+        else:
+            apertures = [(aper.fibid, aper.valid, aper.start, aper.stop)
+                         for aper in self.trace_repr.contents]
+        for fibid, valid, start, stop in apertures:
             # set the value only if invalid
-            if not aper.valid:
-                key = f"FIB{aper.fibid:03d}_V"
-                fibers_ext_headers[key] = (aper.valid, "Fiber is invalid")
-            key = f"FIB{aper.fibid:03d}S1"
-            fibers_ext_headers[key] = (aper.start, "[pix] Start of trace")
-            key = f"FIB{aper.fibid:03d}S2"
-            fibers_ext_headers[key] = (aper.stop, "[pix] End of trace")
+            if not valid:
+                key = f"FIB{fibid:03d}_V"
+                fibers_ext_headers[key] = (valid, "Fiber is invalid")
+            key = f"FIB{fibid:03d}S1"
+            fibers_ext_headers[key] = (start, "[pix] Start of trace")
+            key = f"FIB{fibid:03d}S2"
+            fibers_ext_headers[key] = (stop, "[pix] End of trace")
 
         newimg = fits.HDUList([img[0], fibers_ext])
         return newimg
@@ -15,8 +15,18 @@ van de Ville et al. IEEE Transactions on Image Processing 2004, 13, 6
 
 
 import argparse
+import collections
+import concurrent.futures
+import glob
+import logging
+import multiprocessing as mp
+import pathlib
+import sys
+import time
+
 import numpy as np
-from scipy import signal
+from scipy import ndimage
+import scipy.sparse as sparse
 from astropy.io import fits
 import astropy.units as u
 import astropy.wcs
@@ -35,6 +45,23 @@ GTC_PLATESCALE = u.plate_scale(cons.GTC_FC_A_PLATESCALE)
 # Size scale of the spaxel grid in arcseconds
 HEX_SCALE = cons.SPAXEL_SCALE.to(u.arcsec, GTC_PLATESCALE).value
 
+# Maximum number of interpolation operators kept in memory
+OPERATOR_CACHE_SIZE = 8
+_operator_cache = collections.OrderedDict()
+
+_logger = logging.getLogger(__name__)
+
+
+def _grid_unit(fpconf):
+    """Size of the hexagonal grid in the units of the positions of the fibers"""
+    if fpconf.funit == 'arcsec':
+        # arcsec
+        return HEX_SCALE
+    else:
+        # mm
+        # fpconf.funit == 'mm'
+        return cons.SPAXEL_SCALE.to(u.mm).value
+
 
 def calc_matrix_from_fiberconf(fpconf, refid=614):
     """
@@ -62,13 +89,7 @@ def calc_matrix_from_fiberconf(fpconf, refid=614):
     # FIBER in LOW LEFT corner is 614
     ref_fiber = fpconf.fibers[refid]
     minx, miny = ref_fiber.x, ref_fiber.y
-    if fpconf.funit == 'arcsec':
-        # arcsec
-        ascale = HEX_SCALE
-    else:
-        # mm
-        # fpconf.funit == 'mm'
-        ascale = cons.SPAXEL_SCALE.to(u.mm).value
+    ascale = _grid_unit(fpconf)
     ref = minx / ascale, miny / ascale
     rpos1_x = (spos1_x - minx) / ascale
     rpos1_y = (spos1_y - miny) / ascale
@@ -76,7 +97,186 @@ def calc_matrix_from_fiberconf(fpconf, refid=614):
     return r0l_1, ref
 
 
-def create_cube(r0l, zval, p=1, target_scale=1.0):
+def calc_cube_operator(r0l, p=1, target_scale=1.0, extremes=None):
+    """
+    Compute the sparse interpolation operator from fibers to spaxels
+
+    Each row of the operator contains the weights of the fibers
+    in one spaxel of the rectangular grid. Only the fibers inside
+    the support of the rescaling kernel contribute to a spaxel.
+
+    Parameters
+    ----------
+    r0l : np.ndarray
+        Positions of the fibers in the hexagonal grid, shape (2, nfibers)
+    p : {1, 2}
+    target_scale : float, optional
+    extremes : tuple, optional
+        Extremes of the grid, computed with hexgrid_extremes if None
+
+    Returns
+    -------
+    tuple
+        Operator as a scipy.sparse.csr_matrix of shape
+        (nrows * ncols, nfibers), and the shape (nrows, ncols)
+        of the spatial grid
+
+    """
+    if extremes is None:
+        extremes = hg.hexgrid_extremes(r0l, target_scale)
+    (i1min, i1max), (j1min, j1max) = extremes
+    crow = i1max - i1min + 1
+    ccol = j1max - j1min + 1
+    nfib = r0l.shape[1]
+
+    kernel = hspline.rescaling_kernel_table(p, scale=target_scale)
+    # the kernel is tabulated in a box, it is 0 outside
+    # the first coordinate of the kernel is y
+    (ylow, yhigh), (xlow, xhigh) = kernel.bbox
+
+    # range of rows and columns of the spaxels around each fiber
+    x0, y0 = r0l
+    jlow = np.maximum(np.ceil((x0 + xlow) / target_scale), j1min).astype('int')
+    jhigh = np.minimum(np.floor((x0 + xhigh) / target_scale), j1max).astype('int')
+    ilow = np.maximum(np.ceil((y0 + ylow) / target_scale), i1min).astype('int')
+    ihigh = np.minimum(np.floor((y0 + yhigh) / target_scale), i1max).astype('int')
+
+    nj = int(max((jhigh - jlow).max() + 1, 0))
+    ni = int(max((ihigh - ilow).max() + 1, 0))
+    # candidate spaxels of each fiber, shape (nfibers, ni, nj)
+    jj = jlow[:, None, None] + np.arange(nj)[None, None, :]
+    ii = ilow[:, None, None] + np.arange(ni)[None, :, None]
+    jj, ii = np.broadcast_arrays(jj, ii)
+    fibers = np.broadcast_to(np.arange(nfib)[:, None, None], jj.shape)
+    inside = (jj <= jhigh[:, None, None]) & (ii <= ihigh[:, None, None])
+
+    jj = jj[inside]
+    ii = ii[inside]
+    fibers = fibers[inside]
+    dx = target_scale * jj - x0[fibers]
+    dy = target_scale * ii - y0[fibers]
+    weights = kernel(dy, dx)
+
+    spaxels = (ii - i1min) * ccol + (jj - j1min)
+    operator = sparse.csr_matrix((weights, (spaxels, fibers)), shape=(crow * ccol, nfib))
+    operator.eliminate_zeros()
+    return operator, (crow, ccol)
+
+
+def _cached(key, func):
+    """Value of key in the operator cache, computed with func if missing"""
+    if key in _operator_cache:
+        _operator_cache.move_to_end(key)
+        return _operator_cache[key]
+
+    _logger.debug('computing %s', key)
+    result = func()
+    _operator_cache[key] = result
+    while len(_operator_cache) > OPERATOR_CACHE_SIZE:
+        _operator_cache.popitem(last=False)
+    return result
+
+
+def cube_geometry(fiberconf, target_scale=1.0, refid=614):
+    """
+    Geometry of the rectangular grid of a focal plane configuration
+
+    The geometry is cached in memory, as the operators
+    computed by cube_operator.
+
+    Parameters
+    ----------
+    fiberconf : megaradrp.instrument.focalplane.FocalPlaneConf
+    target_scale : float, optional
+    refid : int
+        fiber ID of reference fiber for grid coordinates
+
+    Returns
+    -------
+    tuple
+        Positions of the fibers and reference point, as returned by
+        calc_matrix_from_fiberconf, and extremes of the grid, as
+        returned by hexgrid_extremes
+
+    """
+    def compute():
+        r0l, ref = calc_matrix_from_fiberconf(fiberconf, refid=refid)
+        extremes = hg.hexgrid_extremes(r0l, target_scale)
+        return r0l, ref, extremes
+
+    key = ('geometry', fiberconf.conf_id, fiberconf.funit, float(target_scale), refid)
+    return _cached(key, compute)
+
+
+def cube_operator(fiberconf, p=1, target_scale=1.0, refid=614):
+    """
+    Interpolation operator of a focal plane configuration
+
+    The operators are cached in memory, using as key the
+    configuration id, the units of the positions of the fibers,
+    the interpolation order, the scale and the reference fiber.
+
+    Parameters
+    ----------
+    fiberconf : megaradrp.instrument.focalplane.FocalPlaneConf
+    p : {1, 2}
+    target_scale : float, optional
+    refid : int
+        fiber ID of reference fiber for grid coordinates
+
+    Returns
+    -------
+    tuple
+        Operator and shape of the spatial grid, see calc_cube_operator
+
+    """
+    def compute():
+        r0l, _, extremes = cube_geometry(fiberconf, target_scale, refid=refid)
+        return calc_cube_operator(r0l, p, target_scale, extremes=extremes)
+
+    key = (fiberconf.conf_id, fiberconf.funit, p, float(target_scale), refid)
+    return _cached(key, compute)
+
+
+def spline_postfilter(dk, workers=1):
+    """
+    Cubic spline coefficients of each plane of a cube, in place
+
+    The recursive spline filter is applied along the two first
+    axes, with mirror-symmetric boundaries. The result is the same
+    as applying scipy.signal.cspline2d to each plane dk[..., k].
+    With workers > 1, the planes are filtered in chunks in
+    a pool of threads.
+
+    Parameters
+    ----------
+    dk : np.ndarray
+        Cube of shape (nrows, ncols, nplanes)
+    workers : int, optional
+
+    Returns
+    -------
+    np.ndarray
+        `dk`, with the coefficients
+
+    """
+    def filter_chunk(chunk):
+        for axis in [0, 1]:
+            ndimage.spline_filter1d(chunk, order=3, axis=axis,
+                                    mode='reflect', output=chunk)
+
+    nplanes = dk.shape[-1]
+    if workers > 1 and nplanes > 1:
+        bounds = np.linspace(0, nplanes, min(workers, nplanes) + 1).astype('int')
+        chunks = [dk[..., k0:k1] for k0, k1 in zip(bounds[:-1], bounds[1:])]
+        with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+            list(executor.map(filter_chunk, chunks))
+    else:
+        filter_chunk(dk)
+    return dk
+
+
+def create_cube(r0l, zval, p=1, target_scale=1.0, operator=None, workers=1):
     """
 
     Parameters
@@ -85,6 +285,10 @@ def create_cube(r0l, zval, p=1, target_scale=1.0):
     zval
     p : {1, 2}
     target_scale : float, optional
+    operator : tuple, optional
+        Interpolation operator, computed from `r0l` if None
+    workers : int, optional
+        Number of threads used in postfiltering
 
     Returns
     -------
@@ -102,42 +306,20 @@ def create_cube(r0l, zval, p=1, target_scale=1.0):
     if p > 2:
         raise ValueError('p > 2 not implemented')
 
-    rr1 = target_scale * np.array([[1.0, 0], [0, 1]])  # Unit scale
-
-    # compute extremes of hexgrid to rectangular grid
-    # with pixel size 'scale'
-
-    (i1min, i1max), (j1min, j1max) = hg.hexgrid_extremes(r0l, target_scale)
-
-    # Rectangular grid
-    mk1 = np.arange(i1min, i1max + 1)
-    mk2 = np.arange(j1min, j1max + 1)
-    crow = len(mk1)
-    ccol = len(mk2)
-    # Result image
-    # Add third last axis
-    zval2 = atleast_2d_last(zval)
-    # disp axis is last axis...
-    dk = np.zeros((crow, ccol, zval2.shape[-1]))
-    # print('result shape is ', dk.shape)
-    # r1k = rr1 @ sk
-    sk = np.flipud(np.transpose(
-        [np.tile(mk1, len(mk2)), np.repeat(mk2, len(mk1))]).T)  # x y
-    r1k = np.dot(rr1, sk)
-
     # Prefiltering
     # For p = 1, prefilter coefficients with p = 1, coeff = 1
     # For p = 2, prefilter coefficients with p = 2, coeff = 1
     # No prefiltering in zval2 is required if p <= 2
 
-    rbs = hspline.rescaling_kernel(p, scale=target_scale)
+    if operator is None:
+        operator = calc_cube_operator(r0l, p, target_scale)
+    matrix, (crow, ccol) = operator
 
-    # Loop to compute integrals...
-    for s, r in zip(sk.T, r1k.T):
-        allpos = -(r0l - r[:, np.newaxis])
-        we = np.abs((rbs.ev(allpos[1], allpos[0])))
-        dk[s[1] - i1min, s[0] -
-            j1min] = np.sum(we[:, np.newaxis] * zval2, axis=0)
+    # Result image
+    # Add third last axis
+    zval2 = atleast_2d_last(zval)
+    # disp axis is last axis...
+    dk = (matrix @ zval2).reshape(crow, ccol, zval2.shape[-1])
 
     # Postfiltering
     # For p = 1, final image in NN, postfilter coefficients with n = 1
@@ -150,10 +332,8 @@ def create_cube(r0l, zval, p=1, target_scale=1.0):
         img = cpk
     elif p == 2:
         # Coefficients post filtering to n = 2 * p - 1 == 3
-        cpk = np.zeros_like(dk)
-        # last axis
-        for k in range(dk.shape[-1]):
-            cpk[..., k] = signal.cspline2d(dk[..., k])
+        # all the planes at once
+        cpk = spline_postfilter(dk, workers=workers)
         # Linear samples equal to coefficients
         img = cpk
     else:
@@ -162,7 +342,8 @@ def create_cube(r0l, zval, p=1, target_scale=1.0):
     return img
 
 
-def create_cube_from_array(rss_data, fiberconf, p=1, target_scale_arcsec=1.0, conserve_flux=True):
+def create_cube_from_array(rss_data, fiberconf, p=1, target_scale_arcsec=1.0, conserve_flux=True,
+                           workers=1):
     """
     Create a cube array from a 2D or 1D array and focal plane configuration
 
@@ -173,6 +354,8 @@ def create_cube_from_array(rss_data, fiberconf, p=1, target_scale_arcsec=1.0, co
     p : {1, 2}
     target_scale_arcsec : float
     conserve_flux : bool
+    workers : int
+        Number of threads used in postfiltering
 
     Returns
     -------
@@ -180,27 +363,104 @@ def create_cube_from_array(rss_data, fiberconf, p=1, target_scale_arcsec=1.0, co
 
     """
 
+    rss_data = atleast_2d_last(rss_data)
+    _, _, result = next(iter_cube_slabs(
+        rss_data, fiberconf, p=p, target_scale_arcsec=target_scale_arcsec,
+        conserve_flux=conserve_flux, nplanes=rss_data.shape[-1], workers=workers
+    ))
+    return result
+
+
+def iter_cube_slabs(rss_data, fiberconf, p=1, target_scale_arcsec=1.0,
+                    conserve_flux=True, nplanes=None, workers=1):
+    """
+    Create a cube in slabs of wavelength planes
+
+    Parameters
+    ----------
+    rss_data
+    fiberconf : megaradrp.instrument.focalplane.FocalPlaneConf
+    p : {1, 2}
+    target_scale_arcsec : float
+    conserve_flux : bool
+    nplanes : int, optional
+        Number of wavelength planes in each slab, all if None
+    workers : int
+        Number of threads used in postfiltering
+
+    Yields
+    ------
+    tuple
+        First and last (excluded) plane of the slab and the slab,
+        a float32 array with the wavelength axis first
+
+    """
+
     target_scale = target_scale_arcsec / HEX_SCALE
     conected = fiberconf.connected_fibers()
     rows = [conf.fibid - 1 for conf in conected]
 
     rss_data = atleast_2d_last(rss_data)
+    nwave = rss_data.shape[-1]
+    if nplanes is None:
+        nplanes = nwave
+    nplanes = max(int(nplanes), 1)
+
+    operator = cube_operator(fiberconf, p, target_scale)
+    for k0 in range(0, nwave, nplanes):
+        k1 = min(k0 + nplanes, nwave)
+        region = rss_data[rows, k0:k1]
+        cube_data = create_cube(None, region, p, target_scale, operator=operator,
+                                workers=workers)
+
+        if conserve_flux:
+            # scale with areas
+            cube_data *= (target_scale ** 2 / hg.HA_HEX)
+        # Move axis to put WL first
+        # so that is last in FITS
+        result = np.moveaxis(cube_data, 2, 0)
+        yield k0, k1, result.astype('float32')
+
+
+def cube_slab_planes(fiberconf, p=1, target_scale_arcsec=1.0, max_memory=None):
+    """
+    Number of wavelength planes in a slab that fit in max_memory bytes
 
-    region = rss_data[rows, :]
+    The estimate includes the float64 interpolated planes
+    and the float32 output.
+    """
+    if max_memory is None:
+        return None
+    target_scale = target_scale_arcsec / HEX_SCALE
+    matrix, (crow, ccol) = cube_operator(fiberconf, p, target_scale)
+    nfib = matrix.shape[1]
+    plane_bytes = crow * ccol * (8 + 4 + 4) + nfib * 8
+    return max(int(max_memory // plane_bytes), 1)
 
-    r0l, _ = calc_matrix_from_fiberconf(fiberconf)
-    cube_data = create_cube(r0l, region[:, :], p, target_scale)
 
-    if conserve_flux:
-        # scale with areas
-        cube_data *= (target_scale ** 2 / hg.HA_HEX)
-    # Move axis to put WL first
-    # so that is last in FITS
-    result = np.moveaxis(cube_data, 2, 0)
-    return result.astype('float32')
+def cube_sky_header(rss, fiberconf, target_scale_arcsec=1.0):
+    """Sky WCS of the cube, from the FIBERS header of the RSS"""
+    sky_header = rss['FIBERS'].header.copy()
+    # Update values of sky WCS
+    # CRPIX1, CRPIX2
+    # CDELT1, CDELT2
+    # minx, miny
+    # After shifting the array
+    # refpixel is -i1min, -j1min
+    target_scale = target_scale_arcsec / HEX_SCALE
+    _, (refx, refy), extremes = cube_geometry(fiberconf, target_scale)
+    (i1min, i1max), (j1min, j1max) = extremes
+    crpix_x = -refx / target_scale - j1min
+    crpix_y = -refy / target_scale - i1min
+    # Map the center of original field
+    sky_header['CRPIX1'] = crpix_x
+    sky_header['CRPIX2'] = crpix_y
+    sky_header['CDELT1'] = -target_scale_arcsec / 3600.0
+    sky_header['CDELT2'] = target_scale_arcsec / 3600.0
+    return sky_header
 
 
-def create_cube_from_rss(rss, p=1, target_scale_arcsec=1.0, conserve_flux=True):
+def create_cube_from_rss(rss, p=1, target_scale_arcsec=1.0, conserve_flux=True, workers=1):
     """
     Create a cube HDUlist from a RSS HDUList
 
@@ -210,6 +470,8 @@ def create_cube_from_rss(rss, p=1, target_scale_arcsec=1.0, conserve_flux=True):
     p : {1, 2}
     target_scale_arcsec : float, optional
     conserve_flux : bool, optional
+    workers : int, optional
+        Number of threads used in postfiltering
 
     Returns
     -------
@@ -220,30 +482,14 @@ def create_cube_from_rss(rss, p=1, target_scale_arcsec=1.0, conserve_flux=True):
     result_arr = create_cube_from_array(
         rss[0].data, fiberconf, p=p,
         target_scale_arcsec=target_scale_arcsec,
-        conserve_flux=conserve_flux
+        conserve_flux=conserve_flux, workers=workers
     )
 
     cube = copy_img(rss)
     cube[0].data = result_arr
 
-    sky_header = rss['FIBERS'].header.copy()
+    sky_header = cube_sky_header(rss, fiberconf, target_scale_arcsec)
     spec_header = rss[0].header
-    # Update values of sky WCS
-    # CRPIX1, CRPIX2
-    # CDELT1, CDELT2
-    # minx, miny
-    # After shifting the array
-    # refpixel is -i1min, -j1min
-    target_scale = target_scale_arcsec / HEX_SCALE
-    r0l, (refx, refy) = calc_matrix_from_fiberconf(fiberconf)
-    (i1min, i1max), (j1min, j1max) = hg.hexgrid_extremes(r0l, target_scale)
-    crpix_x = -refx / target_scale - j1min
-    crpix_y = -refy / target_scale - i1min
-    # Map the center of original field
-    sky_header['CRPIX1'] = crpix_x
-    sky_header['CRPIX2'] = crpix_y
-    sky_header['CDELT1'] = -target_scale_arcsec / 3600.0
-    sky_header['CDELT2'] = target_scale_arcsec / 3600.0
 
     # Merge headers
     # 2D from FIBERS
@@ -254,6 +500,294 @@ def create_cube_from_rss(rss, p=1, target_scale_arcsec=1.0, conserve_flux=True):
     return cube
 
 
+def write_cube_from_rss(rss, outfile, p=1, target_scale_arcsec=1.0,
+                        conserve_flux=True, max_memory=None, overwrite=False,
+                        workers=1):
+    """
+    Create a cube from a RSS HDUList and write it to a FITS file
+
+    The cube is computed in slabs of wavelength planes, that are
+    written in the memory mapped data section of the primary HDU
+    of the file. The memory used by the slabs is bounded
+    by `max_memory`.
+
+    Parameters
+    ----------
+    rss : fits.HDUList
+    outfile : str or pathlib.Path
+    p : {1, 2}
+    target_scale_arcsec : float, optional
+    conserve_flux : bool, optional
+    max_memory : int, optional
+        Maximum size in bytes of the slabs, the whole cube if None
+    overwrite : bool, optional
+    workers : int, optional
+        Number of threads used in postfiltering
+
+    """
+    fiberconf = FocalPlaneConf.from_img(rss)
+    target_scale = target_scale_arcsec / HEX_SCALE
+    _, (crow, ccol) = cube_operator(fiberconf, p, target_scale)
+    rss_data = atleast_2d_last(rss[0].data)
+    nwave = rss_data.shape[-1]
+    nplanes = cube_slab_planes(fiberconf, p, target_scale_arcsec, max_memory)
+
+    # Header of the cube
+    hdr = rss[0].header.copy()
+    sky_header = cube_sky_header(rss, fiberconf, target_scale_arcsec)
+    merge_wcs(sky_header, rss[0].header, out=hdr)
+    shape = (nwave, crow, ccol)
+
+    _logger.debug('writing cube of shape %s in slabs of %s planes', shape, nplanes)
+    slabs = iter_cube_slabs(
+        rss_data, fiberconf, p=p, target_scale_arcsec=target_scale_arcsec,
+        conserve_flux=conserve_flux, nplanes=nplanes, workers=workers)
+    write_cube_slabs(outfile, hdr, shape, slabs, rss[1:], overwrite=overwrite)
+
+
+def write_cube_slabs(outfile, header, shape, slabs, extensions=(), overwrite=False):
+    """
+    Write a cube to a FITS file, slab by slab
+
+    The primary HDU is created with an empty data section
+    that is filled through a memory map.
+
+    Parameters
+    ----------
+    outfile : str or pathlib.Path
+    header : fits.Header
+        Header of the primary HDU
+    shape : tuple
+        Shape of the cube, with the wavelength axis first
+    slabs : iterable
+        Triplets of first and last (excluded) plane and slab
+    extensions : sequence of HDU, optional
+        HDUs appended after the primary HDU
+    overwrite : bool, optional
+
+    """
+    primary = fits.PrimaryHDU(data=np.zeros((1, 1, 1), dtype='float32'), header=header)
+    header = primary.header
+    for axis, size in enumerate(reversed(shape), 1):
+        header[f'NAXIS{axis}'] = size
+    header_bytes = header.tostring().encode('ascii')
+    data_bytes = 4 * int(np.prod(shape))
+    padded = -(-data_bytes // 2880) * 2880
+
+    mode = 'wb' if overwrite else 'xb'
+    with open(outfile, mode) as fd:
+        fd.write(header_bytes)
+        fd.truncate(len(header_bytes) + padded)
+
+    out = np.memmap(outfile, dtype='>f4', mode='r+', offset=len(header_bytes), shape=shape)
+    try:
+        for k0, k1, slab in slabs:
+            out[k0:k1] = slab
+        out.flush()
+    finally:
+        del out
+
+    for hdu in extensions:
+        fits.append(outfile, hdu.data, hdu.header)
+
+
+def dithered_fiber_positions(rss_list, refid=614):
+    """
+    Positions of the fibers of several RSS in the frame of the first one
+
+    The positions of the fibers of each RSS are transformed to the
+    sky with the WCS of its FIBERS extension and then to the focal
+    plane of the first RSS, in units of the hexagonal grid relative
+    to the reference fiber.
+
+    Parameters
+    ----------
+    rss_list : sequence of fits.HDUList
+    refid : int
+        fiber ID of reference fiber for grid coordinates
+
+    Returns
+    -------
+    tuple
+        List of pairs of rows of the connected fibers and their
+        positions, one per RSS, and the reference point of the first RSS
+    """
+    ref_conf = FocalPlaneConf.from_img(rss_list[0])
+    ref_wcs = astropy.wcs.WCS(rss_list[0]['FIBERS'].header)
+    _, ref = calc_matrix_from_fiberconf(ref_conf, refid=refid)
+    ascale = _grid_unit(ref_conf)
+
+    result = []
+    for rss in rss_list:
+        fiberconf = FocalPlaneConf.from_img(rss)
+        fibers = fiberconf.connected_fibers()
+        rows = [fiber.fibid - 1 for fiber in fibers]
+        xx = np.array([fiber.x for fiber in fibers])
+        yy = np.array([fiber.y for fiber in fibers])
+        wcs = astropy.wcs.WCS(rss['FIBERS'].header)
+        # the pixel coordinates of the FIBERS WCS are the positions of the fibers
+        world = wcs.all_pix2world(xx, yy, 1)
+        x1, y1 = ref_wcs.all_world2pix(world[0], world[1], 1)
+        r0l = np.array([x1 / ascale - ref[0], y1 / ascale - ref[1]])
+        result.append((rows, r0l))
+    return result, ref
+
+
+class DitheredCubeCombiner:
+    """
+    Combine several RSS of a dithered pattern in one cube
+
+    The fibers of all the RSS are placed in the grid of the first
+    one, using the WCS of their FIBERS extensions. The flux of each
+    fiber and the weight of the interpolation kernel are accumulated
+    in the spaxels of the common grid, in a drizzle-like fashion.
+    The cube is the accumulated flux divided by the accumulated weight,
+    and it is zero in the spaxels with weight less than `min_weight`.
+
+    Parameters
+    ----------
+    rss_list : sequence of fits.HDUList
+        RSS with the same wavelength calibration
+    p : {1, 2}
+    target_scale_arcsec : float, optional
+    scales : sequence of float, optional
+        Factor applied to the flux of each RSS
+    conserve_flux : bool, optional
+    refid : int, optional
+        fiber ID of reference fiber for grid coordinates
+    min_weight : float, optional
+
+    """
+
+    def __init__(self, rss_list, p=1, target_scale_arcsec=1.0, scales=None,
+                 conserve_flux=True, refid=614, min_weight=0.01):
+        if p > 2:
+            raise ValueError('p > 2 not implemented')
+        if not rss_list:
+            raise ValueError('no RSS to combine')
+        shapes = {atleast_2d_last(rss[0].data).shape for rss in rss_list}
+        if len(shapes) > 1:
+            raise ValueError(f'RSS with different shapes {shapes}')
+        if scales is None:
+            scales = [1.0] * len(rss_list)
+        elif len(scales) != len(rss_list):
+            raise ValueError('len(scales) must be equal to len(rss_list)')
+
+        self.rss_list = rss_list
+        self.p = p
+        self.target_scale_arcsec = target_scale_arcsec
+        self.target_scale = target_scale_arcsec / HEX_SCALE
+        self.scales = list(scales)
+        self.conserve_flux = conserve_flux
+        self.min_weight = min_weight
+
+        positions, self.ref = dithered_fiber_positions(rss_list, refid=refid)
+        all_pos = np.concatenate([r0l for _, r0l in positions], axis=1)
+        self.extremes = hg.hexgrid_extremes(all_pos, self.target_scale)
+        self.rows = []
+        self.operators = []
+        for rows, r0l in positions:
+            matrix, grid_shape = calc_cube_operator(
+                r0l, p, self.target_scale, extremes=self.extremes)
+            self.rows.append(rows)
+            self.operators.append(matrix)
+        self.grid_shape = grid_shape
+        # accumulated weight of the kernel in each spaxel
+        weight = sum(np.asarray(matrix.sum(axis=1)).ravel() for matrix in self.operators)
+        self.weight = weight.reshape(grid_shape)
+
+    @property
+    def shape(self):
+        """Shape of the cube, with the wavelength axis first"""
+        nwave = atleast_2d_last(self.rss_list[0][0].data).shape[-1]
+        return (nwave,) + self.grid_shape
+
+    def slab_planes(self, max_memory=None):
+        """Number of wavelength planes in a slab that fit in max_memory bytes"""
+        if max_memory is None:
+            return None
+        crow, ccol = self.grid_shape
+        nfib = sum(len(rows) for rows in self.rows)
+        # accumulated flux, product of each RSS and output
+        plane_bytes = crow * ccol * (8 + 8 + 4) + nfib * 8
+        return max(int(max_memory // plane_bytes), 1)
+
+    def iter_slabs(self, nplanes=None, workers=1):
+        """
+        Combined cube in slabs of wavelength planes
+
+        Yields
+        ------
+        tuple
+            First and last (excluded) plane of the slab and the slab,
+            a float32 array with the wavelength axis first
+        """
+        nwave = self.shape[0]
+        if nplanes is None:
+            nplanes = nwave
+        nplanes = max(int(nplanes), 1)
+        crow, ccol = self.grid_shape
+        covered = self.weight >= self.min_weight
+        norm = np.where(covered, 1.0 / np.where(covered, self.weight, 1.0), 0.0)
+
+        for k0 in range(0, nwave, nplanes):
+            k1 = min(k0 + nplanes, nwave)
+            flux = np.zeros((crow * ccol, k1 - k0))
+            for rss, rows, matrix, scale in zip(self.rss_list, self.rows, self.operators, self.scales):
+                region = atleast_2d_last(rss[0].data)[rows, k0:k1]
+                flux += scale * (matrix @ region)
+
+            dk = flux.reshape(crow, ccol, k1 - k0)
+            dk *= norm[..., np.newaxis]
+            if self.p == 2:
+                dk = spline_postfilter(dk, workers=workers)
+            if self.conserve_flux:
+                # scale with areas
+                dk *= (self.target_scale ** 2 / hg.HA_HEX)
+            result = np.moveaxis(dk, 2, 0)
+            yield k0, k1, result.astype('float32')
+
+    def header(self):
+        """Header of the combined cube, with the sky WCS of the first RSS"""
+        rss = self.rss_list[0]
+        sky_header = rss['FIBERS'].header.copy()
+        refx, refy = self.ref
+        (i1min, i1max), (j1min, j1max) = self.extremes
+        sky_header['CRPIX1'] = -refx / self.target_scale - j1min
+        sky_header['CRPIX2'] = -refy / self.target_scale - i1min
+        sky_header['CDELT1'] = -self.target_scale_arcsec / 3600.0
+        sky_header['CDELT2'] = self.target_scale_arcsec / 3600.0
+        hdr = rss[0].header.copy()
+        merge_wcs(sky_header, rss[0].header, out=hdr)
+        hdr['NCOMBINE'] = (len(self.rss_list), 'Number of combined RSS')
+        return hdr
+
+    def extensions(self):
+        """Weight map and FIBERS extension of the first RSS"""
+        weight = fits.ImageHDU(self.weight.astype('float32'), name='WEIGHT')
+        return [weight, self.rss_list[0]['FIBERS'].copy()]
+
+    def create_cube(self, nplanes=None, workers=1):
+        """
+        Create the combined cube
+
+        Returns
+        -------
+        fits.HDUList
+        """
+        data = np.empty(self.shape, dtype='float32')
+        for k0, k1, slab in self.iter_slabs(nplanes=nplanes, workers=workers):
+            data[k0:k1] = slab
+        primary = fits.PrimaryHDU(data=data, header=self.header())
+        return fits.HDUList([primary] + self.extensions())
+
+    def write_cube(self, outfile, max_memory=None, overwrite=False, workers=1):
+        """Write the combined cube, in slabs that fit in max_memory bytes"""
+        slabs = self.iter_slabs(nplanes=self.slab_planes(max_memory), workers=workers)
+        write_cube_slabs(outfile, self.header(), self.shape, slabs,
+                         self.extensions(), overwrite=overwrite)
+
+
 def merge_wcs(hdr_sky, hdr_spec, out=None):
     """Merge sky WCS with spectral WCS
 
@@ -362,6 +896,196 @@ def merge_wcs_alt(hdr_sky, hdr_spec, out, spec_suffix=' '):
     return hdr
 
 
+def prepare_rss(rss, pa_from_header=False, fix_missing=False):
+    """Recompute the WCS from the IPA angle and interpolate missing fibers"""
+    if not pa_from_header:
+        # Doing it here so the change is propagated to
+        # all alternative coordinates
+        _logger.info('recompute WCS from IPA')
+        ipa = rss['PRIMARY'].header['IPA']
+        rss['FIBERS'].header = fixrss.recompute_wcs(
+            rss['FIBERS'].header, ipa=ipa)
+    if fix_missing:
+        fibid = 623
+        _logger.info('interpolate fiber %d', fibid)
+        rss = fixrss.fix_missing_fiber(rss, fibid)
+    return rss
+
+
+def combine_rss_files(rssfiles, outfile, p=1, target_scale_arcsec=1.0,
+                      conserve_flux=True, scales=None, pa_from_header=False,
+                      fix_missing=False, max_memory=None, workers=1):
+    """
+    Combine several RSS files of a dithered pattern into a cube file
+
+    See DitheredCubeCombiner for the parameters of the combination
+    and convert_rss_to_cube for the rest of the parameters.
+    """
+    rss_list = []
+    try:
+        for rssfile in rssfiles:
+            rss = fits.open(rssfile)
+            rss_list.append(rss)
+            prepare_rss(rss, pa_from_header=pa_from_header, fix_missing=fix_missing)
+        combiner = DitheredCubeCombiner(
+            rss_list, p=p, target_scale_arcsec=target_scale_arcsec,
+            scales=scales, conserve_flux=conserve_flux)
+        if max_memory is not None:
+            combiner.write_cube(outfile, max_memory=max_memory,
+                                overwrite=True, workers=workers)
+        else:
+            cube = combiner.create_cube(workers=workers)
+            cube.writeto(outfile, overwrite=True)
+    finally:
+        for rss in rss_list:
+            rss.close()
+
+
+def convert_rss_to_cube(rssfile, outfile, p=1, target_scale_arcsec=1.0,
+                        conserve_flux=True, pa_from_header=False,
+                        fix_missing=False, max_memory=None, workers=1):
+    """
+    Convert a RSS file into a cube file
+
+    Parameters
+    ----------
+    rssfile : str or pathlib.Path
+    outfile : str or pathlib.Path
+    p : {1, 2}
+    target_scale_arcsec : float, optional
+    conserve_flux : bool, optional
+    pa_from_header : bool, optional
+        If False, the WCS is recomputed from the IPA angle
+    fix_missing : bool, optional
+        Interpolate missing fibers
+    max_memory : int, optional
+        If not None, build the cube in wavelength slabs,
+        using at most `max_memory` bytes
+    workers : int, optional
+        Number of threads used in postfiltering
+
+    """
+    with fits.open(rssfile) as rss:
+        rss = prepare_rss(rss, pa_from_header=pa_from_header, fix_missing=fix_missing)
+
+        if max_memory is not None:
+            write_cube_from_rss(
+                rss, outfile, p, target_scale_arcsec, conserve_flux=conserve_flux,
+                max_memory=max_memory, overwrite=True, workers=workers)
+            return
+
+        cube = create_cube_from_rss(
+            rss, p, target_scale_arcsec, conserve_flux=conserve_flux,
+            workers=workers)
+
+    cube.writeto(outfile, overwrite=True)
+
+
+def group_rss_files(rssfiles):
+    """
+    Group RSS files by focal plane configuration
+
+    Returns
+    -------
+    dict
+        Pairs of FocalPlaneConf and list of files, keyed by the
+        configuration id and the units of the positions of the fibers
+    """
+    groups = {}
+    for rssfile in rssfiles:
+        fiberconf = FocalPlaneConf.from_header(fits.getheader(rssfile, 'FIBERS'))
+        key = (fiberconf.conf_id, fiberconf.funit)
+        if key not in groups:
+            groups[key] = (fiberconf, [])
+        groups[key][1].append(rssfile)
+    return groups
+
+
+def _seed_operator_cache(entries):
+    """Initialize the operator cache of a worker process"""
+    _operator_cache.update(entries)
+
+
+def _convert_rss_task(rssfile, outfile, kwargs):
+    """Convert one file in a batch, returning a report"""
+    t0 = time.perf_counter()
+    try:
+        convert_rss_to_cube(rssfile, outfile, **kwargs)
+        error = None
+    except Exception as exc:
+        error = f'{type(exc).__name__}: {exc}'
+    return {'rss': str(rssfile), 'cube': str(outfile),
+            'time': time.perf_counter() - t0, 'error': error}
+
+
+def convert_rss_batch(rssfiles, outdir='.', processes=1, p=1,
+                      target_scale_arcsec=1.0, **kwargs):
+    """
+    Convert many RSS files into cube files
+
+    The files are grouped by focal plane configuration. The geometry
+    and the interpolation operator are computed once per group and
+    shared by all the conversions, that run in a pool of processes.
+    Each cube is written in `outdir`, with the name of the RSS file
+    and the suffix '_cube'.
+
+    Parameters
+    ----------
+    rssfiles : list of str or pathlib.Path
+    outdir : str or pathlib.Path, optional
+    processes : int, optional
+    p : {1, 2}
+    target_scale_arcsec : float, optional
+    kwargs
+        Other arguments of convert_rss_to_cube
+
+    Returns
+    -------
+    list of dict
+        Report of each file, with the names of the RSS and the cube,
+        the time used and the error message, None if successful
+    """
+    outdir = pathlib.Path(outdir)
+    target_scale = target_scale_arcsec / HEX_SCALE
+    kwargs = dict(kwargs, p=p, target_scale_arcsec=target_scale_arcsec)
+
+    tasks = []
+    for fiberconf, group in group_rss_files(rssfiles).values():
+        _logger.info('%d files with configuration %s', len(group), fiberconf.conf_id)
+        cube_geometry(fiberconf, target_scale)
+        cube_operator(fiberconf, p, target_scale)
+        for rssfile in group:
+            outfile = outdir / f'{pathlib.Path(rssfile).stem}_cube.fits'
+            tasks.append((rssfile, outfile, kwargs))
+
+    if processes > 1 and len(tasks) > 1:
+        entries = dict(_operator_cache)
+        with mp.Pool(min(processes, len(tasks)), initializer=_seed_operator_cache,
+                     initargs=(entries,)) as pool:
+            reports = pool.starmap(_convert_rss_task, tasks)
+    else:
+        reports = [_convert_rss_task(*task) for task in tasks]
+    return reports
+
+
+def expand_rss_files(names, listfile=None):
+    """Expand glob patterns and read names from a list file"""
+    names = list(names)
+    result = []
+    if listfile is not None:
+        with open(listfile) as fd:
+            for line in fd:
+                line = line.strip()
+                if line and not line.startswith('#'):
+                    names.append(line)
+    for name in names:
+        if glob.has_magic(name):
+            result.extend(sorted(glob.glob(name)))
+        else:
+            result.append(name)
+    return result
+
+
 def main(args=None):
     """Main function to convert RSS to cube"""
 
@@ -371,9 +1095,9 @@ def main(args=None):
 
     methods = {'nn': 1, 'linear': 2}
 
-    parser.add_argument("rss",
-                        help="RSS file with fiber traces",
-                        type=argparse.FileType('rb'))
+    parser.add_argument("rss", nargs='*',
+                        help="RSS file with fiber traces, or several "
+                             "files or glob patterns in batch mode")
     parser.add_argument('-p', '--pixel-size', type=float, default=0.3,
                         metavar='PIXEL_SIZE',
                         help="Pixel size in arc seconds")
@@ -387,32 +1111,67 @@ def main(args=None):
                         help="Use PA angle from header", dest='pa_from_header')
     parser.add_argument('--fix-missing', action='store_true',
                         help="Interpolate missing fibers")
+    parser.add_argument('--threads', type=int, default=1,
+                        help="Number of threads used in postfiltering")
+    parser.add_argument('--max-memory', type=float, metavar='MAX_MEMORY',
+                        help="Build the cube in wavelength slabs, "
+                             "using at most MAX_MEMORY megabytes")
+    parser.add_argument('--list', dest='listfile', metavar='LISTFILE',
+                        help="File with the names of the RSS files, one per line")
+    parser.add_argument('--outdir', default='.',
+                        help="Directory of the output cubes in batch mode")
+    parser.add_argument('--processes', type=int, default=1,
+                        help="Number of processes in batch mode")
+    parser.add_argument('--combine', action='store_true',
+                        help="Combine all the RSS files in one cube")
+    parser.add_argument('--scales', type=float, nargs='+', metavar='SCALE',
+                        help="Flux scale of each RSS file when combining")
 
     args = parser.parse_args(args=args)
 
+    rssfiles = expand_rss_files(args.rss, args.listfile)
+    if not rssfiles:
+        parser.error('no RSS files')
+
     target_scale = args.pixel_size  # Arcsec
     p = methods[args.method]
     print(f'interpolation method is "{args.method}"')
     print('target scale is', target_scale, 'arcsec')
     conserve_flux = not args.disable_scaling
-
-    with fits.open(args.rss) as rss:
-        if not args.pa_from_header:
-            # Doing it here so the change is propagated to
-            # all alternative coordinates
-            print('recompute WCS from IPA')
-            ipa = rss['PRIMARY'].header['IPA']
-            rss['FIBERS'].header = fixrss.recompute_wcs(
-                rss['FIBERS'].header, ipa=ipa)
-        if args.fix_missing:
-            fibid = 623
-            print(f'interpolate fiber {fibid}')
-            rss = fixrss.fix_missing_fiber(rss, fibid)
-
-        cube = create_cube_from_rss(
-            rss, p, target_scale, conserve_flux=conserve_flux)
-
-    cube.writeto(args.outfile, overwrite=True)
+    if args.max_memory is not None:
+        max_memory = args.max_memory * 1024 ** 2
+    else:
+        max_memory = None
+
+    kwargs = dict(conserve_flux=conserve_flux,
+                  pa_from_header=args.pa_from_header,
+                  fix_missing=args.fix_missing,
+                  max_memory=max_memory, workers=args.threads)
+
+    if args.combine:
+        print(f'combining {len(rssfiles)} files')
+        combine_rss_files(rssfiles, args.outfile, p, target_scale,
+                          scales=args.scales, **kwargs)
+        return
+
+    batch = len(rssfiles) > 1 or args.listfile is not None
+    if not batch:
+        convert_rss_to_cube(rssfiles[0], args.outfile, p, target_scale, **kwargs)
+        return
+
+    reports = convert_rss_batch(rssfiles, outdir=args.outdir,
+                                processes=args.processes, p=p,
+                                target_scale_arcsec=target_scale, **kwargs)
+    nerrors = 0
+    for report in reports:
+        if report['error'] is None:
+            print(f"{report['rss']} -> {report['cube']} in {report['time']:.2f} s")
+        else:
+            nerrors += 1
+            print(f"{report['rss']} failed: {report['error']}")
+    print(f'converted {len(reports) - nerrors} of {len(reports)} files')
+    if nerrors:
+        sys.exit(1)
 
 
 if __name__ == '__main__':
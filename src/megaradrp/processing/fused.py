@@ -0,0 +1,152 @@
+#
+# Copyright 2025 Universidad Complutense de Madrid
+#
+# This file is part of Megara DRP
+#
+# SPDX-License-Identifier: GPL-3.0-or-later
+# License-Filename: LICENSE.txt
+#
+
+"""Reduction of a 2D image to a calibrated RSS with one operator"""
+
+import collections
+import hashlib
+import logging
+
+import numpy
+import scipy.sparse as sparse
+from numina.processing import Corrector
+
+from .wavecalibration import target_wcs_megara, update_wl_headers
+
+
+# Maximum number of fused operators kept in memory
+FUSED_CACHE_SIZE = 2
+_fused_cache = collections.OrderedDict()
+
+_logger = logging.getLogger(__name__)
+
+
+def flat_key(corrector):
+    """Identifier of the correction of a flat corrector.
+
+    The calibid of the corrector, or a hash of the
+    correction if the calibid is unknown.
+    """
+    if corrector.calibid != 'calibid-unknown':
+        return corrector.calibid
+    corr = numpy.ascontiguousarray(corrector.corr)
+    digest = hashlib.sha256(corr.view('uint8')).hexdigest()
+    return f'{corr.dtype.str}{corr.shape}-{digest}'
+
+
+class FusedRSSCalibrator(Corrector):
+    """A Node that extracts, calibrates in wavelength and flat-fields an image.
+
+    The aperture extraction, the flip of the RSS, the linear
+    wavelength resampling and the flat field corrections are
+    linear operations. They are composed in one sparse operator,
+    that maps the reduced 2D image to the calibrated RSS. The
+    result is equivalent to the chain of ApertureExtractor, FlipLR,
+    WavelengthCalibrator with resampling='linear' and the flat correctors.
+
+    Parameters
+    ----------
+    extractor : ApertureExtractor
+        Extractor with a trace map
+    wlcalibrator : WavelengthCalibrator
+    flat_correctors : list
+        FiberFlatCorrector and TwilightCorrector, applied in order
+    datamodel : optional
+    dtype : str
+    """
+
+    def __init__(self, extractor, wlcalibrator, flat_correctors=(), datamodel=None,
+                 dtype='float32'):
+        super(FusedRSSCalibrator, self).__init__(
+            datamodel=datamodel,
+            calibid=extractor.calibid,
+            dtype=dtype
+        )
+        self.extractor = extractor
+        self.wlcalibrator = wlcalibrator
+        self.flat_correctors = list(flat_correctors)
+        for corrector in self.flat_correctors:
+            # Avoid nan values when divide
+            corrector.corr[corrector.corr == 0.0] = 1.0
+        self.flat_keys = tuple(flat_key(corrector) for corrector in self.flat_correctors)
+
+    def operator_key(self, hdr, shape):
+        """Key of the operator in the cache"""
+        solutionwl = self.wlcalibrator.solutionwl
+        return (
+            self.extractor.calibid,
+            tuple(self.extractor.trace_repr.global_offset.coef),
+            solutionwl.uuid,
+            tuple(solutionwl.global_offset.coef),
+            hdr['INSMODE'], hdr['VPH'],
+            self.wlcalibrator.span,
+            tuple(shape),
+            self.flat_keys
+        )
+
+    def operator(self, hdr, shape):
+        """Fused operator, for images of this shape.
+
+        Parameters
+        ----------
+        hdr : astropy.io.fits.Header
+            Header of the image, with the instrument mode
+        shape : tuple
+            Shape (nrow, ncol) of the image
+
+        Returns
+        -------
+        tuple
+            The operator, a scipy.sparse.csr_matrix of shape
+            (nfibers * npix, nrow * ncol), and the ResamplingOperator
+        """
+        key = self.operator_key(hdr, shape)
+        if key in _fused_cache:
+            _fused_cache.move_to_end(key)
+            return _fused_cache[key]
+
+        _logger.debug('computing fused operator for %s', self.calibid)
+        extraction = self.extractor.extraction_operator(shape)
+        nfibers = self.extractor.trace_repr.total_fibers
+        ncol = shape[1]
+        resampling = self.wlcalibrator.resampling_operator(hdr, (nfibers, ncol))
+
+        # The flip of the RSS is a permutation of the columns of the resampling
+        rows = numpy.arange(nfibers)[:, numpy.newaxis]
+        flip = (rows * ncol + numpy.arange(ncol)[::-1]).ravel()
+        matrix = resampling.matrix[:, flip]
+
+        scale = numpy.ones(resampling.shape)
+        for corrector in self.flat_correctors:
+            scale /= corrector.corr
+        matrix = sparse.diags(scale.ravel()) @ matrix
+
+        result = (sparse.csr_matrix(matrix @ extraction), resampling)
+        _fused_cache[key] = result
+        while len(_fused_cache) > FUSED_CACHE_SIZE:
+            _fused_cache.popitem(last=False)
+        return result
+
+    def run(self, img):
+        imgid = self.get_imgid(img)
+        _logger.debug('fused reduction of image %s', imgid)
+        hdr = img[0].header
+        shape = img[0].data.shape
+        self.extractor.update_offset(img[0].data)
+        matrix, resampling = self.operator(hdr, shape)
+        flat = numpy.asarray(img[0].data, dtype='float').reshape(-1)
+        rssdata = (matrix @ flat).reshape(resampling.shape)
+
+        img = self.extractor.update_img(img, rssdata.astype(self.dtype))
+        targetwcs, _ = target_wcs_megara(hdr)
+        update_wl_headers(img, self.wlcalibrator.solutionwl, targetwcs, resampling.limits,
+                          span=self.wlcalibrator.span, resampling='linear')
+        for corrector in self.flat_correctors:
+            corrector.header_update(img[0].header, self.get_imgid(img))
+        return img
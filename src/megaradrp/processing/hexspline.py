@@ -1,5 +1,5 @@
 #
-# Copyright 2017-2023 Universidad Complutense de Madrid
+# Copyright 2017-2025 Universidad Complutense de Madrid
 #
 # This file is part of Megara DRP
 #
@@ -13,18 +13,25 @@ Interpolation method based on:
 van de Ville et al. IEEE Transactions on Image Processing 2004, 13, 6
 """
 
+import collections
 import math
 
 import scipy.interpolate as interp
 from scipy import signal
 import numpy as np
 
-from megaradrp.simulation.convolution import hex_c, setup_grid
+from megaradrp.simulation.convolution import hex_c
 
 
 # Hexagon constants
 M_SQRT3 = math.sqrt(3)
 
+# Sampling of the tabulated kernels
+KERNEL_STEP = 0.005
+# Maximum number of tabulated kernels kept in memory
+KERNEL_CACHE_SIZE = 16
+_kernel_cache = collections.OrderedDict()
+
 
 def hexspline1(xx, yy):
     """Hexspline of order p=1"""
@@ -440,41 +447,169 @@ def _bspline(x, n):
     knots = np.arange(-(n + 1) / 2, (n + 3) / 2)
     out = interp.BSpline.basis_element(knots)(x)
     out[(x < knots[0]) | (x > knots[-1])] = 0.0
+    # a step is 1/2 in its border, as in hexspline2
+    out[(x == knots[0]) | (x == knots[-1])] *= 0.5
     return out
 
 
-# Convolution, compute kernel
-def rescaling_kernel(p, scale=1):
-    """Rescaling kernel from hexgrid to rectangular grid"""
-    Dx = 0.005
-    Dy = 0.005
-    DA = Dx * Dy
-    # TODO: the support should be computed from the scale and p
-    xsize = ysize = 3.0
-    xx, yy, xs, ys, xl, yl = setup_grid(xsize, ysize, Dx, Dy)
+class TabulatedKernel:
+    """Kernel sampled in a regular grid.
+
+    The kernel is evaluated by bilinear interpolation of the
+    samples, and it is 0 outside the tabulated region. The
+    first coordinate of the kernel is y, as in the arrays
+    of samples.
+
+    Parameters
+    ----------
+    ys, xs : numpy.ndarray
+        Coordinates of the samples, with a uniform step
+    values : numpy.ndarray
+        Samples of the kernel, shape (len(ys), len(xs))
+    """
+
+    def __init__(self, ys, xs, values):
+        self.ys = ys
+        self.xs = xs
+        self.values = values
+        self.step = xs[1] - xs[0]
+
+    @property
+    def bbox(self):
+        """Tabulated region, ((ylow, yhigh), (xlow, xhigh))"""
+        return (self.ys[0], self.ys[-1]), (self.xs[0], self.xs[-1])
+
+    @property
+    def error_bound(self):
+        """Bound of the interpolation error.
+
+        The error of the bilinear interpolation of a function
+        is bounded by h^2 / 8 times the sum of the maximum values of
+        its second derivatives, estimated here with second differences
+        of the samples.
+        """
+        d2y = np.abs(np.diff(self.values, n=2, axis=0)).max(initial=0.0)
+        d2x = np.abs(np.diff(self.values, n=2, axis=1)).max(initial=0.0)
+        return (d2y + d2x) / 8
+
+    def __call__(self, y, x):
+        y = np.asanyarray(y, dtype='float')
+        x = np.asanyarray(x, dtype='float')
+        ny, nx = self.values.shape
+        fy = (y - self.ys[0]) / self.step
+        fx = (x - self.xs[0]) / self.step
+        inside = (fy >= 0) & (fy <= ny - 1) & (fx >= 0) & (fx <= nx - 1)
+        iy = np.clip(np.floor(fy).astype('int'), 0, ny - 2)
+        ix = np.clip(np.floor(fx).astype('int'), 0, nx - 2)
+        ty = fy - iy
+        tx = fx - ix
+        vals = self.values
+        res = (1 - ty) * ((1 - tx) * vals[iy, ix] + tx * vals[iy, ix + 1]) + \
+            ty * ((1 - tx) * vals[iy + 1, ix] + tx * vals[iy + 1, ix + 1])
+        return np.where(inside, res, 0.0)
+
+    def integral(self):
+        """Integral of the kernel over the tabulated region"""
+        # the kernel vanishes in the borders of the region
+        return self.values.sum() * self.step * self.step
+
+
+def _cached_kernel(key, func):
+    """Value of key in the kernel cache, computed with func if missing"""
+    if key in _kernel_cache:
+        _kernel_cache.move_to_end(key)
+        return _kernel_cache[key]
+
+    result = func()
+    _kernel_cache[key] = result
+    while len(_kernel_cache) > KERNEL_CACHE_SIZE:
+        _kernel_cache.popitem(last=False)
+    return result
+
+
+def clear_kernel_cache():
+    """Remove all the tabulated kernels from memory"""
+    _kernel_cache.clear()
+
+
+def _kernel_axis(half, step):
+    """Symmetric axis covering [-half, half], with an odd number of samples"""
+    npoints = int(math.ceil(half / step - 1e-9))
+    return step * np.arange(-npoints, npoints + 1)
+
+
+def hexspline_table(p, step=KERNEL_STEP):
+    """Hexspline of order p, tabulated over its bounding box
+
+    The tables are cached, the returned object must not be modified.
+    """
+    def compute():
+        if p == 1:
+            func = hexspline1
+        elif p == 2:
+            func = hexspline2
+        else:
+            raise ValueError('p>2 not implemented')
+        (_, x1), (_, y1) = hexspline_bbox(p)
+        xs = _kernel_axis(x1, step)
+        ys = _kernel_axis(y1, step)
+        xx, yy = np.meshgrid(xs, ys, indexing='xy')
+        return TabulatedKernel(ys, xs, func(xx, yy))
+
+    return _cached_kernel(('hexspline', p, step), compute)
+
+
+def rescaling_kernel_table(p, scale=1, step=KERNEL_STEP):
+    """Rescaling kernel from hexgrid to rectangular grid, tabulated
+
+    The kernel is the convolution of the hexspline of order p
+    with the B-spline of degree p - 1 of the rectangular grid.
+    It is tabulated over its support, the bounding box of the hexspline
+    enlarged by the half width of the B-spline.
+
+    The tables are cached, the returned object must not be modified.
+    """
+    if p not in (1, 2, 3):
+        raise ValueError('p>3 not implemented')
 
-    detR0 = M_SQRT3 / 2
-    detR1 = scale * scale
+    def compute():
+        (_, hx), (_, hy) = hexspline_bbox(p)
+        # half width of the B-spline of degree p - 1
+        half = scale * p / 2.0
+        xs = _kernel_axis(hx + half + step, step)
+        ys = _kernel_axis(hy + half + step, step)
+        xx, yy = np.meshgrid(xs, ys, indexing='xy')
+        DA = step * step
 
-    # index of bspline
-    n = p - 1
+        detR0 = M_SQRT3 / 2
+        detR1 = scale * scale
 
-    rect_kernel = _bspline(xx / scale, n) * _bspline(yy / scale, n) / detR1
+        # index of bspline
+        n = p - 1
 
-    hex1 = hexspline1(xx, yy)
+        rect_kernel = _bspline(xx / scale, n) * _bspline(yy / scale, n) / detR1
+
+        hex1 = hexspline1(xx, yy)
 
-    if p == 1:
         hex_kernel = hex1
-    elif p == 2:
-        hex2 = signal.fftconvolve(hex1, hex1, mode='same') * DA / detR0
-        hex_kernel = hex2
-    elif p == 3:
-        hex2 = signal.fftconvolve(hex1, hex1, mode='same') * DA / detR0
-        hex3 = signal.fftconvolve(hex2, hex1, mode='same') * DA / detR0
-        hex_kernel = hex3
-    else:
-        raise ValueError('p>3 not implemented')
+        for _ in range(1, p):
+            hex_kernel = signal.fftconvolve(hex_kernel, hex1, mode='same') * DA / detR0
+
+        kernel = signal.fftconvolve(rect_kernel, hex_kernel, mode='same') * DA
+        return TabulatedKernel(ys, xs, kernel)
+
+    return _cached_kernel(('rescaling', p, scale, step), compute)
+
+
+# Convolution, compute kernel
+def rescaling_kernel(p, scale=1):
+    """Rescaling kernel from hexgrid to rectangular grid
+
+    The first coordinate of the spline is y. The splines are
+    cached, the returned object must not be modified.
+    """
+    def compute():
+        table = rescaling_kernel_table(p, scale)
+        return interp.RectBivariateSpline(table.ys, table.xs, table.values)
 
-    kernel = signal.fftconvolve(rect_kernel, hex_kernel, mode='same') * DA
-    rbs = interp.RectBivariateSpline(xs, ys, kernel)
-    return rbs
+    return _cached_kernel(('spline', p, scale), compute)
@@ -15,6 +15,9 @@ import numpy as np
 
 class ModelDescription(metaclass=abc.ABCMeta):
 
+    # Name of the parameter of model_cls that is the center of the profile
+    center_param = None
+
     def __init__(self, name, model_cls, fixed_center=True, params_fit=None, params_save=None, deg_save=None):
         self.model_cls = model_cls
         self.nfib = 1
@@ -70,6 +73,21 @@ class ModelDescription(metaclass=abc.ABCMeta):
 
         return current
 
+    def init_values_from(self, previous: dict, centers: Sequence[float], fibers: Sequence[int]) -> dict:
+        """Initial values of the parameters from a previous fit.
+
+        The parameters of each profile are copied from `previous`,
+        typically the fit of a neighbouring column, with the centers
+        of the profiles moved to `centers`.
+        """
+        current = {}
+        for fibid, center in zip(fibers, centers):
+            cf = dict(previous[fibid])
+            self.set_fiber_center(cf, center)
+            current[fibid] = cf
+
+        return current
+
     @abc.abstractmethod
     def params_fixed(self, values, fibid, col):
         raise NotImplementedError
@@ -81,3 +99,6 @@ class ModelDescription(metaclass=abc.ABCMeta):
     @abc.abstractmethod
     def fiber_center(self, values: dict) -> float:
         raise NotImplementedError
+
+    def set_fiber_center(self, values: dict, center: float) -> None:
+        values[self.center_param] = center
@@ -18,6 +18,8 @@ from .base import ModelDescription
 
 class GaussBoxModelDescription(ModelDescription):
 
+    center_param = 'mean'
+
     def __init__(self, fixed_center=True, init_simple=False, npix=5, sigma=3.0):
         super().__init__("gaussbox", GaussBox, fixed_center=fixed_center,
                          params_fit=['amplitude', 'mean', 'stddev'],
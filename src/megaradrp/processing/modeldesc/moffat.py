@@ -17,6 +17,8 @@ from .base import ModelDescription
 
 class MoffatModelDescription(ModelDescription):
 
+    center_param = 'x_0'
+
     def __init__(self, fixed_center=True):
         super().__init__("moffat", Moffat1D, fixed_center=fixed_center)
 
@@ -11,6 +11,10 @@ import bisect
 import collections
 import logging
 import math
+import os
+import shutil
+import tempfile
+import weakref
 
 from collections.abc import Sequence  # for typing
 
@@ -20,14 +24,25 @@ from numina.util.objimport import import_object
 import numpy
 
 from .modeldesc.base import ModelDescription
+from megaradrp.core.opcache import ArrayCache, cache_key
 from megaradrp.processing.modeldesc import config
 
 
+_logger = logging.getLogger(__name__)
+
+
 def calc1d_model(model_desc: ModelDescription, column: numpy.ndarray,
                  centers: Sequence[float],
                  valid: Sequence[int], col: int,
-                 lateral=2, reject=3, nloop=1) -> dict:
-    """Fit a sum of profiles along a 1D column vector"""
+                 lateral=2, reject=3, nloop=1,
+                 current: dict = None, tol: float = None) -> dict:
+    """Fit a sum of profiles along a 1D column vector
+
+    If `current` is given, it is used as the initial values
+    of the parameters of each fiber. If `tol` is given, the loops
+    stop when the parameters change less than `tol` (relative)
+    from one loop to the next.
+    """
 
     nfib = len(centers)
     if nfib != len(valid):
@@ -47,13 +62,18 @@ def calc1d_model(model_desc: ModelDescription, column: numpy.ndarray,
     # 'current' contains the values of the parameters
     # for each fiber
     # it is initially filled with initial values
-    current = model_desc.init_values_per_profile(column, centers, valid)
+    if current is None:
+        current = model_desc.init_values_per_profile(column, centers, valid)
+    else:
+        current = {fibid: dict(current[fibid]) for fibid in valid}
 
     # total fits is 2 * lateral + 1
     total = reject + lateral
     npix = 6
     for il in range(nloop):
         # print('loop', il, datetime.datetime.now())
+        if tol is not None:
+            start = {fibid: dict(current[fibid]) for fibid in valid}
         # permutation of the valid fibers
         permutated_fibers = numpy.random.permutation(valid)
         for fib_id_reorder in permutated_fibers:
@@ -132,56 +152,158 @@ def calc1d_model(model_desc: ModelDescription, column: numpy.ndarray,
                 for name in model_cls.param_names:
                     current[fibid][name] = fvalue[name]
 
-    return current
-
-
-def calc_matrix(wshape, model, params, valid, clip=1.0e-6, extra=10):
-    from scipy.sparse import lil_matrix
-
-    # calc w
-    # this is valid for 1 column (there are more broadcasts for N)
-    g_mean = params['mean']
+        if tol is not None:
+            change = max(
+                abs(current[fibid][name] - start[fibid][name]) /
+                max(abs(start[fibid][name]), tol)
+                for fibid in valid for name in model_cls.param_names
+            )
+            if change < tol:
+                _logger.debug('column %d converged after %d loops', col, il + 1)
+                break
 
-    begpix = numpy.ceil(g_mean - 0.5).astype('int')
+    return current
 
-    steps = numpy.arange(-extra, extra)
-    # ref is a bidimensional matrix +-10 pixels around the trace
-    ref = begpix + steps[:, numpy.newaxis]
 
+def _model_params(model, params):
+    """Complete params with the default values of the model"""
+    mpar = {}
     for key in model.param_names:
-        if key not in params:
+        if key in params:
+            mpar[key] = params[key]
+        else:
             model_param = getattr(model, key)
-            params[key] = model_param.value
-
-    rr = model.evaluate(ref, **params)
-    rrb = begpix - extra
+            mpar[key] = model_param.value
+    return mpar
+
+
+def calc_matrix_block(wshape, model, params, valid, clip=1.0e-6, extra=10,
+                      block_diag=False):
+    """Weight matrices of a block of contiguous columns.
+
+    The profiles of all the fibers in all the columns of the block
+    are sampled at once in an array of shape (2 * extra, nfibers, ncols),
+    and the index arrays of the sparse matrices are built from it.
+
+    Parameters
+    ----------
+    wshape : tuple
+        Shape of the matrix of one column, (nrows, nfibers)
+    model : type
+        Model class of the profile
+    params : dict
+        Parameters of the model, each one of shape (nfibers, ncols)
+    valid : Sequence[int]
+        Fiber ids (starting in 1) of the valid fibers
+    clip : float
+        Weights under clip are removed
+    extra : int
+        Half size of the region sampled around each fiber
+    block_diag : bool
+        If True, return a single block-diagonal operator of shape
+        (nrows * ncols, nfibers * ncols), that maps the RSS flattened
+        in column order (rss.T.ravel()) into the image flattened
+        in column order (img.T.ravel())
+
+    Returns
+    -------
+    list of scipy.sparse.csr_matrix or scipy.sparse.csr_matrix
+    """
+    from scipy.sparse import csc_matrix, csr_matrix
+
+    nrow, nfib = wshape
+    mpar = _model_params(model, params)
+    g_mean = numpy.asarray(mpar['mean'])
+    if g_mean.ndim == 1:
+        g_mean = g_mean[:, numpy.newaxis]
+    ncol = g_mean.shape[1]
+
+    # negative indices wrap, as in numpy indexing
+    idx = numpy.unique((numpy.asarray(valid, dtype='int') - 1) % nfib)
+    vpar = {}
+    for key, value in mpar.items():
+        value = numpy.asarray(value)
+        if value.ndim == 0:
+            vpar[key] = value
+        else:
+            vpar[key] = value.reshape(nfib, -1)[idx]
+
+    begpix = numpy.ceil(vpar['mean'] - 0.5).astype('int')
+    steps = numpy.arange(-extra, extra)
+    # ref is a 3D array +-extra pixels around the trace
+    # with axes (step, fiber, column)
+    ref = begpix + steps[:, numpy.newaxis, numpy.newaxis]
+    rr = model.evaluate(ref, **vpar)
+    rr = numpy.broadcast_to(rr, ref.shape)
+
+    # Order the samples by (column, fiber, row), the natural
+    # order of a block-diagonal matrix in CSC format
+    rr = rr.transpose(2, 1, 0)
+    ref = ref.transpose(2, 1, 0)
+    gcols = numpy.arange(ncol)[:, numpy.newaxis] * nfib + idx
+    grows = ref + (numpy.arange(ncol) * nrow)[:, numpy.newaxis, numpy.newaxis]
 
     # This was sending warnings. Is there a NaN somewhere?
     with numpy.errstate(invalid='ignore'):
-        rr[rr < clip] = 0.0
-
-    # Calc Ws matrix
-    block, valid_nfib = rr.shape
+        keep = ~(rr < clip) & (ref >= 0) & (ref < nrow)
+
+    indptr = numpy.zeros(nfib * ncol + 1, dtype='int')
+    counts = numpy.zeros(nfib * ncol, dtype='int')
+    counts[gcols.ravel()] = keep.sum(axis=2).ravel()
+    numpy.cumsum(counts, out=indptr[1:])
+    wblock = csc_matrix((rr[keep], grows[keep], indptr),
+                        shape=(nrow * ncol, nfib * ncol)).tocsr()
+
+    if block_diag:
+        return wblock
+
+    wcols = []
+    for col in range(ncol):
+        p1 = wblock.indptr[col * nrow]
+        p2 = wblock.indptr[(col + 1) * nrow]
+        indptr = wblock.indptr[col * nrow:(col + 1) * nrow + 1] - p1
+        indices = wblock.indices[p1:p2] - col * nfib
+        wcols.append(csr_matrix((wblock.data[p1:p2], indices, indptr), shape=wshape))
+    return wcols
 
-    w_init = lil_matrix(wshape)
-    for fibid in valid:
-        idx = fibid - 1
-        w_init[rrb[idx]:rrb[idx] + block, idx] = rr[:, idx, numpy.newaxis]
 
-    wcol = w_init.tocsr()
-    return wcol
+def calc_matrix(wshape, model, params, valid, clip=1.0e-6, extra=10):
+    """Weight matrix of one column"""
+    wcols = calc_matrix_block(wshape, model, params, valid,
+                              clip=clip, extra=extra)
+    return wcols[0]
 
 
-def calc_matrix_adapt(wshape, col, model, params, valid, clip=1.0e-6, extra=10):
-    """Adapted function to return the column number"""
+def calc_matrix_adapt(wshape, cols, model, params, valid, clip=1.0e-6, extra=10):
+    """Adapted function to return the column numbers"""
 
     # For parallel processing
-    wcol = calc_matrix(wshape, model, params, valid, clip=clip, extra=extra)
+    wcols = calc_matrix_block(wshape, model, params, valid, clip=clip, extra=extra)
+
+    return cols, wcols
+
 
-    return col, wcol
+def calc_matrix_cols(model_map, datashape, processes=0, block=64, block_diag=False):
+    """Weight matrices of every column of the image.
 
+    Parameters
+    ----------
+    model_map : ModelMap
+    datashape : tuple
+        Shape of the image
+    processes : int
+        Number of processes used to build the matrices
+    block : int
+        Number of columns computed together
+    block_diag : bool
+        If True, return a single block-diagonal operator for
+        the whole image, see calc_matrix_block
 
-def calc_matrix_cols(model_map, datashape, processes=0):
+    Returns
+    -------
+    dict or scipy.sparse.csr_matrix
+        Weight matrix of each column or block-diagonal operator
+    """
 
     dnrow, dncol = datashape
     nfibs = model_map.total_fibers
@@ -220,52 +342,401 @@ def calc_matrix_cols(model_map, datashape, processes=0):
     params_reorder_c[mask, :] = params_reorder_c[mask, :] + \
         offset[:, numpy.newaxis]
 
-    wcols = {}
     valid = [f.fibid for f in model_map.contents if f.valid]
 
-    # parameters per colum
-    params_col = {}
-    for col in xcol:
-        mpar = {}
-        for key in model.param_names:
-            if key not in params_reorder:
-                model_param = getattr(model, key)
-                mpar[key] = model_param.value
-            else:
-                mpar[key] = params_reorder[key][:, col]
-        params_col[col] = mpar
+    # parameters per block of columns
+    params_block = []
+    for col0 in range(0, dncol, block):
+        cols = xcol[col0:col0 + block]
+        mpar = {key: params_reorder[key][:, cols] for key in model.param_names
+                if key in params_reorder}
+        params_block.append((cols, mpar))
+
+    if block_diag:
+        from scipy.sparse import block_diag as sparse_block_diag
 
+        # the blocks of the operator are the columns of the image
+        blocks = [calc_matrix_block(wshape, model, mpar, valid, clip=1e-6,
+                                    extra=10, block_diag=True)
+                  for _, mpar in params_block]
+        return sparse_block_diag(blocks, format='csr')
+
+    wcols = {}
     if processes < 2:
-        for col in xcol:
-            result = calc_matrix(wshape, model, params_col[col], valid, clip=1e-6,
-                                 extra=10)
-            wcols[col] = result
+        for cols, mpar in params_block:
+            result = calc_matrix_block(wshape, model, mpar, valid, clip=1e-6,
+                                       extra=10)
+            wcols.update(zip(cols, result))
     else:
         import multiprocessing as mp
-        pool = mp.Pool(processes=processes)
+        with mp.Pool(processes=processes) as pool:
+            results = [pool.apply_async(
+                calc_matrix_adapt,
+                args=(wshape, cols, model, mpar, valid),
+                kwds={'clip': 1e-6, 'extra': 10}
+            ) for cols, mpar in params_block]
 
-        results = [pool.apply_async(
-            calc_matrix_adapt,
-            args=(wshape, col, model, params_col[col], valid),
-            kwds={'clip': 1e-6, 'extra': 10}
-        ) for col in xcol]
-
-        for p in results:
-            col, wcol = p.get()
-            wcols[col] = wcol
+            for p in results:
+                cols, result = p.get()
+                wcols.update(zip(cols, result))
 
     return wcols
 
 
-def aper_extract(model_map, wcols, img):
-    from scipy.sparse.linalg import lsqr
+def normal_banded(wcol):
+    """Normal matrix of a column weight matrix in upper banded form.
+
+    The profile of each fiber only overlaps with its neighbours,
+    so W^T W is a narrow banded matrix. Fibers without weights
+    in this column get a unit diagonal, so that their flux is 0.
+
+    Parameters
+    ----------
+    wcol : scipy.sparse.csr_matrix
+        Weight matrix of the column, of shape (nrows, nfibers)
+
+    Returns
+    -------
+    numpy.ndarray
+        Normal matrix in the upper form used by scipy.linalg.solveh_banded
+    """
+    norm = (wcol.T @ wcol).tocoo()
+    upper = norm.col >= norm.row
+    rows = norm.row[upper]
+    cols = norm.col[upper]
+    if len(rows) > 0:
+        u = int((cols - rows).max())
+    else:
+        u = 0
+    ab = numpy.zeros((u + 1, norm.shape[0]))
+    ab[u + rows - cols, cols] = norm.data[upper]
+    diag = ab[u]
+    diag[diag <= 0] = 1.0
+    return ab
+
+
+def calc_factor_cols(wcols):
+    """Banded Cholesky factors of the normal matrices of each column.
+
+    Columns where the factorization fails are stored as None,
+    they are extracted with the iterative solver.
+    """
+    from scipy.linalg import cholesky_banded
+
+    factors = {}
+    for col, wcol in wcols.items():
+        try:
+            factors[col] = cholesky_banded(normal_banded(wcol))
+        except numpy.linalg.LinAlgError:
+            _logger.debug('normal matrix of column %d is not positive definite', col)
+            factors[col] = None
+    return factors
+
+
+def pack_matrix_cols(wcols, factors=None):
+    """Pack the matrices of each column in a few flat arrays.
+
+    The matrices are stored concatenated, with the row pointers
+    of each column relative to the column, so that they can be
+    rebuilt from memory maps without copies.
+
+    Parameters
+    ----------
+    wcols : dict
+        Weight matrix of each column
+    factors : dict, optional
+        Banded Cholesky factors of each column
+
+    Returns
+    -------
+    dict
+        Arrays, see unpack_matrix_cols
+    """
+    cols = numpy.array(sorted(wcols), dtype='int')
+    wlist = [wcols[col] for col in cols]
+    colptr = numpy.zeros(len(cols) + 1, dtype='int64')
+    numpy.cumsum([wcol.nnz for wcol in wlist], out=colptr[1:])
+    arrays = {
+        'cols': cols,
+        'shape': numpy.array(wlist[0].shape, dtype='int'),
+        'colptr': colptr,
+        'data': numpy.concatenate([wcol.data for wcol in wlist]),
+        'indices': numpy.concatenate([wcol.indices for wcol in wlist]).astype('int32'),
+        'indptr': numpy.stack([wcol.indptr for wcol in wlist]).astype('int32'),
+    }
+    if factors is not None:
+        flist = [factors.get(col) for col in cols]
+        nband = max((cb.shape[0] for cb in flist if cb is not None), default=1)
+        nfib = arrays['shape'][1]
+        # extra superdiagonals filled with zeros
+        packed = numpy.zeros((len(cols), nband, nfib))
+        factor_valid = numpy.zeros(len(cols), dtype='bool')
+        for idx, cb in enumerate(flist):
+            if cb is not None:
+                packed[idx, nband - cb.shape[0]:] = cb
+                factor_valid[idx] = True
+        arrays['factors'] = packed
+        arrays['factor_valid'] = factor_valid
+    return arrays
+
+
+def unpack_matrix_cols(arrays, start=0, stop=None):
+    """Rebuild the matrices of each column from pack_matrix_cols arrays.
+
+    Parameters
+    ----------
+    arrays : dict
+        Arrays created by pack_matrix_cols
+    start, stop : int, optional
+        Range of the stored columns that are rebuilt
+
+    Returns
+    -------
+    tuple
+        Weight matrix of each column and Cholesky factors
+        of each column (None if not stored)
+    """
+    from scipy.sparse import csr_matrix
+
+    shape = tuple(int(v) for v in arrays['shape'])
+    colptr = arrays['colptr']
+    data = arrays['data']
+    indices = arrays['indices']
+    indptr = arrays['indptr']
+    if stop is None:
+        stop = len(arrays['cols'])
+    wcols = {}
+    for idx in range(start, stop):
+        col = arrays['cols'][idx]
+        sl = slice(colptr[idx], colptr[idx + 1])
+        wcols[int(col)] = csr_matrix((data[sl], indices[sl], indptr[idx]), shape=shape)
+
+    factors = None
+    if 'factors' in arrays:
+        factors = {}
+        for idx in range(start, stop):
+            col = arrays['cols'][idx]
+            if arrays['factor_valid'][idx]:
+                factors[int(col)] = arrays['factors'][idx]
+            else:
+                factors[int(col)] = None
+    return wcols, factors
+
+
+def load_matrix_cols(model_map, datashape, processes=0, cache=None):
+    """Weight matrices and Cholesky factors of each column.
+
+    The matrices depend on the model map, its global offset
+    and the shape of the image. They are loaded from the on-disk
+    cache if possible, or computed and stored in the cache.
+
+    Parameters
+    ----------
+    model_map : ModelMap
+    datashape : tuple
+        Shape of the image
+    processes : int
+        Number of processes used to build the matrices
+    cache : megaradrp.core.opcache.ArrayCache, optional
+        On-disk cache, by default the one in MEGARADRP_CACHE_DIR
+
+    Returns
+    -------
+    tuple
+        Weight matrix of each column and Cholesky factors of each column
+    """
+    if cache is None:
+        cache = ArrayCache.from_environ()
+
+    if cache is not None:
+        key = cache_key('modelmap', model_map.uuid,
+                        model_map.global_offset.coef, list(datashape))
+        arrays = cache.load('modelmap', key)
+        if arrays is not None:
+            _logger.debug('extraction matrices of %s loaded from cache', model_map.uuid)
+            return unpack_matrix_cols(arrays)
+
+    wcols = calc_matrix_cols(model_map, datashape, processes)
+    factors = calc_factor_cols(wcols)
+    if cache is not None:
+        cache.save('modelmap', key, pack_matrix_cols(wcols, factors))
+    return wcols, factors
+
+
+def aper_extract(model_map, wcols, img, factors=None, method='banded'):
+    """Extract the fibers of an image, column by column.
+
+    Parameters
+    ----------
+    model_map : ModelMap
+    wcols : dict
+        Weight matrix of each column
+    img : numpy.ndarray
+        2D image, or 3D stack of images of shape (nframes, nrow, ncol)
+    factors : dict, optional
+        Banded Cholesky factors of each column, computed if not given
+    method : {'banded', 'lsqr'}
+        'banded' solves the normal equations of each column with
+        a banded Cholesky factorization, 'lsqr' uses the iterative
+        least squares solver. Columns where the factorization
+        fails are solved with 'lsqr'.
+
+    Returns
+    -------
+    numpy.ndarray
+        RSS of shape (total_fibers, ncol), or (nframes, total_fibers, ncol)
+    """
+    if method not in ('banded', 'lsqr'):
+        raise ValueError(f"method {method} is not defined")
+
+    if method == 'banded' and factors is None:
+        factors = calc_factor_cols(wcols)
 
     n0 = model_map.total_fibers
-    n1 = img.shape[1]
-    rss = numpy.zeros((n0, n1))
+    n1 = img.shape[-1]
+    rss = numpy.zeros(img.shape[:-2] + (n0, n1))
+    _aper_extract_cols(wcols, factors, img, rss, method)
+    return rss
+
+
+def _aper_extract_cols(wcols, factors, img, rss, method):
+    """Extract the columns in wcols from img, in place in rss"""
+    from scipy.linalg import cho_solve_banded
+    from scipy.sparse.linalg import lsqr
+
     for key, val in wcols.items():
-        yl = img[:, key]
-        res = lsqr(val, yl)
-        rss[:, key] = res[0]
+        # shape (nrow,) or (nrow, nframes)
+        yl = img[..., key].T
+        cb = factors.get(key) if method == 'banded' else None
+        if cb is None:
+            if yl.ndim == 1:
+                res = lsqr(val, yl)
+                rss[:, key] = res[0]
+            else:
+                for idx in range(yl.shape[1]):
+                    res = lsqr(val, yl[:, idx])
+                    rss[idx, :, key] = res[0]
+        else:
+            # all the frames are solved together
+            rss[..., key] = cho_solve_banded((cb, False), val.T @ yl).T
+
+
+# Operators of each work directory, loaded by the worker processes
+_worker_operators = {}
+
+
+def _aper_extract_range(workdir, start, stop, method):
+    """Extract a range of columns in a worker process"""
+    from numpy.lib.format import open_memmap
+
+    if workdir not in _worker_operators:
+        names = ['cols', 'shape', 'colptr', 'data', 'indices', 'indptr',
+                 'factors', 'factor_valid']
+        _worker_operators.clear()
+        _worker_operators[workdir] = {
+            name: numpy.load(os.path.join(workdir, f'{name}.npy'), mmap_mode='r')
+            for name in names
+        }
+    arrays = _worker_operators[workdir]
+    wcols, factors = unpack_matrix_cols(arrays, start, stop)
+    img = numpy.load(os.path.join(workdir, 'img.npy'), mmap_mode='r')
+    rss = open_memmap(os.path.join(workdir, 'rss.npy'), mode='r+')
+    _aper_extract_cols(wcols, factors, img, rss, method)
+    rss.flush()
+    return start, stop
+
+
+def _shutdown_extractor(pool, workdir):
+    if pool is not None:
+        pool.close()
+        pool.join()
+    shutil.rmtree(workdir, ignore_errors=True)
+
+
+class ParallelColumnExtractor:
+    """Extract the columns of images with a pool of processes.
+
+    The operators, the image and the output RSS are memory-mapped
+    files in a work directory (in /dev/shm, if available). Each
+    worker solves a range of columns, writing in place in the RSS.
+    The pool is reused by every call to extract, until close.
+
+    Parameters
+    ----------
+    wcols : dict
+        Weight matrix of each column
+    factors : dict
+        Banded Cholesky factors of each column
+    nfibers : int
+        Number of fibers of the RSS
+    processes : int
+        Number of worker processes
+    chunks : int
+        Number of column ranges per process
+    tmpdir : str, optional
+        Directory where the work directory is created
+    """
+
+    def __init__(self, wcols, factors, nfibers, processes, chunks=4, tmpdir=None):
+        if tmpdir is None and os.path.isdir('/dev/shm'):
+            tmpdir = '/dev/shm'
+        self.workdir = tempfile.mkdtemp(prefix='megaradrp-', dir=tmpdir)
+        self.nfibers = nfibers
+        self.processes = processes
+        self.chunks = chunks
+        self.pool = None
+
+        if factors is None:
+            factors = calc_factor_cols(wcols)
+        arrays = pack_matrix_cols(wcols, factors)
+        for name, arr in arrays.items():
+            numpy.save(os.path.join(self.workdir, f'{name}.npy'), arr)
+        self.ncols = len(arrays['cols'])
+        self._finalizer = weakref.finalize(self, _shutdown_extractor, None, self.workdir)
+
+    def _start_pool(self):
+        import multiprocessing as mp
 
-    return rss
+        self.pool = mp.Pool(processes=self.processes)
+        self._finalizer.detach()
+        self._finalizer = weakref.finalize(self, _shutdown_extractor, self.pool, self.workdir)
+
+    def extract(self, img, method='banded'):
+        """Extract the fibers of img, see aper_extract"""
+        from numpy.lib.format import open_memmap
+
+        if method not in ('banded', 'lsqr'):
+            raise ValueError(f"method {method} is not defined")
+
+        if self.pool is None:
+            self._start_pool()
+
+        img_map = open_memmap(os.path.join(self.workdir, 'img.npy'), mode='w+',
+                              dtype=img.dtype, shape=img.shape)
+        img_map[:] = img
+        img_map.flush()
+        del img_map
+        rss_shape = img.shape[:-2] + (self.nfibers, img.shape[-1])
+        rss_map = open_memmap(os.path.join(self.workdir, 'rss.npy'), mode='w+',
+                              dtype='float64', shape=rss_shape)
+        del rss_map
+
+        bounds = numpy.linspace(0, self.ncols, self.processes * self.chunks + 1)
+        bounds = numpy.unique(bounds.astype('int'))
+        tasks = [(self.workdir, int(start), int(stop), method)
+                 for start, stop in zip(bounds[:-1], bounds[1:])]
+        self.pool.starmap(_aper_extract_range, tasks)
+
+        rss = numpy.load(os.path.join(self.workdir, 'rss.npy'))
+        return rss
+
+    def close(self):
+        """Shutdown the pool and remove the work directory"""
+        self._finalizer()
+        self.pool = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
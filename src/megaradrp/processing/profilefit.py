@@ -0,0 +1,253 @@
+#
+# Copyright 2025 Universidad Complutense de Madrid
+#
+# This file is part of Megara DRP
+#
+# SPDX-License-Identifier: GPL-3.0-or-later
+# License-Filename: LICENSE.txt
+#
+
+"""Simultaneous fit of the profiles of all the fibers in a column"""
+
+import logging
+from collections.abc import Sequence  # for typing
+
+import numpy
+from scipy.linalg import solveh_banded
+from scipy.sparse import csc_matrix
+
+from .modeldesc.base import ModelDescription
+from .modelmap import normal_banded
+
+
+_logger = logging.getLogger(__name__)
+
+
+def _profile_windows(centers, extra, nrow):
+    """Rows sampled around each fiber, shape (nfibers, 2 * extra)"""
+    begpix = numpy.ceil(centers - 0.5).astype('int')
+    steps = numpy.arange(-extra, extra)
+    ref = begpix[:, numpy.newaxis] + steps
+    inside = (ref >= 0) & (ref < nrow)
+    return numpy.clip(ref, 0, nrow - 1), inside
+
+
+def _profile_model(model_cls, params, ref, inside, nrow):
+    """Sum of the profiles of all the fibers"""
+    vals = model_cls.evaluate(ref, *params[:, :, numpy.newaxis])
+    vals = numpy.where(inside, vals, 0.0)
+    return numpy.bincount(ref.ravel(), weights=vals.ravel(), minlength=nrow)
+
+
+def _profile_jacobian(model_cls, params, free, ref, inside, nrow):
+    """Jacobian of the sum of profiles, with the free parameters as columns"""
+    derivs = model_cls.fit_deriv(ref, *params[:, :, numpy.newaxis])
+    # shape (nfibers, nparams, 2 * extra)
+    derivs = numpy.stack([numpy.broadcast_to(d, ref.shape) for d in derivs], axis=1)
+    derivs = numpy.where(inside[:, numpy.newaxis], derivs, 0.0)
+    rows = numpy.broadcast_to(ref[:, numpy.newaxis], derivs.shape)
+    data = derivs[free]
+    nfree, block = data.shape
+    indptr = numpy.arange(nfree + 1) * block
+    return csc_matrix((data.ravel(), rows[free].ravel(), indptr), shape=(nrow, nfree))
+
+
+def fit_profiles(model_cls, column, params, free, lower, upper, center, extra=10,
+                 maxiter=100, ftol=1e-8, xtol=1e-8):
+    """Fit a sum of profiles to a column, all the fibers at once.
+
+    The fit is performed with Levenberg-Marquardt iterations,
+    using the analytic derivatives of the model. Each profile only
+    overlaps with its neighbours, so the normal equations are banded
+    and solved with a banded Cholesky factorization. Bounds are
+    enforced by projecting each step on the feasible region.
+
+    Parameters
+    ----------
+    model_cls : type
+        Model class of the profile, with evaluate and fit_deriv
+    column : numpy.ndarray
+        Values of the column
+    params : numpy.ndarray
+        Initial values of the parameters, shape (nparams, nfibers),
+        in the order of model_cls.param_names
+    free : numpy.ndarray
+        Boolean mask of the free parameters, shape (nfibers, nparams)
+    lower, upper : numpy.ndarray
+        Bounds of the parameters, shape (nfibers, nparams)
+    center : str
+        Name of the parameter that is the center of the profile
+    extra : int
+        Half size of the region around each fiber
+    maxiter : int
+        Maximum number of iterations
+    ftol : float
+        Tolerance on the relative change of the cost
+    xtol : float
+        Tolerance on the change of the parameters
+
+    Returns
+    -------
+    tuple
+        Fitted parameters, shape (nparams, nfibers), and a dictionary
+        with the number of iterations, the final cost and
+        the convergence status. The fit has not converged if the
+        damping grows without reducing the cost
+    """
+
+    if model_cls.fit_deriv is None:
+        raise ValueError(f"model {model_cls.__name__} has no analytic derivatives")
+    if center not in model_cls.param_names:
+        raise ValueError(f"parameter {center} not in model parameters")
+    icenter = model_cls.param_names.index(center)
+
+    nrow = len(column)
+    current = numpy.array(params, dtype='float')
+    # parameters, with fibers in the first axis
+    p_view = current.T
+    pfree = p_view[free]
+    lfree = lower[free]
+    ufree = upper[free]
+    pfree = numpy.clip(pfree, lfree, ufree)
+    p_view[free] = pfree
+
+    ref, inside = _profile_windows(current[icenter], extra, nrow)
+    residual = column - _profile_model(model_cls, current, ref, inside, nrow)
+    cost = residual @ residual
+    jac = _profile_jacobian(model_cls, current, free, ref, inside, nrow)
+
+    lam = 1e-3
+    converged = False
+    niter = 0
+    for niter in range(1, maxiter + 1):
+        ab = normal_banded(jac)
+        grad = jac.T @ residual
+        damped = ab.copy()
+        damped[-1] *= 1 + lam
+        try:
+            delta = solveh_banded(damped, grad)
+        except numpy.linalg.LinAlgError:
+            lam *= 10
+            continue
+
+        trial = numpy.clip(pfree + delta, lfree, ufree)
+        p_view[free] = trial
+        ref, inside = _profile_windows(current[icenter], extra, nrow)
+        trial_res = column - _profile_model(model_cls, current, ref, inside, nrow)
+        trial_cost = trial_res @ trial_res
+
+        if trial_cost <= cost:
+            step = numpy.abs(trial - pfree).max(initial=0.0)
+            dcost = cost - trial_cost
+            pfree = trial
+            residual = trial_res
+            cost = trial_cost
+            lam = max(lam / 10, 1e-12)
+            if dcost <= ftol * cost or step <= xtol * (numpy.abs(pfree).max(initial=0.0) + xtol):
+                converged = True
+                break
+            jac = _profile_jacobian(model_cls, current, free, ref, inside, nrow)
+        else:
+            p_view[free] = pfree
+            if trial_cost - cost <= ftol * cost:
+                # the step only changes the cost by rounding errors
+                converged = True
+                break
+            lam *= 10
+            if lam > 1e10:
+                # the damping has blown up, no further progress possible
+                break
+
+    p_view[free] = pfree
+    info = {'niter': niter, 'cost': cost, 'converged': converged}
+    return current, info
+
+
+def profile_constraints(model_desc: ModelDescription, current: dict,
+                        valid: Sequence[int], col: int):
+    """Free parameters and bounds of each fiber, from the model description.
+
+    Parameters not in params_fixed or params_bounds take
+    the defaults of the parameters of the model class.
+
+    Returns
+    -------
+    tuple
+        Free mask, lower and upper bounds, each of shape (nfibers, nparams)
+    """
+    model_cls = model_desc.model_cls
+    names = model_cls.param_names
+    nfib = len(valid)
+    free = numpy.empty((nfib, len(names)), dtype='bool')
+    lower = numpy.empty((nfib, len(names)))
+    upper = numpy.empty((nfib, len(names)))
+    for idx, fibid in enumerate(valid):
+        values = current[fibid]
+        p_fixed = model_desc.params_fixed(values, fibid, col)
+        p_bounds = model_desc.params_bounds(values, fibid, col)
+        for pidx, name in enumerate(names):
+            model_param = getattr(model_cls, name)
+            free[idx, pidx] = not p_fixed.get(name, model_param.fixed)
+            lo, hi = p_bounds.get(name, model_param.bounds)
+            lower[idx, pidx] = -numpy.inf if lo is None else lo
+            upper[idx, pidx] = numpy.inf if hi is None else hi
+    return free, lower, upper
+
+
+def calc1d_model_banded(model_desc: ModelDescription, column: numpy.ndarray,
+                        centers: Sequence[float], valid: Sequence[int], col: int,
+                        current: dict = None, extra=10, maxiter=100) -> dict:
+    """Fit a sum of profiles along a 1D column vector.
+
+    Equivalent to calc1d_model, fitting all the fibers
+    at once with fit_profiles.
+
+    Parameters
+    ----------
+    model_desc : ModelDescription
+    column : numpy.ndarray
+    centers : Sequence[float]
+        Center of each valid fiber
+    valid : Sequence[int]
+        Fiber ids of the valid fibers
+    col : int
+        Column of the image
+    current : dict, optional
+        Initial values of the parameters of each fiber, computed
+        with model_desc.init_values_per_profile if not given
+    extra : int
+        Half size of the region around each fiber
+    maxiter : int
+        Maximum number of iterations
+
+    Returns
+    -------
+    dict
+        Values of the parameters of each fiber
+    """
+    nfib = len(centers)
+    if nfib != len(valid):
+        raise ValueError("len(valid) fibers must equal to len(centers)")
+
+    model_cls = model_desc.model_cls
+    names = model_cls.param_names
+
+    if current is None:
+        current = model_desc.init_values_per_profile(column, centers, valid)
+
+    params = numpy.array([[current[fibid][name] for fibid in valid] for name in names],
+                         dtype='float')
+    free, lower, upper = profile_constraints(model_desc, current, valid, col)
+    fitted, info = fit_profiles(model_cls, column, params, free, lower, upper,
+                                model_desc.center_param, extra=extra, maxiter=maxiter)
+    if info['converged']:
+        _logger.debug('column %d fitted in %d iterations, cost %g',
+                      col, info['niter'], info['cost'])
+    else:
+        _logger.warning('fit of column %d has not converged after %d iterations, cost %g',
+                        col, info['niter'], info['cost'])
+
+    result = {}
+    for idx, fibid in enumerate(valid):
+        result[fibid] = {name: fitted[pidx, idx] for pidx, name in enumerate(names)}
+    return result
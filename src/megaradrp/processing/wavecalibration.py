@@ -1,5 +1,5 @@
 #
-# Copyright 2016-2023 Universidad Complutense de Madrid
+# Copyright 2016-2025 Universidad Complutense de Madrid
 #
 # This file is part of Megara DRP
 #
@@ -9,6 +9,7 @@
 
 """Corrector for wavelength calibration"""
 
+import collections
 import datetime
 import logging
 import sys
@@ -19,18 +20,22 @@ if sys.version_info[:2] <= (3, 10):
     datetime.UTC = datetime.timezone.utc
 
 import numpy
-from numpy.polynomial.polynomial import polyval
+from numpy.polynomial.polynomial import polyvander
 import astropy.wcs
 import astropy.io.fits as fits
+from scipy.sparse import csr_matrix
 
 import numina.datamodel as dm
-import numina.array.utils as utils
 from numina.frame.utils import copy_img
 from numina.processing import Corrector
-from numina.array.interpolation import SteffenInterpolator
 
+from megaradrp.core.opcache import ArrayCache, cache_key
 from megaradrp.instrument import WLCALIB_PARAMS
 
+# Maximum number of resampling operators kept in memory
+RESAMPLING_CACHE_SIZE = 4
+_resampling_cache = collections.OrderedDict()
+
 _logger = logging.getLogger(__name__)
 
 
@@ -55,9 +60,17 @@ class SimpleWcs1D:
 
 
 class WavelengthCalibrator(Corrector):
-    """A Node that applies wavelength calibration."""
+    """A Node that applies wavelength calibration.
+
+    With resampling='linear', the resampling of the RSS is a sparse
+    linear operator, computed for the first frame and reused
+    for the following frames calibrated with the same solution.
+    resampling='steffen' gives the interpolation of calibrate_wl_rss.
+    Both conserve the flux of each fiber, they differ in the
+    distribution of the flux between the pixels of unresolved features.
+    """
 
-    def __init__(self, solutionwl, datamodel=None, dtype='float32'):
+    def __init__(self, solutionwl, datamodel=None, dtype='float32', resampling='linear'):
 
         super(WavelengthCalibrator, self).__init__(
             datamodel=datamodel,
@@ -65,17 +78,38 @@ class WavelengthCalibrator(Corrector):
             dtype=dtype)
 
         self.solutionwl = solutionwl
+        self.resampling = resampling
+        self.span = 2
+
+    def resampling_operator(self, hdr, shape):
+        """Sparse operator of the resampling of the RSS, see resampling_operator
+
+        Parameters
+        ----------
+        hdr : astropy.io.fits.Header
+            Header of the RSS, with the instrument mode
+        shape : tuple
+            Shape (nfibers, nsamples) of the RSS, not WL calibrated
+
+        Returns
+        -------
+        ResamplingOperator
+        """
+        targetwcs, npix = target_wcs_megara(hdr)
+        return resampling_operator(self.solutionwl, shape, npix, targetwcs, span=self.span)
 
     def run(self, rss):
 
         newrss = calibrate_wl_rss_megara(
             rss, self.solutionwl,
-            dtype=self.dtype, span=2, inplace=True
+            dtype=self.dtype, span=self.span, inplace=True,
+            resampling=self.resampling
         )
         return newrss
 
 
-def calibrate_wl_rss_megara(rss, solutionwl, dtype='float32', span=0, inplace=False):
+def calibrate_wl_rss_megara(rss, solutionwl, dtype='float32', span=0, inplace=False,
+                            resampling='steffen'):
     """Apply wavelength calibration to a RSS
 
     Parameters
@@ -91,6 +125,8 @@ def calibrate_wl_rss_megara(rss, solutionwl, dtype='float32', span=0, inplace=Fa
         Remove `span` pixels at both sides of the resampled image
     inplace: bool
         The input RSS is modified inplace, if False, a copy is made
+    resampling: {'steffen', 'linear'}
+        Interpolation of the accumulated flux, see calibrate_wl_rss
 
     Returns
     -------
@@ -103,8 +139,27 @@ def calibrate_wl_rss_megara(rss, solutionwl, dtype='float32', span=0, inplace=Fa
     _logger.debug('with wavecalib %s', solutionwl.calibid)
     _logger.debug('offsets are %s', solutionwl.global_offset.coef)
 
-    current_vph = rss[0].header['VPH']
-    current_insmode = rss[0].header['INSMODE']
+    targetwcs, npix = target_wcs_megara(rss[0].header)
+
+    result = calibrate_wl_rss(
+        rss, solutionwl, npix, targetwcs,
+        dtype=dtype,
+        span=span, inplace=inplace,
+        resampling=resampling
+    )
+    return result
+
+
+def target_wcs_megara(hdr):
+    """Common WCS of the calibrated RSS of a MEGARA mode
+
+    Returns
+    -------
+    tuple
+        The WCS, as SimpleWcs1D, and the number of channels
+    """
+    current_vph = hdr['VPH']
+    current_insmode = hdr['INSMODE']
 
     _logger.debug('Current INSMODE is %s, VPH is %s',
                   current_insmode, current_vph)
@@ -120,16 +175,11 @@ def calibrate_wl_rss_megara(rss, solutionwl, dtype='float32', span=0, inplace=Fa
 
     targetwcs = SimpleWcs1D(**wvpar_dict)
     npix = wvpar_dict['npix']
-
-    result = calibrate_wl_rss(
-        rss, solutionwl, npix, targetwcs,
-        dtype=dtype,
-        span=span, inplace=inplace
-    )
-    return result
+    return targetwcs, npix
 
 
-def calibrate_wl_rss(rss, solutionwl, npix, targetwcs, dtype='float32', span=0, inplace=False):
+def calibrate_wl_rss(rss, solutionwl, npix, targetwcs, dtype='float32', span=0, inplace=False,
+                     resampling='steffen'):
     """Apply wavelength calibration to a RSS
 
     Parameters
@@ -149,6 +199,10 @@ def calibrate_wl_rss(rss, solutionwl, npix, targetwcs, dtype='float32', span=0,
         Remove `span` pixels at both sides of the resampled image
     inplace: bool
         The input RSS is modified inplace, if False, a copy is made
+    resampling: {'steffen', 'linear'}
+        Interpolation of the accumulated flux. 'steffen' uses a monotonic
+        cubic interpolator, 'linear' a linear interpolator, applied with
+        a cached sparse operator
 
     Returns
     -------
@@ -156,6 +210,9 @@ def calibrate_wl_rss(rss, solutionwl, npix, targetwcs, dtype='float32', span=0,
         A Row stacked Spectra MEGARA image, WL calibrated
     """
 
+    if resampling not in ('steffen', 'linear'):
+        raise ValueError(f"resampling {resampling} is not defined")
+
     if not inplace:
         # This is a new HDUList
         rss = copy_img(rss)
@@ -169,13 +226,40 @@ def calibrate_wl_rss(rss, solutionwl, npix, targetwcs, dtype='float32', span=0,
     re_wcs = targetwcs.create_internal_wcs_()
 
     _logger.debug('Resample RSS')
-    final, limits = resample_rss_flux(
-        rss[0].data, solutionwl, npix, re_wcs,
-        span=span, fill=0
-    )
+    if resampling == 'linear':
+        operator = resampling_operator(solutionwl, rss[0].data.shape, npix, targetwcs, span=span)
+        final = operator(rss[0].data)
+        limits = operator.limits
+    else:
+        final, limits = resample_rss_flux(
+            rss[0].data, solutionwl, npix, re_wcs,
+            span=span, fill=0
+        )
 
     rss[0].data = final.astype(dtype)
+    update_wl_headers(rss, solutionwl, targetwcs, limits, span=span, resampling=resampling)
+    return rss
+
 
+def update_wl_headers(rss, solutionwl, targetwcs, limits, span=0, resampling='steffen'):
+    """Add the headers and the WLMAP extension of a WL calibrated RSS
+
+    Parameters
+    ----------
+
+    rss: astropy.io.fits.HDUList
+        A Row stacked Spectra MEGARA image, with WL calibrated data
+    solutionwl: megaradrp.products.wavecalibration.WavelengthCalibration
+        A wavelength calibration solution
+    targetwcs: SimpleWcs1D
+        Common WCS solution
+    limits: a list of tuples
+        Contains the fiberid and a pair with the first and last valid pixel (0-based)
+    span: int
+        Pixels removed at both sides of the resampled image
+    resampling: {'steffen', 'linear'}
+        Interpolation of the accumulated flux
+    """
     hdr = rss[0].header
     _logger.debug('Add WCS headers')
     rss_add_wcs(hdr, targetwcs.crval, targetwcs.cdelt, targetwcs.crpix)
@@ -190,13 +274,13 @@ def calibrate_wl_rss(rss, solutionwl, npix, targetwcs, dtype='float32', span=0,
     hdr['history'] = 'Aperture extraction offsets are {}'.format(
         solutionwl.global_offset.coef.tolist())
     hdr['history'] = f'Wavelength calibration time {datetime.datetime.now(datetime.UTC).isoformat()}'
-    hdr['history'] = f'Resample span={span}'
+    hdr['history'] = f'Resample span={span}, {resampling} interpolation'
     # Update UUID
     hdr['UUID'] = str(uuid.uuid1())
 
     # Update other HDUs if needed
     # dtype here can be int16 or uint8
-    map_data = numpy.zeros_like(final, dtype='int16')
+    map_data = numpy.zeros(rss[0].data.shape, dtype='int16')
 
     fibers_ext = rss['FIBERS']
     fibers_ext_headers = fibers_ext.header
@@ -226,7 +310,6 @@ def calibrate_wl_rss(rss, solutionwl, npix, targetwcs, dtype='float32', span=0,
     rss_map = fits.ImageHDU(data=map_data, name='WLMAP')
 
     rss.append(rss_map)
-    return rss
 
 
 def rss_add_wcs(hdr, crval, cdelt, crpix):
@@ -358,6 +441,225 @@ def resample_rss_flux(arr, solutionwl, npix, finalwcs, span=0, fill=0):
     nfibers = arr.shape[0]
     nsamples = arr.shape[1]
 
+    rss_resampled = numpy.zeros((nfibers, npix))
+    if not solutionwl.contents:
+        return rss_resampled, []
+
+    fibids, old_wl_borders, new_wl_borders, lower, upper = _resampling_geometry(
+        solutionwl, nsamples, npix, finalwcs, span
+    )
+    rows = fibids - 1
+
+    accum_flux = numpy.empty((len(rows), nsamples + 1))
+    accum_flux[:, 1:] = numpy.cumsum(arr[rows], axis=1)
+    accum_flux[:, 0] = 0.0
+
+    # We need a monotonic interpolator
+    # linear would work, we use a cubic interpolator
+    fl_borders = steffen_interpolate_rows(old_wl_borders, accum_flux, new_wl_borders)
+    rss_resampled[rows] = numpy.diff(fl_borders, axis=1)
+
+    # Expand the border to remove `span` pixels
+    # in both sides, to avoid high variance
+    steps = numpy.arange(span)
+    for cols in [lower[:, None] + steps, upper[:, None] + 1 - span + steps]:
+        valid = (cols >= 0) & (cols < npix)
+        frows = numpy.broadcast_to(rows[:, None], cols.shape)
+        rss_resampled[frows[valid], cols[valid]] = fill
+
+    limits = [(fibid, (lo + span, up - span))
+              for fibid, lo, up in zip(fibids.tolist(), lower.tolist(), upper.tolist())]
+    return rss_resampled, limits
+
+
+class ResamplingOperator:
+    """Linear resampling of the fibers of a RSS
+
+    The resampling is a sparse matrix, block diagonal,
+    with a block for each fiber.
+
+    Parameters
+    ----------
+    matrix : scipy.sparse.csr_matrix
+        Matrix of shape (nfibers * npix, nfibers * nsamples)
+    shape : tuple
+        Shape (nfibers, npix) of the resampled RSS
+    limits : list of tuples
+        Contains the fiberid and a pair with the first
+        and last valid pixel (0-based)
+    """
+
+    def __init__(self, matrix, shape, limits):
+        self.matrix = matrix
+        self.shape = shape
+        self.limits = limits
+
+    def __call__(self, arr):
+        """Resample a RSS, of shape (nfibers, nsamples)"""
+        nfibers = self.shape[0]
+        nsamples = self.matrix.shape[1] // nfibers
+        if arr.shape != (nfibers, nsamples):
+            raise ValueError(f"shape of RSS {arr.shape} is not {(nfibers, nsamples)}")
+        flat = numpy.asarray(arr, dtype='float').reshape(-1)
+        return (self.matrix @ flat).reshape(self.shape)
+
+    def pack(self):
+        """Arrays to store the operator in an ArrayCache"""
+        fibids = [fibid for fibid, _ in self.limits]
+        bounds = [bound for _, bound in self.limits]
+        return {
+            'shape': numpy.array(self.shape + self.matrix.shape),
+            'data': self.matrix.data,
+            'indices': self.matrix.indices,
+            'indptr': self.matrix.indptr,
+            'limits': numpy.column_stack([fibids, numpy.reshape(bounds, (-1, 2))]).astype('int'),
+        }
+
+    @classmethod
+    def unpack(cls, arrays):
+        """Operator from the arrays of an ArrayCache"""
+        nfibers, npix, nrows, ncols = (int(val) for val in arrays['shape'])
+        matrix = csr_matrix(
+            (arrays['data'], arrays['indices'], arrays['indptr']),
+            shape=(nrows, ncols)
+        )
+        limits = [(int(fibid), (int(lower), int(upper)))
+                  for fibid, lower, upper in arrays['limits']]
+        return cls(matrix, (nfibers, npix), limits)
+
+
+def calc_resampling_operator(solutionwl, shape, npix, finalwcs, span=0):
+    """Sparse operator of the resampling of a RSS
+
+    The accumulated flux of each fiber is interpolated linearly,
+    so the flux of each final pixel is the sum of the input
+    pixels weighted by the fraction of each pixel
+    that falls inside the final pixel.
+
+    Parameters
+    ----------
+    solutionwl: megaradrp.products.wavecalibration.WavelengthCalibration
+        A wavelength calibration solution
+    shape: tuple
+        Shape (nfibers, nsamples) of the RSS, not WL calibrated
+    npix: int
+        Number of channels of the calibrated RSS
+    finalwcs: astropy.wcs.WCS
+        WCS solution of the final array
+    span: int
+        Remove `span` pixels at both sides of the resampled image
+
+    Returns
+    -------
+    ResamplingOperator
+    """
+    nfibers, nsamples = shape
+    matrix = csr_matrix((nfibers * npix, nfibers * nsamples))
+    if not solutionwl.contents:
+        return ResamplingOperator(matrix, (nfibers, npix), [])
+
+    fibids, old_wl_borders, new_wl_borders, lower, upper = _resampling_geometry(
+        solutionwl, nsamples, npix, finalwcs, span
+    )
+
+    samples = numpy.arange(nsamples + 1)
+    new_x = numpy.arange(npix)
+    all_rows, all_cols, all_weights = [], [], []
+    for idx, fibid in enumerate(fibids):
+        # borders of the final pixels, in input pixels
+        qq = numpy.interp(new_wl_borders, old_wl_borders[idx], samples)
+        q0 = qq[:-1, numpy.newaxis]
+        q1 = qq[1:, numpy.newaxis]
+        first = numpy.minimum(numpy.floor(q0).astype('int'), nsamples - 1)
+        ncand = int((numpy.ceil(q1) - first).max()) + 1
+        cols = first + numpy.arange(ncand)
+        weights = numpy.minimum(q1, cols + 1) - numpy.maximum(q0, cols)
+        # remove `span` pixels in both sides, to avoid high variance
+        spanned = ((new_x >= lower[idx]) & (new_x < lower[idx] + span)) | \
+            ((new_x > upper[idx] - span) & (new_x <= upper[idx]))
+        valid = (weights > 0) & (cols < nsamples) & ~spanned[:, numpy.newaxis]
+        rows = numpy.broadcast_to(new_x[:, numpy.newaxis], cols.shape)
+        row0 = (fibid - 1) * npix
+        col0 = (fibid - 1) * nsamples
+        all_rows.append(rows[valid] + row0)
+        all_cols.append(cols[valid] + col0)
+        all_weights.append(weights[valid])
+
+    matrix = csr_matrix(
+        (numpy.concatenate(all_weights), (numpy.concatenate(all_rows), numpy.concatenate(all_cols))),
+        shape=(nfibers * npix, nfibers * nsamples)
+    )
+    limits = [(fibid, (lo + span, up - span))
+              for fibid, lo, up in zip(fibids.tolist(), lower.tolist(), upper.tolist())]
+    return ResamplingOperator(matrix, (nfibers, npix), limits)
+
+
+def resampling_operator(solutionwl, shape, npix, targetwcs, span=0, cache=None):
+    """Sparse operator of the resampling of a RSS, cached
+
+    The operators are kept in memory, and in the on-disk cache
+    if it is enabled. They depend on the calibration solution, its
+    global offset, the shape of the RSS and the target WCS.
+
+    Parameters
+    ----------
+    solutionwl: megaradrp.products.wavecalibration.WavelengthCalibration
+        A wavelength calibration solution
+    shape: tuple
+        Shape (nfibers, nsamples) of the RSS, not WL calibrated
+    npix: int
+        Number of channels of the calibrated RSS
+    targetwcs: SimpleWcs1D
+        Common WCS solution
+    span: int
+        Remove `span` pixels at both sides of the resampled image
+    cache : megaradrp.core.opcache.ArrayCache, optional
+        On-disk cache, by default the one in MEGARADRP_CACHE_DIR
+
+    Returns
+    -------
+    ResamplingOperator
+    """
+    key = cache_key('wlresample', solutionwl.uuid, solutionwl.global_offset.coef,
+                    list(shape), npix, targetwcs.crval, targetwcs.crpix, targetwcs.cdelt, span)
+    if key in _resampling_cache:
+        _resampling_cache.move_to_end(key)
+        return _resampling_cache[key]
+
+    if cache is None:
+        cache = ArrayCache.from_environ()
+
+    operator = None
+    if cache is not None:
+        arrays = cache.load('wlresample', key)
+        if arrays is not None:
+            _logger.debug('resampling operator of %s loaded from cache', solutionwl.uuid)
+            operator = ResamplingOperator.unpack(arrays)
+
+    if operator is None:
+        _logger.debug('computing resampling operator of %s', solutionwl.uuid)
+        operator = calc_resampling_operator(
+            solutionwl, shape, npix, targetwcs.create_internal_wcs_(), span=span
+        )
+        if cache is not None:
+            cache.save('wlresample', key, operator.pack())
+
+    _resampling_cache[key] = operator
+    while len(_resampling_cache) > RESAMPLING_CACHE_SIZE:
+        _resampling_cache.popitem(last=False)
+    return operator
+
+
+def _resampling_geometry(solutionwl, nsamples, npix, finalwcs, span):
+    """Borders of the pixels of each fiber before and after resampling
+
+    Returns
+    -------
+    tuple
+        Fiber ids, borders of the pixels of each fiber in AA,
+        borders of the pixels of the final array in AA and the
+        0-based first and last pixel covered by each fiber
+    """
     # Use only the spectral axis
     subwcs = finalwcs.sub(['spectral'])
 
@@ -375,58 +677,122 @@ def resample_rss_flux(arr, solutionwl, npix, finalwcs, span=0, fill=0):
     # In AA
     new_wl_borders = pixel_borders(new_wl)
 
-    accum_flux = numpy.empty((nfibers, nsamples + 1))
-    accum_flux[:, 1:] = numpy.cumsum(arr, axis=1)
-    accum_flux[:, 0] = 0.0
-    rss_resampled = numpy.zeros((nfibers, npix))
-    limits = []
+    fibids = numpy.array([fibsol.fibid for fibsol in solutionwl.contents])
+
+    # Coefficients of all the solutions, padded to the same degree
+    ncoeff = max(len(fibsol.solution.coeff) for fibsol in solutionwl.contents)
+    coeffs = numpy.zeros((len(fibids), ncoeff))
+    for idx, fibsol in enumerate(solutionwl.contents):
+        coeff = fibsol.solution.coeff
+        coeffs[idx, :len(coeff)] = coeff
+    # small correction defined in master_wlcalib_XXX_XX-X.json
+    # the solutions are not modified
+    coeffs[:, 0] -= solutionwl.global_offset(fibids)
+
+    # Polynomials return AA, shape (nsolutions, nsamples + 1)
+    old_wl_borders = coeffs @ polyvander(old_x_borders_1, ncoeff - 1).T
+
+    # 0-based, AA
+    ss_vals, = subwcs.all_world2pix(old_wl_borders[:, [0, -1]].ravel(), 0)
+    # s1 is the 0-based pixel that contains the lower limit
+    # s2 is the 0-based pixel that contains the upper limit
+    s1, s2 = numpy.floor(ss_vals + 0.5).astype('int').reshape(-1, 2).T
+    lower = numpy.clip(s1, 0, npix - 1)
+    upper = numpy.clip(s2, 0, npix - 1)
+
+    if numpy.any(lower > upper):
+        warnings.warn('lower limit is > upper limit', RuntimeWarning)
+
+    if numpy.any(lower + span > upper - span):
+        warnings.warn(
+            'lower limit + span is > upper limit - span', RuntimeWarning)
 
-    for fibsol in solutionwl.contents:
+    return fibids, old_wl_borders, new_wl_borders, lower, upper
 
-        fibid = fibsol.fibid
-        idx = fibid - 1
 
-        # small correction defined in master_wlcalib_XXX_XX-X.json
-        coeff = fibsol.solution.coeff
-        offset_wavelength = solutionwl.global_offset(fibid)
-        coeff[0] -= offset_wavelength
-
-        # Polynomial returns AA
-        old_wl_borders = polyval(old_x_borders_1, coeff)
-        # 0-based, AA
-        ss_vals, = subwcs.all_world2pix(old_wl_borders[[0, -1]], 0)
-        # s1 is the 0-based pixel that contains the lower limit
-        # s2 is the 0-based pixel that contains the upper limit
-        s1, s2 = ss_vals
-        s1 = utils.coor_to_pix_1d(s1)
-        s2 = utils.coor_to_pix_1d(s2)
-        lower = max(0, min(s1, npix - 1))
-        upper = max(0, min(s2, npix - 1))
-
-        if lower > upper:
-            warnings.warn('lower limit is > upper limit', RuntimeWarning)
-
-        # We need a monotonic interpolator
-        # linear would work, we use a cubic interpolator
-        interpolator = SteffenInterpolator(
-            old_wl_borders,
-            accum_flux[idx],
-            extrapolate='border'
-        )
+def steffen_interpolate_rows(x, y, x_new, block=16):
+    """Monotonic interpolation of the rows of an array
 
-        if lower + span > upper - span:
-            warnings.warn(
-                'lower limit + span is > upper limit - span', RuntimeWarning)
+    Each row of `y` is interpolated in `x_new`, with the
+    monotonic piecewise cubic interpolator of Steffen (1990).
+    The result of each row is equivalent to
+    ``SteffenInterpolator(x[i], y[i], extrapolate='border')(x_new)``
 
-        fl_borders = interpolator(new_wl_borders)
-        rss_resampled[idx] = fl_borders[1:] - fl_borders[:-1]
-        # Expand the border to remove `span` pixels
-        # in both sides, to avoid high variance
-        rss_resampled[idx, lower:lower + span] = fill
-        rss_resampled[idx, upper + 1 - span:upper + 1] = fill
-        limits.append((fibid, (lower + span, upper - span)))
+    Parameters
+    ----------
+    x : numpy.ndarray
+        Coordinates of the samples, shape (nrows, nsamples),
+        each row sorted monotonically increasing
+    y : numpy.ndarray
+        Values of the samples, shape (nrows, nsamples)
+    x_new : numpy.ndarray
+        Points to evaluate the interpolants at, sorted
+        monotonically increasing
+    block : int
+        Number of rows interpolated together, the temporary
+        arrays of a block should fit in the cache
 
-    return rss_resampled, limits
+    Returns
+    -------
+    numpy.ndarray
+        Interpolated values, shape (nrows, len(x_new))
+    """
+    x = numpy.asarray(x, dtype='float')
+    y = numpy.asarray(y, dtype='float')
+    x_new = numpy.asarray(x_new, dtype='float')
+    result = numpy.empty((x.shape[0], len(x_new)))
+    for start in range(0, x.shape[0], block):
+        sl = slice(start, start + block)
+        result[sl] = _steffen_interpolate_block(x[sl], y[sl], x_new)
+    return result
+
+
+def _steffen_interpolate_block(x, y, x_new):
+    nrows, nsamples = x.shape
+
+    # Steps
+    h = numpy.empty_like(x)
+    h[:, :-1] = numpy.diff(x, axis=1)
+    h[:, -1] = h[:, -2]
+    # Secants
+    s = numpy.zeros_like(y)
+    s[:, :-1] = numpy.diff(y, axis=1) / h[:, :-1]
+    # Parabolic derivative
+    p = numpy.zeros_like(s)
+    p[:, 1:] = (s[:, :-1] * h[:, 1:] + s[:, 1:] * h[:, :-1]) / (h[:, 1:] + h[:, :-1])
+
+    # Derivatives, 0 in the borders
+    abs_s = numpy.abs(s)
+    yp = numpy.zeros((nrows, nsamples + 1))
+    yp[:, 1:-1] = (numpy.sign(s[:, 1:]) + numpy.sign(s[:, :-1])) * \
+        numpy.minimum(numpy.minimum(abs_s[:, 1:], abs_s[:, :-1]), 0.5 * numpy.abs(p[:, 1:]))
+
+    # Interval of each new point, numpy.interp is faster than
+    # numpy.searchsorted for sorted points
+    samples = numpy.arange(nsamples)
+    ids = numpy.empty((nrows, len(x_new)), dtype='int')
+    for row in range(nrows):
+        ids[row] = numpy.interp(x_new, x[row], samples)
+    ids = numpy.minimum(ids, nsamples - 1)
+    # flat indices, yp has an additional column
+    rows = numpy.arange(nrows)[:, numpy.newaxis]
+    flat = ids + nsamples * rows
+    flat_yp = flat + rows
+
+    # Polynomial coefficients in each interval
+    hh = h.take(flat)
+    ss = s.take(flat)
+    yp0 = yp.take(flat_yp)
+    yp1 = yp.take(flat_yp + 1)
+    coef_b = (3 * ss - 2 * yp0 - yp1) / hh
+    coef_a = (yp0 + yp1 - 2 * ss) / hh**2
+
+    # Border extrapolation: the points below the range are moved
+    # to the first sample; the polynomial of the last sample is
+    # constant, as its derivatives are 0
+    u = numpy.maximum(x_new - x.take(flat), 0.0)
+    result = u * (u * (coef_a * u + coef_b) + yp0) + y.take(flat)
+    return result
 
 
 def pixel_borders(arr):
@@ -13,7 +13,8 @@ import numpy.polynomial.polynomial as nppol
 
 from numina.util.convertfunc import json_serial_function, convert_function
 
-from megaradrp.processing.modelmap import calc_matrix_cols, aper_extract
+from megaradrp.processing.modelmap import load_matrix_cols, aper_extract
+from megaradrp.processing.modelmap import ParallelColumnExtractor
 from .structured import BaseStructuredCalibration
 from .aperture import GeometricAperture
 from .traces import to_ds9_reg as to_ds9_reg_function
@@ -78,6 +79,9 @@ class ModelMap(BaseStructuredCalibration):
         self.global_offset = nppol.Polynomial([0.0])
         self.ref_column = 2000
         self._wcols = None
+        self._wfactors = None
+        self._wkey = None
+        self._wpar = None
 
     def __getstate__(self):
         st = super(ModelMap, self).__getstate__()
@@ -100,15 +104,45 @@ class ModelMap(BaseStructuredCalibration):
             state.get('global_offset', [0.0]))
         self.ref_column = state.get('ref_column', 2000)
         self._wcols = None
+        self._wfactors = None
+        self._wkey = None
+        self._wpar = None
 
     def calculate_matrices(self, shape, processes=0):
-        if self._wcols is None:
-            self._wcols = calc_matrix_cols(self, shape, processes)
+        """Compute the extraction matrices for images of this shape.
 
-    def aper_extract(self, img, processes=0):
-        if self._wcols is None:
-            self._wcols = calc_matrix_cols(self, img.shape, processes)
-        return aper_extract(self, self._wcols, img)
+        The matrices are recomputed if the shape or the
+        global offset change.
+        """
+        key = (tuple(shape), tuple(self.global_offset.coef))
+        if self._wcols is None or self._wkey != key:
+            self.close()
+            self._wcols, self._wfactors = load_matrix_cols(self, shape, processes)
+            self._wkey = key
+
+    def aper_extract(self, img, processes=0, method='banded'):
+        """Extract the fibers of img.
+
+        img can be a 2D image or a 3D stack of images. With
+        processes > 1, the columns are extracted by a pool of
+        processes, that is reused in later calls.
+        """
+        self.calculate_matrices(img.shape[-2:], processes)
+        if processes < 2:
+            return aper_extract(self, self._wcols, img,
+                                factors=self._wfactors, method=method)
+
+        if self._wpar is None or self._wpar.processes != processes:
+            self.close()
+            self._wpar = ParallelColumnExtractor(
+                self._wcols, self._wfactors, self.total_fibers, processes)
+        return self._wpar.extract(img, method=method)
+
+    def close(self):
+        """Shutdown the pool of processes used in extraction"""
+        if self._wpar is not None:
+            self._wpar.close()
+            self._wpar = None
 
     def to_ds9_reg(self, ds9reg, rawimage=False, numpix=100, fibid_at=0):
         """Transform fiber traces to ds9-region format.
@@ -9,6 +9,7 @@
 
 """Products of the Megara Pipeline"""
 
+import numpy
 import numpy.polynomial.polynomial as nppol
 
 from megaradrp.datatype import MegaraDataType
@@ -57,6 +58,78 @@ class GeometricTrace(GeometricAperture):
         return self.polynomial
 
 
+class TraceArrays:
+    """Columnar representation of the traces of a TraceMap.
+
+    Attributes
+    ----------
+    fibid, boxid, start, stop : numpy.ndarray
+        Fiber and box ids and first and last columns of each trace
+    valid : numpy.ndarray
+        True for the traces with a polynomial
+    coeffs : numpy.ndarray
+        Coefficients of the polynomials (ntraces, ncoeffs), in
+        increasing degree and padded with zeros
+    """
+
+    def __init__(self, fibid, boxid, start, stop, valid, coeffs):
+        self.fibid = fibid
+        self.boxid = boxid
+        self.start = start
+        self.stop = stop
+        self.valid = valid
+        self.coeffs = coeffs
+
+    def __len__(self):
+        return len(self.fibid)
+
+    @classmethod
+    def from_states(cls, states):
+        """Arrays from the states of GeometricTrace"""
+        fitparms = [state.get('fitparms') or [] for state in states]
+        ncoeffs = max([len(parms) for parms in fitparms], default=0)
+        coeffs = numpy.zeros((len(states), max(ncoeffs, 1)))
+        for idx, parms in enumerate(fitparms):
+            coeffs[idx, :len(parms)] = parms
+        return cls(
+            fibid=numpy.array([state['fibid'] for state in states], dtype='int'),
+            boxid=numpy.array([state['boxid'] for state in states], dtype='int'),
+            start=numpy.array([state['start'] for state in states], dtype='int'),
+            stop=numpy.array([state['stop'] for state in states], dtype='int'),
+            valid=numpy.array([len(parms) > 0 for parms in fitparms], dtype='bool'),
+            coeffs=coeffs
+        )
+
+    @classmethod
+    def from_traces(cls, traces):
+        """Arrays from a list of GeometricTrace"""
+        states = [dict(fibid=t.fibid, boxid=t.boxid, start=t.start, stop=t.stop,
+                       fitparms=t.fitparms) for t in traces]
+        return cls.from_states(states)
+
+    def evaluate(self, columns):
+        """Value of the polynomials of all the traces.
+
+        Parameters
+        ----------
+        columns : array_like
+            Columns, the same for all the traces (ncol,), or
+            different for each trace (ntraces, ncol)
+
+        Returns
+        -------
+        numpy.ndarray
+            Array (ntraces, ncol)
+        """
+        columns = numpy.asarray(columns, dtype='float')
+        result = numpy.zeros((len(self),) + columns.shape[-1:])
+        # Horner scheme
+        for coef in self.coeffs.T[::-1]:
+            result *= columns
+            result += coef[:, numpy.newaxis]
+        return result
+
+
 class TraceMap(BaseStructuredCalibration):
     """Trace map calibration product"""
     DATATYPE = MegaraDataType.TRACE_MAP
@@ -64,6 +137,9 @@ class TraceMap(BaseStructuredCalibration):
 
     def __init__(self, instrument='MEGARA'):
         super(TraceMap, self).__init__(instrument)
+        # States of the traces, until contents is accessed
+        self._states = None
+        self._arrays = None
         self.contents = []
         self.boxes_positions = []
         self.global_offset = nppol.Polynomial([0.0])
@@ -71,9 +147,126 @@ class TraceMap(BaseStructuredCalibration):
         self.expected_range = [4, 4092]
         #
 
+    @property
+    def contents(self):
+        """Traces, as a list of GeometricTrace"""
+        if self._contents is None:
+            self._contents = [GeometricTrace(**trace) for trace in self._states]
+            self._states = None
+            self._arrays = None
+        return self._contents
+
+    @contents.setter
+    def contents(self, value):
+        self._contents = value
+        self._states = None
+        self._arrays = None
+
+    @property
+    def arrays(self):
+        """Traces, in columnar form.
+
+        The arrays are computed from `contents` each time,
+        unless the traces have not been accessed after loading.
+
+        Returns
+        -------
+        TraceArrays
+        """
+        if self._contents is None:
+            if self._arrays is None:
+                self._arrays = TraceArrays.from_states(self._states)
+            return self._arrays
+        return TraceArrays.from_traces(self._contents)
+
+    def centers(self, columns, offset=True):
+        """Centers of all the traces.
+
+        Parameters
+        ----------
+        columns : array_like
+            Columns, the same for all the traces (ncol,), or
+            different for each trace (ntraces, ncol)
+        offset : bool
+            If True, apply the global offset
+
+        Returns
+        -------
+        numpy.ndarray
+            Array (ntraces, ncol), in the order of `contents`,
+            with nan in the invalid traces
+        """
+        arrays = self.arrays
+        centers = arrays.evaluate(columns)
+        if offset:
+            y_ref = arrays.evaluate([self.ref_column])
+            centers += self.global_offset(y_ref)
+        centers[~arrays.valid] = numpy.nan
+        return centers
+
+    def borders(self, columns):
+        """Compute the borders of the apertures.
+
+        The borders are placed halfway to the neighbouring fibers, or
+        at a quarter of the distance if one fiber is missing in between.
+        If both neighbours are farther, the border is the reflection of
+        the other border. Fibers without neighbours are not extracted.
+        The global offset is applied.
+
+        Parameters
+        ----------
+        columns : numpy.ndarray
+            Columns where the borders are computed
+
+        Returns
+        -------
+        tuple
+            Fiber ids (nfib,), lower and upper borders (nfib, len(columns))
+        """
+        arrays = self.arrays
+        ncol = len(columns)
+        valid = arrays.valid
+        if not numpy.any(valid):
+            return numpy.array([], dtype='int'), numpy.empty((0, ncol)), numpy.empty((0, ncol))
+
+        fibid = arrays.fibid[valid]
+        boxid = arrays.boxid[valid]
+        centers = self.centers(columns)[valid]
+
+        # Distance to contiguous fibers in box
+        # Handle the first and last using far distances
+        far_dist = 100
+        dist = numpy.diff(fibid) + numpy.diff(boxid)
+        d21 = numpy.concatenate(([far_dist], dist))
+        d32 = numpy.concatenate((dist, [far_dist]))
+
+        middle = 0.5 * (centers[:-1] + centers[1:])
+        pix_21 = numpy.empty_like(centers)
+        pix_21[1:] = middle
+        pix_32 = numpy.empty_like(centers)
+        pix_32[:-1] = middle
+        m21 = d21 == 2
+        pix_21[m21] = 0.5 * (pix_21[m21] + centers[m21])
+        m32 = d32 == 2
+        pix_32[m32] = 0.5 * (pix_32[m32] + centers[m32])
+
+        has_21 = d21 <= 2
+        has_32 = d32 <= 2
+        # Recompute the missing border using the other
+        m21 = ~has_21 & has_32
+        pix_21[m21] = 2 * centers[m21] - pix_32[m21]
+        m32 = has_21 & ~has_32
+        pix_32[m32] = 2 * centers[m32] - pix_21[m32]
+
+        keep = has_21 | has_32
+        return fibid[keep], pix_21[keep], pix_32[keep]
+
     def __getstate__(self):
         st = super(TraceMap, self).__getstate__()
-        st['contents'] = [t.__getstate__() for t in self.contents]
+        if self._contents is None:
+            st['contents'] = [dict(trace) for trace in self._states]
+        else:
+            st['contents'] = [t.__getstate__() for t in self._contents]
         st['boxes_positions'] = self.boxes_positions
         st['global_offset'] = self.global_offset.coef
         st['ref_column'] = self.ref_column
@@ -82,8 +275,9 @@ class TraceMap(BaseStructuredCalibration):
 
     def __setstate__(self, state):
         super(TraceMap, self).__setstate__(state)
-        self.contents = [GeometricTrace(**trace)
-                         for trace in state['contents']]
+        # The traces are created when contents is accessed
+        self.contents = None
+        self._states = [dict(trace) for trace in state['contents']]
         # fibers in missing fibers and error_fitting are invalid
         self.boxes_positions = state.get('boxes_positions', [])
         self.global_offset = nppol.Polynomial(
@@ -14,6 +14,26 @@ import itertools
 import numpy
 
 
+def _sample_traces(obj, numpix):
+    """Fiber id, validity and numpix points of each trace of obj"""
+    if hasattr(obj, 'arrays'):
+        arrays = obj.arrays
+        # abscissae of each fiber, all fibers are evaluated at once
+        xps = numpy.linspace(start=arrays.start, stop=arrays.stop, num=numpix, axis=-1)
+        yps = obj.centers(xps, offset=False)
+        return zip(arrays.fibid, arrays.valid, xps, yps)
+    return _sample_apertures(obj.contents, numpix)
+
+
+def _sample_apertures(apertures, numpix):
+    for aper in apertures:
+        if aper.valid:
+            xp = numpy.linspace(start=aper.start, stop=aper.stop, num=numpix)
+            yield aper.fibid, True, xp, aper.polynomial(xp)
+        else:
+            yield aper.fibid, False, None, None
+
+
 def to_ds9_reg(obj, ds9reg, rawimage=False, numpix=100, fibid_at=0):
     """Transform fiber traces to ds9-region format.
 
@@ -50,16 +70,10 @@ def to_ds9_reg(obj, ds9reg, rawimage=False, numpix=100, fibid_at=0):
     ds9reg.write(f'# uuid: {obj.uuid}\n')
     colorbox = ['#ff77ff', '#4444ff']
     itercolors = itertools.cycle(colorbox)
-    for fiberdict in obj.contents:
-        fibid = fiberdict.fibid
-        # boxid = fiberdict.boxid
-        xmin = fiberdict.start
-        xmax = fiberdict.stop
+    for fibid, valid, xp, yp in _sample_traces(obj, numpix):
         ds9reg.write(f'#\n# fibid: {fibid}\n')
         # skip fibers without trace
-        if fiberdict.valid:
-            xp = numpy.linspace(start=xmin, stop=xmax, num=numpix)
-            yp = fiberdict.polynomial(xp)
+        if valid:
             if rawimage:
                 lcut = (yp > 2056.5)
                 yp[lcut] += 100
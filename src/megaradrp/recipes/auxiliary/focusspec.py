@@ -161,24 +161,31 @@ class FocusSpectrographRecipe(MegaraBaseRecipe):
         nfibers = rinput.nfibers
         valid_traces = valid_traces[::nfibers]
 
-        ever = {}
+        images = {}
         for focus, frames in image_groups.items():
             self.logger.info('processing focus %s', focus)
 
             try:
                 img = basic_processing_with_combination_frames(
                     frames, flow, method=combine.median, errors=False)
-                calibrator_aper = ApertureExtractor(
-                    rinput.master_apertures,
-                    self.datamodel,
-                    offset=rinput.extraction_offset
-                )
-
                 self.save_intermediate_img(img, f'focus2d-{focus}.fits')
-                img1d = calibrator_aper(img)
-                self.save_intermediate_img(img1d, f'focus1d-{focus}.fits')
+                images[focus] = img
+            except ValueError:
+                self.logger.info('focus %s cannot be processed', focus)
 
-                self.logger.info('find lines and compute FWHM')
+        # All the images are extracted together
+        calibrator_aper = ApertureExtractor(
+            rinput.master_apertures,
+            self.datamodel,
+            offset=rinput.extraction_offset
+        )
+        imgs1d = calibrator_aper.run_stack(list(images.values()))
+
+        ever = {}
+        for focus, img1d in zip(images, imgs1d):
+            self.save_intermediate_img(img1d, f'focus1d-{focus}.fits')
+            try:
+                self.logger.info('find lines and compute FWHM in focus %s', focus)
                 lines_rss_fwhm = self.run_on_image(img1d, rinput.master_apertures,
                                                    flux_limit,
                                                    valid_traces=valid_traces,
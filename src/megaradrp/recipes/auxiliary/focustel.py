@@ -112,7 +112,8 @@ class FocusTelescopeRecipe(ImageRecipe):
                     rinput.master_apertures,
                     rinput.master_wlcalib,
                     rinput.master_fiberflat,
-                    offset=rinput.extraction_offset
+                    offset=rinput.extraction_offset,
+                    resampling=rinput.wl_resampling
                 )
 
                 do_sky_subtraction = True
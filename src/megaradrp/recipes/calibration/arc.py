@@ -11,6 +11,8 @@
 
 from copy import deepcopy
 import errno
+import logging
+import multiprocessing as mp
 import os
 
 from astropy.io import fits
@@ -29,6 +31,7 @@ from numina.array.wavecalib.arccalibration import gen_triplets_master
 from numina.array.wavecalib.arccalibration import refine_arccalibration
 from numina.array.wavecalib.solutionarc import CrLinear
 from numina.array.wavecalib.solutionarc import SolutionArcCalibration
+from numina.array.wavecalib.solutionarc import WavecalFeature
 from numina.core.validator import range_validator
 from numina.util.flow import SerialFlow
 from numina.array import combine
@@ -37,6 +40,7 @@ from megaradrp.ntypes import ProcessedFrame, ProcessedRSS
 from megaradrp.processing.combine import basic_processing_with_combination
 from megaradrp.processing.aperture import ApertureExtractor
 from megaradrp.processing.fiberflat import Splitter, FlipLR
+from megaradrp.core.opcache import ArrayCache, cache_key
 from megaradrp.core.recipe import MegaraBaseRecipe
 from megaradrp.products import WavelengthCalibration
 from megaradrp.products.wavecalibration import FiberSolutionArcCalibration
@@ -45,6 +49,9 @@ import megaradrp.requirements as reqs
 from megaradrp.instrument import vph_thr_arc
 
 
+_logger = logging.getLogger(__name__)
+
+
 class ArcCalibrationRecipe(MegaraBaseRecipe):
     """Provides wavelength calibration information from arc images.
 
@@ -88,6 +95,14 @@ class ArcCalibrationRecipe(MegaraBaseRecipe):
     group, `nlines[1]` peaks in the second, etc.
 
     The selected peaks are matched against the catalog of lines in `lines_catalog`.
+    If `nanchors` is not 0, only `nanchors` fibers of each box are
+    matched against the catalog using triplets. The solutions of
+    the rest of fibers are predicted from these anchors and the peaks
+    are matched directly to the nearest lines in the catalog. The triplet
+    method is used only if the predicted match does not fit well.
+    The fibers are processed in parallel, being the number of processes controlled
+    by the parameter `processes`, with the default value of 0 meaning to use
+    all the available cores minus 2.
     The matched lines, the quality of the match and other relevant information is
     stored in the product WavelengthCalibration object. The wavelength of the matched
     features is fitted to a polynomial
@@ -128,6 +143,11 @@ class ArcCalibrationRecipe(MegaraBaseRecipe):
         0,
         description='Store PDF plot with refined fits for each fiber',
     )
+    processes = Parameter(0, 'Number of processes used for line identification')
+    nanchors = Parameter(
+        3, 'Number of fibers per box identified with the triplet method, 0 for all fibers',
+        validator=range_validator(minval=0)
+    )
 
     # Results
     reduced_image = Result(ProcessedFrame)
@@ -152,6 +172,16 @@ class ArcCalibrationRecipe(MegaraBaseRecipe):
 
         debugplot = rinput.debug_plot if self.intermediate_results else 0
 
+        if rinput.processes == 0:
+            have = mp.cpu_count()
+            if have >= 4:
+                processes = mp.cpu_count() - 2
+            else:
+                processes = 1
+        else:
+            processes = rinput.processes
+        self.logger.debug('using %d processes', processes)
+
         obresult = rinput.obresult
         obresult_meta = obresult.metadata_with(self.datamodel)
 
@@ -207,7 +237,9 @@ class ArcCalibrationRecipe(MegaraBaseRecipe):
             threshold=threshold,
             min_distance=min_distance,
             debugplot=debugplot,
-            store_pdf_with_refined_fits=rinput.store_pdf_with_refined_fits
+            store_pdf_with_refined_fits=rinput.store_pdf_with_refined_fits,
+            processes=processes,
+            nanchors=rinput.nanchors
         )
 
         initial_data_wlcalib.tags = rinput.obresult.tags
@@ -244,17 +276,16 @@ class ArcCalibrationRecipe(MegaraBaseRecipe):
         """
         Compute FWHM of lines in spectra
         """
-        import numina.array.fwhm as fmod
-
-        # FIXME: this could wrap around the image
-        qslit = row[peak_int - lwidth:peak_int + lwidth]
-        return fmod.compute_fwhm_1d_simple(qslit, lwidth)
+        return calc_fwhm_of_line(row, peak_int, lwidth=lwidth)
 
     def calibrate_wl(self, rss, lines_catalog, poldeg, tracemap, nlines,
                      threshold=0.27,
                      min_distance=30,
                      debugplot=0,
-                     store_pdf_with_refined_fits=0):
+                     store_pdf_with_refined_fits=0,
+                     processes=1,
+                     nanchors=0,
+                     match_tolerance=(3.0, 1.0)):
 
         if len(poldeg) == 1:
             poldeg_initial = poldeg[0]
@@ -295,12 +326,31 @@ class ArcCalibrationRecipe(MegaraBaseRecipe):
         self.logger.info('wv_end_search %s', wv_end_search)
 
         ntriplets_master, ratios_master_sorted, triplets_master_sorted_list = \
-            gen_triplets_master(wv_master)
+            triplets_master(wv_master)
+
+        if processes > 1 and debugplot != 0:
+            self.logger.info('debug plots require serial processing, using 1 process')
+            processes = 1
+
+        # Master tables and settings, sent once to each worker
+        context = dict(
+            wv_master=wv_master,
+            wv_master_all=wv_master_all,
+            ntriplets_master=ntriplets_master,
+            ratios_master_sorted=ratios_master_sorted,
+            triplets_master_sorted_list=triplets_master_sorted_list,
+            nlines=nlines,
+            naxis1=rss.shape[1],
+            wv_ini_search=wv_ini_search,
+            wv_end_search=wv_end_search,
+            poldeg_initial=poldeg_initial,
+            poldeg_refined=poldeg_refined,
+            debugplot=debugplot,
+            match_tolerance=match_tolerance
+        )
 
         error_contador = 0
         missing_fib = 0
-        crpix1 = 1.0
-        naxis1 = rss.shape[1]
 
         plot_tracenumber = []
         plot_npeaksfound = []
@@ -310,122 +360,79 @@ class ArcCalibrationRecipe(MegaraBaseRecipe):
 
         initial_data_wlcalib = WavelengthCalibration(instrument='MEGARA')
         initial_data_wlcalib.total_fibers = tracemap.total_fibers
+
+        tasks = []
+        boxes = []
         for trace in tracemap.contents:
             fibid = trace.fibid
             idx = trace.fibid - 1
-
             if trace.valid:
-                self.logger.info('-' * 52)
-                self.logger.info('Starting row %d, fibid %d', idx, fibid)
-
-                row = rss[idx]
-
-                fxpeaks, sxpeaks = find_fxpeaks(
-                    sp=row,
-                    times_sigma_threshold=0.0,
-                    minimum_threshold=0,
-                    nwinwidth_initial=7,
-                    nwinwidth_refined=5,
-                    npix_avoid_border=6,
-                    nbrightlines=nlines,
-                    sigma_gaussian_filtering=0,
-                    minimum_gaussian_filtering=0
-                )
-                self.logger.info('number of peaks (expected): %s',
-                                 str(nlines))
-                self.logger.info('number of peaks (found)...: %d',
-                                 len(fxpeaks))
-
-                try:
-
-                    # use channels (pixels from 1 to naxis1)
-                    xchannel = fxpeaks + 1.0
-
-                    list_of_wvfeatures = arccalibration_direct(
-                        wv_master=wv_master,
-                        ntriplets_master=ntriplets_master,
-                        ratios_master_sorted=ratios_master_sorted,
-                        triplets_master_sorted_list=triplets_master_sorted_list,
-                        xpos_arc=xchannel,
-                        naxis1_arc=naxis1,
-                        crpix1=crpix1,
-                        wv_ini_search=wv_ini_search,
-                        wv_end_search=wv_end_search,
-                        error_xpos_arc=3.0,  # initially: 2.0
-                        times_sigma_r=3.0,
-                        frac_triplets_for_sum=0.50,
-                        times_sigma_theil_sen=10.0,
-                        poly_degree_wfit=poldeg_initial,
-                        times_sigma_polfilt=10.0,
-                        times_sigma_cook=10.0,
-                        times_sigma_inclusion=10.0,
-                        debugplot=debugplot
-                    )
-
-                    self.logger.info('Solution for row %d completed', idx)
-                    self.logger.info('Fitting solution for row %d', idx)
-                    solution_wv = fit_list_of_wvfeatures(
-                        list_of_wvfeatures,
-                        naxis1_arc=naxis1,
-                        crpix1=crpix1,
-                        poly_degree_wfit=poldeg_initial,
-                        weighted=False,
-                        debugplot=0,
-                        plot_title=None
-                    )
-
-                    self.logger.info('linear crval1, cdelt1: %f %f',
-                                     solution_wv.cr_linear.crval,
-                                     solution_wv.cr_linear.cdelt)
-
-                    self.logger.info('fitted coefficients %s',
-                                     solution_wv.coeff)
-
-                    # store results for plotting
-                    plot_tracenumber.append(fibid)
-                    plot_npeaksfound.append(len(fxpeaks))
-                    plot_crval1.append(solution_wv.cr_linear.crval)
-                    plot_cdelt1.append(solution_wv.cr_linear.cdelt)
-                    plot_coeff.append(solution_wv.coeff)
-
-                    trace_pol = trace.polynomial
-                    # Update feature with measurements of Y coord in original
-                    # image
-                    # Peak and FWHM in RSS
-                    for feature in solution_wv.features:
-                        # Compute Y
-                        feature.ypos = trace_pol(feature.xpos)
-                        # FIXME: check here FITS vs PYTHON coordinates, etc
-                        peak_int = int(feature.xpos)
-                        try:
-                            peak, fwhm = self.calc_fwhm_of_line(row, peak_int,
-                                                                lwidth=20)
-                        except Exception as error:
-                            self.logger.warning("%s", error)
-                            self.logger.warning('error in feature %s', feature)
-                            # workaround
-                            peak = row[peak_int]
-                            fwhm = 0.0
-                        # I would call this peak instead...
-                        feature.peak = peak
-                        feature.fwhm = fwhm
-
-                    new = FiberSolutionArcCalibration(fibid, solution_wv)
-                    initial_data_wlcalib.contents.append(new)
-
-                except (ValueError, TypeError, IndexError) as error:
-                    self.logger.warning("%s", error)
-                    self.logger.warning(
-                        'problem in row %d, fibid %d', idx, fibid)
-                    initial_data_wlcalib.error_fitting.append(fibid)
-                    error_contador += 1
-
+                tasks.append((fibid, rss[idx], trace.polynomial))
+                boxes.append(trace.boxid)
             else:
                 self.logger.info('skipping row %d, fibid %d, not extracted',
                                  idx, fibid)
                 missing_fib += 1
                 initial_data_wlcalib.missing_fibers.append(fibid)
 
+        if nanchors > 0:
+            anchors = select_anchor_fibers(boxes, nanchors)
+        else:
+            anchors = numpy.ones(len(tasks), dtype='bool')
+
+        anchor_tasks = [task for task, anchor in zip(tasks, anchors) if anchor]
+        self.logger.info('identifying lines in %d fibers, using %d processes',
+                         len(anchor_tasks), processes)
+        anchor_results = map_fibers(identify_fiber_lines, anchor_tasks, context, processes)
+        results = {res[0]: res + (False,) for res in anchor_results}
+
+        seed_tasks = []
+        if not numpy.all(anchors):
+            seeds = seed_coefficients(
+                [task[0] for task in tasks], boxes, anchors, anchor_results
+            )
+            seed_tasks = [task + (coeff,)
+                          for task, anchor, coeff in zip(tasks, anchors, seeds)
+                          if not anchor]
+            self.logger.info('matching lines in %d fibers, using %d processes',
+                             len(seed_tasks), processes)
+            for res in map_fibers(match_fiber_lines, seed_tasks, context, processes):
+                results[res[0]] = res
+        results = [results[task[0]] for task in tasks]
+        nfallback = sum(res[4] is False for res in results) - len(anchor_tasks)
+        self.logger.info('%d fibers matched from anchors, %d with triplet fallback',
+                         len(seed_tasks) - nfallback, nfallback)
+
+        for fibid, npeaks, solution_wv, error, seeded in results:
+            idx = fibid - 1
+            self.logger.info('-' * 52)
+            self.logger.info('row %d, fibid %d', idx, fibid)
+            self.logger.info('number of peaks (expected): %s', str(nlines))
+            self.logger.info('number of peaks (found)...: %d', npeaks)
+            if seeded:
+                self.logger.info('lines matched with the solution of the anchors')
+            if solution_wv is None:
+                self.logger.warning("%s", error)
+                self.logger.warning('problem in row %d, fibid %d', idx, fibid)
+                initial_data_wlcalib.error_fitting.append(fibid)
+                error_contador += 1
+                continue
+
+            self.logger.info('linear crval1, cdelt1: %f %f',
+                             solution_wv.cr_linear.crval,
+                             solution_wv.cr_linear.cdelt)
+            self.logger.info('fitted coefficients %s', solution_wv.coeff)
+
+            # store results for plotting
+            plot_tracenumber.append(fibid)
+            plot_npeaksfound.append(npeaks)
+            plot_crval1.append(solution_wv.cr_linear.crval)
+            plot_cdelt1.append(solution_wv.cr_linear.cdelt)
+            plot_coeff.append(solution_wv.coeff)
+
+            new = FiberSolutionArcCalibration(fibid, solution_wv)
+            initial_data_wlcalib.contents.append(new)
+
         self.logger.info('Errors in fitting: %s', error_contador)
         self.logger.info('Missing fibers: %s', missing_fib)
 
@@ -489,95 +496,58 @@ class ArcCalibrationRecipe(MegaraBaseRecipe):
                             if exc.errno != errno.EEXIST:
                                 raise
             # refine wavelength calibration polynomial for each valid fiber
+            store_pdf = store_pdf_with_refined_fits == 1 and self.intermediate_results
+            tasks = []
             for trace in tracemap.contents:
                 fibid = trace.fibid
                 idx = trace.fibid - 1
                 if trace.valid:
-                    self.logger.info('-' * 52)
-                    self.logger.info('Starting row %d, fibid %d', idx, fibid)
-                    # select spectrum for current fiber
-                    row = rss[idx]
-                    naxis1 = row.shape[0]
                     # estimate polynomial coefficients for current fiber
                     coeff = numpy.zeros(poldeg_initial + 1)
                     for k in range(poldeg_initial + 1):
                         dumpol = list_poly_vs_fiber[k]
                         coeff[k] = dumpol(fibid)
-                    wlpol = numpy.polynomial.Polynomial(coeff)
-                    # refine polynomial fit using the full set of arc lines
-                    # in master list (and save output PDF file when requested)
-                    if store_pdf_with_refined_fits == 1:
-                        if self.intermediate_results:
-                            from matplotlib.backends.backend_pdf import PdfPages
-                            plottitle = f'fiber #{fibid:03d}'
-                            pdf = PdfPages(
-                                f'refined_wavecal/{fibid:03d}.pdf'
-                            )
-                        else:
-                            plottitle = None
-                            pdf = None
-                    else:
-                        plottitle = None
-                        pdf = None
-                    poly_refined, yres_summary = \
-                        refine_arccalibration(sp=row,
-                                              poly_initial=wlpol,
-                                              wv_master=wv_master_all,
-                                              poldeg=poldeg_refined,
-                                              plottitle=plottitle,
-                                              ylogscale=True,
-                                              pdf=pdf)
-                    if pdf is not None:
-                        from numina.array.display.matplotlib_qt import plt
-                        plt.close()
-                        pdf.close()
-                    if poly_refined != numpy.polynomial.Polynomial([0.0]):
-                        npoints_eff = yres_summary['npoints']
-                        residual_std = yres_summary['robust_std']
-                        # compute approximate linear values
-                        crmin1_linear = poly_refined(1)
-                        crmax1_linear = poly_refined(naxis1)
-                        cdelt1_linear = (crmax1_linear - crmin1_linear) / \
-                                        (naxis1 - 1)
-                        self.logger.info('linear crval1, cdelt1: %f %f',
-                                         crmin1_linear, cdelt1_linear)
-                        self.logger.info('fitted coefficients %s',
-                                         poly_refined.coef)
-                        self.logger.info('npoints_eff, residual_std: %d %f',
-                                         npoints_eff, residual_std)
-                        cr_linear = CrLinear(
-                            crpix=1.0,
-                            crval=crmin1_linear,
-                            crmin=crmin1_linear,
-                            crmax=crmax1_linear,
-                            cdelt=cdelt1_linear
-                        )
-                        solution_wv = SolutionArcCalibration(
-                            features=[],  # empty list!
-                            coeff=poly_refined.coef,
-                            residual_std=residual_std,
-                            cr_linear=cr_linear
-                        )
-                        solution_wv.npoints_eff = npoints_eff  # add also this
-                        new = FiberSolutionArcCalibration(fibid, solution_wv)
-                        data_wlcalib.contents.append(new)
-                        # store results for plotting
-                        plot_tracenumber.append(fibid)
-                        plot_npointseff.append(npoints_eff)
-                        plot_residualstd.append(residual_std)
-                        plot_crval1.append(crmin1_linear)
-                        plot_cdelt1.append(cdelt1_linear)
-                        plot_coeff.append(poly_refined.coef)
+                    # save output PDF file when requested
+                    if store_pdf:
+                        pdfname = f'refined_wavecal/{fibid:03d}.pdf'
                     else:
-                        self.logger.error('error in row %d, fibid %d',
-                                          idx, fibid)
-                        data_wlcalib.error_fitting.append(fibid)
+                        pdfname = None
+                    tasks.append((fibid, rss[idx], coeff, pdfname))
                 else:
                     self.logger.info('skipping row %d, fibid %d, not extracted',
                                      idx, fibid)
                     missing_fib += 1
                     data_wlcalib.missing_fibers.append(fibid)
 
+            self.logger.info('refining solutions of %d fibers, using %d processes',
+                             len(tasks), processes)
+            results = map_fibers(refine_fiber_solution, tasks, context, processes)
+
+            for fibid, solution_wv in results:
+                idx = fibid - 1
+                self.logger.info('-' * 52)
+                self.logger.info('row %d, fibid %d', idx, fibid)
+                if solution_wv is None:
+                    self.logger.error('error in row %d, fibid %d', idx, fibid)
+                    data_wlcalib.error_fitting.append(fibid)
+                    continue
+
+                cr_linear = solution_wv.cr_linear
+                self.logger.info('linear crval1, cdelt1: %f %f',
+                                 cr_linear.crval, cr_linear.cdelt)
+                self.logger.info('fitted coefficients %s', solution_wv.coeff)
+                self.logger.info('npoints_eff, residual_std: %d %f',
+                                 solution_wv.npoints_eff, solution_wv.residual_std)
+                new = FiberSolutionArcCalibration(fibid, solution_wv)
+                data_wlcalib.contents.append(new)
+                # store results for plotting
+                plot_tracenumber.append(fibid)
+                plot_npointseff.append(solution_wv.npoints_eff)
+                plot_residualstd.append(solution_wv.residual_std)
+                plot_crval1.append(cr_linear.crval)
+                plot_cdelt1.append(cr_linear.cdelt)
+                plot_coeff.append(solution_wv.coeff)
+
             self.logger.info('Errors in fitting: %s', error_contador)
             self.logger.info('Missing fibers: %s', missing_fib)
 
@@ -747,3 +717,450 @@ class ArcCalibrationRecipe(MegaraBaseRecipe):
             pdf.close()
 
         return list_poly_vs_fiber
+
+
+# Tables and settings shared by the fibers, set in each worker
+_fiber_context = {}
+
+
+def _init_fiber_context(context):
+    """Initialize the shared tables of a worker process"""
+    _fiber_context.clear()
+    _fiber_context.update(context)
+
+
+def map_fibers(func, tasks, context, processes=1):
+    """Apply func to each task, with the context shared by all the tasks.
+
+    The context is sent once to each worker process. The results
+    are returned in the order of the tasks, independently of the
+    number of processes.
+
+    Parameters
+    ----------
+    func : callable
+        Function called with the elements of each task
+    tasks : list of tuple
+    context : dict
+        Tables and settings, available as `_fiber_context` in func
+    processes : int
+        Number of processes, run in this process if 1
+
+    Returns
+    -------
+    list
+    """
+    if processes > 1 and len(tasks) > 1:
+        with mp.Pool(min(processes, len(tasks)), initializer=_init_fiber_context,
+                     initargs=(context,)) as pool:
+            return pool.starmap(func, tasks)
+    else:
+        _init_fiber_context(context)
+        try:
+            return [func(*task) for task in tasks]
+        finally:
+            _fiber_context.clear()
+
+
+def calc_fwhm_of_line(row, peak_int, lwidth=20):
+    """Compute FWHM of lines in spectra"""
+    import numina.array.fwhm as fmod
+
+    # FIXME: this could wrap around the image
+    qslit = row[peak_int - lwidth:peak_int + lwidth]
+    return fmod.compute_fwhm_1d_simple(qslit, lwidth)
+
+
+def triplets_master(wv_master, cache=None):
+    """Triplets of the master list of lines, sorted by their distance ratio.
+
+    The tables are stored in the on-disk cache, if it is enabled,
+    and loaded from it in later calls with the same list of lines.
+
+    Parameters
+    ----------
+    wv_master : numpy.ndarray
+        Wavelengths of the master list of lines, sorted
+    cache : megaradrp.core.opcache.ArrayCache, optional
+        On-disk cache, by default the one in MEGARADRP_CACHE_DIR
+
+    Returns
+    -------
+    tuple
+        Number of triplets, the sorted distance ratios and the
+        array (ntriplets, 3) with the indices of the lines of
+        each triplet
+    """
+    if cache is None:
+        cache = ArrayCache.from_environ()
+
+    key = cache_key('triplets', numpy.asarray(wv_master, dtype='float'))
+    if cache is not None:
+        arrays = cache.load('triplets', key)
+        if arrays is not None:
+            _logger.debug('triplets of the master list loaded from cache')
+            return len(arrays['ratios']), arrays['ratios'], arrays['triplets']
+
+    _logger.debug('computing triplets of %d lines', len(wv_master))
+    ntriplets, ratios, triplets_list = gen_triplets_master(wv_master)
+    triplets = numpy.array(triplets_list, dtype='int32').reshape(-1, 3)
+    if cache is not None:
+        cache.save('triplets', key, {'ratios': ratios, 'triplets': triplets})
+    return ntriplets, ratios, triplets
+
+
+def measure_features(features, row, trace_pol):
+    """Update the features with their Y coordinate, peak and FWHM"""
+    # Update feature with measurements of Y coord in original
+    # image
+    # Peak and FWHM in RSS
+    for feature in features:
+        # Compute Y
+        feature.ypos = trace_pol(feature.xpos)
+        # FIXME: check here FITS vs PYTHON coordinates, etc
+        peak_int = int(feature.xpos)
+        try:
+            peak, fwhm = calc_fwhm_of_line(row, peak_int, lwidth=20)
+        except Exception as error:
+            _logger.warning("%s", error)
+            _logger.warning('error in feature %s', feature)
+            # workaround
+            peak = row[peak_int]
+            fwhm = 0.0
+        # I would call this peak instead...
+        feature.peak = peak
+        feature.fwhm = fwhm
+
+
+def find_fiber_peaks(row, nlines):
+    """Find the brightest peaks in the spectrum of a fiber"""
+    fxpeaks, sxpeaks = find_fxpeaks(
+        sp=row,
+        times_sigma_threshold=0.0,
+        minimum_threshold=0,
+        nwinwidth_initial=7,
+        nwinwidth_refined=5,
+        npix_avoid_border=6,
+        nbrightlines=nlines,
+        sigma_gaussian_filtering=0,
+        minimum_gaussian_filtering=0
+    )
+    return fxpeaks
+
+
+def identify_fiber_lines(fibid, row, trace_pol):
+    """Identify the arc lines in the spectrum of a fiber.
+
+    The master triplet tables and the settings are read from
+    the context set by `map_fibers`.
+
+    Parameters
+    ----------
+    fibid : int
+    row : numpy.ndarray
+        Spectrum of the fiber
+    trace_pol : numpy.polynomial.Polynomial
+        Trace of the fiber, to compute the Y coordinate of the lines
+
+    Returns
+    -------
+    tuple
+        fibid, number of peaks found, the SolutionArcCalibration
+        (None if the identification failed) and the error message
+    """
+    ctx = _fiber_context
+    crpix1 = 1.0
+    naxis1 = ctx['naxis1']
+
+    fxpeaks = find_fiber_peaks(row, ctx['nlines'])
+
+    try:
+        # use channels (pixels from 1 to naxis1)
+        xchannel = fxpeaks + 1.0
+
+        list_of_wvfeatures = arccalibration_direct(
+            wv_master=ctx['wv_master'],
+            ntriplets_master=ctx['ntriplets_master'],
+            ratios_master_sorted=ctx['ratios_master_sorted'],
+            triplets_master_sorted_list=ctx['triplets_master_sorted_list'],
+            xpos_arc=xchannel,
+            naxis1_arc=naxis1,
+            crpix1=crpix1,
+            wv_ini_search=ctx['wv_ini_search'],
+            wv_end_search=ctx['wv_end_search'],
+            error_xpos_arc=3.0,  # initially: 2.0
+            times_sigma_r=3.0,
+            frac_triplets_for_sum=0.50,
+            times_sigma_theil_sen=10.0,
+            poly_degree_wfit=ctx['poldeg_initial'],
+            times_sigma_polfilt=10.0,
+            times_sigma_cook=10.0,
+            times_sigma_inclusion=10.0,
+            debugplot=ctx['debugplot']
+        )
+
+        solution_wv = fit_list_of_wvfeatures(
+            list_of_wvfeatures,
+            naxis1_arc=naxis1,
+            crpix1=crpix1,
+            poly_degree_wfit=ctx['poldeg_initial'],
+            weighted=False,
+            debugplot=0,
+            plot_title=None
+        )
+
+        measure_features(solution_wv.features, row, trace_pol)
+    except (ValueError, TypeError, IndexError) as error:
+        return fibid, len(fxpeaks), None, str(error)
+
+    return fibid, len(fxpeaks), solution_wv, None
+
+
+def select_anchor_fibers(boxes, nanchors):
+    """Select the fibers solved with the triplet algorithm.
+
+    In each box, `nanchors` fibers evenly spaced are selected,
+    including the first and the last fibers of the box.
+
+    Parameters
+    ----------
+    boxes : list of int
+        Box of each fiber
+    nanchors : int
+        Number of anchors per box
+
+    Returns
+    -------
+    numpy.ndarray
+        Boolean mask, True for the anchors
+    """
+    boxes = numpy.asarray(boxes)
+    anchors = numpy.zeros(len(boxes), dtype='bool')
+    for boxid in numpy.unique(boxes):
+        members = numpy.flatnonzero(boxes == boxid)
+        pos = numpy.linspace(0, len(members) - 1, min(nanchors, len(members)))
+        anchors[members[numpy.round(pos).astype('int')]] = True
+    return anchors
+
+
+def seed_coefficients(fibids, boxes, anchors, anchor_results):
+    """Predict the solution of each fiber from the solved anchors.
+
+    The coefficients are interpolated linearly in fiber number
+    between the anchors of the same box with a solution. The
+    anchors of all the boxes are used if a box has none.
+
+    Parameters
+    ----------
+    fibids : list of int
+    boxes : list of int
+        Box of each fiber
+    anchors : numpy.ndarray
+        Boolean mask of the anchors
+    anchor_results : list of tuple
+        Results of `identify_fiber_lines` for the anchors
+
+    Returns
+    -------
+    list
+        Predicted coefficients of each fiber, None if there
+        are no anchors with a solution
+    """
+    fibids = numpy.asarray(fibids)
+    boxes = numpy.asarray(boxes)
+    anchor_boxes = boxes[anchors]
+    solved = sorted((res[0], box, res[2].coeff)
+                    for box, res in zip(anchor_boxes, anchor_results)
+                    if res[2] is not None)
+    if not solved:
+        return [None for _ in fibids]
+    s_fibids = numpy.array([item[0] for item in solved])
+    s_boxes = numpy.array([item[1] for item in solved])
+    s_coeffs = numpy.array([item[2] for item in solved])
+
+    seeds = []
+    for fibid, box in zip(fibids, boxes):
+        mask = s_boxes == box
+        if not numpy.any(mask):
+            mask = numpy.ones_like(s_boxes, dtype='bool')
+        coeff = [numpy.interp(fibid, s_fibids[mask], c) for c in s_coeffs[mask].T]
+        seeds.append(numpy.array(coeff))
+    return seeds
+
+
+def match_fiber_lines(fibid, row, trace_pol, coeff):
+    """Identify the arc lines of a fiber using a predicted solution.
+
+    The peaks are matched to the nearest line of the master list,
+    using the wavelength predicted by `coeff`, and the solution is
+    fitted again. The matching is repeated with each tolerance in
+    `match_tolerance` (in pixels). If the fit does not use at least
+    half of the peaks or its residuals are larger than the last
+    tolerance, the lines are identified with `identify_fiber_lines`.
+
+    Parameters
+    ----------
+    fibid : int
+    row : numpy.ndarray
+        Spectrum of the fiber
+    trace_pol : numpy.polynomial.Polynomial
+        Trace of the fiber, to compute the Y coordinate of the lines
+    coeff : numpy.ndarray or None
+        Coefficients of the predicted solution
+
+    Returns
+    -------
+    tuple
+        fibid, number of peaks found, the SolutionArcCalibration
+        (None if the identification failed), the error message and
+        True if the lines were matched with the predicted solution
+    """
+    ctx = _fiber_context
+    if coeff is None:
+        return identify_fiber_lines(fibid, row, trace_pol) + (False,)
+
+    crpix1 = 1.0
+    naxis1 = ctx['naxis1']
+    poldeg = ctx['poldeg_initial']
+    wv_master = ctx['wv_master']
+
+    fxpeaks = find_fiber_peaks(row, ctx['nlines'])
+    # use channels (pixels from 1 to naxis1)
+    xchannel = fxpeaks + 1.0
+    npeaks = len(xchannel)
+
+    poly = numpy.polynomial.Polynomial(coeff)
+    matched = numpy.zeros(npeaks, dtype='bool')
+    lineid = numpy.zeros(npeaks, dtype='int')
+    dpix = numpy.zeros(npeaks)
+    for tolerance in ctx['match_tolerance']:
+        if npeaks == 0:
+            break
+        lineid, dpix = _nearest_lines(poly, xchannel, wv_master)
+        matched = numpy.abs(dpix) < tolerance
+        # each line of the master list is assigned only once
+        for line in numpy.unique(lineid[matched]):
+            same = numpy.flatnonzero(matched & (lineid == line))
+            if len(same) > 1:
+                matched[same] = False
+                matched[same[numpy.argmin(numpy.abs(dpix[same]))]] = True
+        if matched.sum() <= poldeg + 1:
+            break
+        poly = numpy.polynomial.Polynomial.fit(
+            xchannel[matched], wv_master[lineid[matched]], deg=poldeg
+        ).convert()
+
+    nmatched = matched.sum()
+    if nmatched <= poldeg + 1 or nmatched < 0.5 * npeaks:
+        return identify_fiber_lines(fibid, row, trace_pol) + (False,)
+
+    features = []
+    for xpos, ok, line, dp in zip(xchannel, matched, lineid, dpix):
+        if ok:
+            feature = WavecalFeature(
+                line_ok=True, category='I', lineid=int(line), funcost=abs(dp),
+                xpos=xpos, reference=wv_master[line], wavelength=poly(xpos)
+            )
+        else:
+            feature = WavecalFeature(
+                line_ok=False, category='X', lineid=-1, funcost=numpy.inf,
+                xpos=xpos
+            )
+        features.append(feature)
+
+    solution_wv = fit_list_of_wvfeatures(
+        features,
+        naxis1_arc=naxis1,
+        crpix1=crpix1,
+        poly_degree_wfit=poldeg,
+        weighted=False,
+        debugplot=0,
+        plot_title=None
+    )
+    cdelt = abs(solution_wv.cr_linear.cdelt)
+    if solution_wv.residual_std > ctx['match_tolerance'][-1] * cdelt:
+        return identify_fiber_lines(fibid, row, trace_pol) + (False,)
+
+    measure_features(solution_wv.features, row, trace_pol)
+    return fibid, npeaks, solution_wv, None, True
+
+
+def _nearest_lines(poly, xpos, wv_master):
+    """Nearest line in the master list and its distance in pixels"""
+    wl = poly(xpos)
+    isort = numpy.clip(numpy.searchsorted(wv_master, wl), 1, len(wv_master) - 1)
+    left = wv_master[isort - 1]
+    right = wv_master[isort]
+    lineid = numpy.where(wl - left < right - wl, isort - 1, isort)
+    # distance in pixels, using the local dispersion
+    dpix = (wl - wv_master[lineid]) / poly.deriv()(xpos)
+    return lineid, dpix
+
+
+def refine_fiber_solution(fibid, row, coeff, pdfname=None):
+    """Refine the wavelength calibration of a fiber.
+
+    The polynomial fit is refined using the full set of arc lines
+    in the master list, read from the context set by `map_fibers`.
+
+    Parameters
+    ----------
+    fibid : int
+    row : numpy.ndarray
+        Spectrum of the fiber
+    coeff : numpy.ndarray
+        Coefficients of the initial polynomial
+    pdfname : str, optional
+        Name of the PDF file with the plot of the fit
+
+    Returns
+    -------
+    tuple
+        fibid and the SolutionArcCalibration, None if the fit failed
+    """
+    ctx = _fiber_context
+    naxis1 = row.shape[0]
+    wlpol = numpy.polynomial.Polynomial(coeff)
+
+    if pdfname is not None:
+        from matplotlib.backends.backend_pdf import PdfPages
+        plottitle = f'fiber #{fibid:03d}'
+        pdf = PdfPages(pdfname)
+    else:
+        plottitle = None
+        pdf = None
+    poly_refined, yres_summary = \
+        refine_arccalibration(sp=row,
+                              poly_initial=wlpol,
+                              wv_master=ctx['wv_master_all'],
+                              poldeg=ctx['poldeg_refined'],
+                              plottitle=plottitle,
+                              ylogscale=True,
+                              pdf=pdf)
+    if pdf is not None:
+        from numina.array.display.matplotlib_qt import plt
+        plt.close()
+        pdf.close()
+
+    if poly_refined == numpy.polynomial.Polynomial([0.0]):
+        return fibid, None
+
+    # compute approximate linear values
+    crmin1_linear = poly_refined(1)
+    crmax1_linear = poly_refined(naxis1)
+    cdelt1_linear = (crmax1_linear - crmin1_linear) / (naxis1 - 1)
+    cr_linear = CrLinear(
+        crpix=1.0,
+        crval=crmin1_linear,
+        crmin=crmin1_linear,
+        crmax=crmax1_linear,
+        cdelt=cdelt1_linear
+    )
+    solution_wv = SolutionArcCalibration(
+        features=[],  # empty list!
+        coeff=poly_refined.coef,
+        residual_std=yres_summary['robust_std'],
+        cr_linear=cr_linear
+    )
+    solution_wv.npoints_eff = yres_summary['npoints']  # add also this
+    return fibid, solution_wv
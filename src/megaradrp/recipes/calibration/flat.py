@@ -101,6 +101,9 @@ class FiberFlatRecipe(MegaraBaseRecipe):
                                  )
     extraction_offset = Parameter(
         [0.0], 'Offset traces for extraction', accept_scalar=True)
+    wl_resampling = Parameter(
+        'linear', 'Interpolation of the accumulated flux in the wavelength resampling',
+        choices=['linear', 'steffen'])
     master_wlcalib = reqs.WavelengthCalibrationRequirement()
 
     # Results
@@ -217,7 +220,7 @@ class FiberFlatRecipe(MegaraBaseRecipe):
         )
         splitter2 = Splitter()
         calibrator_wl = WavelengthCalibrator(
-            rinput.master_wlcalib, self.datamodel)
+            rinput.master_wlcalib, self.datamodel, resampling=rinput.wl_resampling)
         flipcor = FlipLR()
 
         img = splitter1(img)
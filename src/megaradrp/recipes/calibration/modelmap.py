@@ -10,6 +10,7 @@
 """ Trace model recipe for Megara"""
 
 import multiprocessing as mp
+import time
 
 import numpy as np
 from scipy.interpolate import UnivariateSpline
@@ -24,6 +25,7 @@ from megaradrp.products.modelmap import ModelMap
 from megaradrp.products.modelmap import GeometricModel
 from megaradrp.processing.aperture import ApertureExtractor
 from megaradrp.processing.modelmap import calc1d_model
+from megaradrp.processing.profilefit import calc1d_model_banded
 from megaradrp.processing.modeldesc import config
 from megaradrp.ntypes import ProcessedImage, ProcessedRSS
 from megaradrp.processing.combine import basic_processing_with_combination
@@ -58,10 +60,27 @@ class ModelMapRecipe(MegaraBaseRecipe):
     fiting the profiles of the fibers.
 
     The approximate central position of the fibers is obtained from
-    `master_traces`. Then, for each 100 columns of the reduced image, a vertical
+    `master_traces`. Then, in a sample of columns of the reduced image, a vertical
     cut in the image is fitted to a sum of fiber profiles, being the profile
     a gaussian convolved with a square.
 
+    With `fit_sampling` 'fixed', the columns are fitted every 100 columns.
+    With 'adaptive' (the default), a coarse sample of columns is fitted
+    first. New columns are added where the splines of the parameters
+    have residuals or leave-one-out errors larger than `fit_tolerance`.
+    The fitted columns and the timings of each round are stored in
+    the `model_fit` field of the metadata of `master_model`.
+
+    With `fit_method` 'banded' (the default), the profiles of all the fibers
+    in a column are fitted simultaneously, using the analytic derivatives
+    of the model. With 'astropy', each fiber is fitted in turn together
+    with its neighbours, using astropy models and fitters.
+
+    If `fit_propagate` is True (the default), the columns are fitted
+    outwards from the reference column of `master_traces`, each one
+    starting from the parameters fitted in its neighbour. Otherwise,
+    each column starts from the initial values of the model.
+
     The fits are made in parallel, being the number of processes controlled
     by the parameter `processes`, with the default value of 0 meaning to use
     the number of cores minus 2 if the number of cores is greater or equal to 4,
@@ -87,6 +106,24 @@ class ModelMapRecipe(MegaraBaseRecipe):
     # from the data
     master_traces = reqs.MasterTraceMapRequirement()
     processes = Parameter(0, 'Number of processes used for fitting')
+    fit_method = Parameter(
+        'banded',
+        description='Method used to fit the profiles of the fibers',
+        choices=['banded', 'astropy']
+    )
+    fit_propagate = Parameter(
+        True,
+        'Start the fit of each column from the parameters of its neighbour'
+    )
+    fit_sampling = Parameter(
+        'adaptive',
+        description='Sampling of the fitted columns',
+        choices=['adaptive', 'fixed']
+    )
+    fit_tolerance = Parameter(
+        0.01,
+        'Tolerance of the interpolated profile parameters in adaptive sampling'
+    )
     debug_plot = Parameter(0, 'Save intermediate tracing plots')
     # Results
     reduced_image = Result(ProcessedImage)
@@ -177,10 +214,35 @@ class ModelMapRecipe(MegaraBaseRecipe):
         model_obj = model_class(**model_kwargs)
 
         # Perform fitting with multiprocessing
-        results_get = fit_model(model_obj, data, tracemap, cols,
-                                processes=processes)
+        if rinput.fit_sampling == 'adaptive':
+            # coarse sampling, refined where needed
+            cols = range(100, 4100, 300)
+            results_get, fit_info = fit_model_adaptive(
+                model_obj, data, tracemap, cols, tracemap.ref_column,
+                tol=rinput.fit_tolerance, processes=processes,
+                method=rinput.fit_method, propagate=rinput.fit_propagate
+            )
+        else:
+            t0 = time.perf_counter()
+            if rinput.fit_propagate:
+                results_get = fit_model_propagate(model_obj, data, tracemap, cols,
+                                                  tracemap.ref_column,
+                                                  processes=processes,
+                                                  method=rinput.fit_method)
+            else:
+                results_get = fit_model(model_obj, data, tracemap, cols,
+                                        processes=processes,
+                                        method=rinput.fit_method)
+            fit_info = {
+                'columns': list(cols),
+                'rounds': [{'columns': list(cols),
+                            'time_fit': time.perf_counter() - t0}]
+            }
 
         self.logger.info('perform model fitting end')
+        self.logger.info('fitted %d columns in %d rounds',
+                         len(fit_info['columns']), len(fit_info['rounds']))
+        model_map.meta_info['model_fit'] = fit_info
 
         self.logger.info('interpolate parameters')
 
@@ -190,7 +252,7 @@ class ModelMapRecipe(MegaraBaseRecipe):
         spline_degrees = model_obj.deg_save
 
         # vector of columns where we have performed the fit
-        g_col = np.asarray(cols)
+        g_col = np.asarray([calc_col for calc_col, _ in results_get])
 
         for fibid, boxid in valid_fibers:
             # interpolator of the parameters of a given fiber
@@ -264,7 +326,8 @@ class ModelMapRecipe(MegaraBaseRecipe):
 
 
 def calc_parallel(model_desc, data, calc_col, tracemap,
-                  nloop=10, average=0):
+                  nloop=10, average=0, method='banded',
+                  previous=None, tol=None):
 
     if average > 0:
         column = data[:, calc_col -
@@ -272,9 +335,9 @@ def calc_parallel(model_desc, data, calc_col, tracemap,
     else:
         column = data[:, calc_col]
 
-    valid_fibers = [f.fibid for f in tracemap.contents if f.valid]
-    centers = np.array([f.polynomial(calc_col)
-                       for f in tracemap.contents if f.valid])
+    arrays = tracemap.arrays
+    valid_fibers = arrays.fibid[arrays.valid].tolist()
+    centers = tracemap.centers([calc_col], offset=False)[arrays.valid, 0]
     # we might need a better approach to logging in multiprocessing
     # https://www.jamesfheath.com/2020/06/logging-in-python-while-multiprocessing.html
     print('computing in column', calc_col)
@@ -283,8 +346,23 @@ def calc_parallel(model_desc, data, calc_col, tracemap,
     scale = column.max()
     column_norm = column / scale
 
-    final = calc1d_model(model_desc, column_norm, centers,
-                         valid_fibers, calc_col, lateral=2, nloop=nloop)
+    if previous is None:
+        current = None
+    else:
+        # Start from the parameters fitted in another column
+        current = model_desc.init_values_from(previous, centers, valid_fibers)
+        for params in current.values():
+            params['amplitude'] /= scale
+
+    if method == 'banded':
+        final = calc1d_model_banded(model_desc, column_norm, centers,
+                                    valid_fibers, calc_col, current=current)
+    elif method == 'astropy':
+        final = calc1d_model(model_desc, column_norm, centers,
+                             valid_fibers, calc_col, lateral=2, nloop=nloop,
+                             current=current, tol=tol)
+    else:
+        raise ValueError(f'fit method {method} is undefined')
 
     # TODO: we may need a function to perform scaling in general
     for idx, params in final.items():
@@ -293,15 +371,180 @@ def calc_parallel(model_desc, data, calc_col, tracemap,
     return calc_col, final
 
 
-def fit_model(model_desc, data, tracemap, cols, processes=20):
+def fit_model(model_desc, data, tracemap, cols, processes=20, method='banded',
+              previous=None):
 
-    pool = mp.Pool(processes)
+    if previous is None:
+        previous = [None for _ in cols]
 
-    results = [pool.apply_async(
-        calc_parallel,
-        args=(model_desc, data, col, tracemap),
-        kwds={'nloop': 3, 'average': 2}
-    ) for col in cols]
+    with mp.Pool(processes) as pool:
+        results = [pool.apply_async(
+            calc_parallel,
+            args=(model_desc, data, col, tracemap),
+            kwds={'nloop': 3, 'average': 2, 'method': method,
+                  'previous': prev, 'tol': None if prev is None else 1e-4}
+        ) for col, prev in zip(cols, previous)]
 
-    results_get = [p.get() for p in results]
+        results_get = [p.get() for p in results]
     return results_get
+
+
+def fit_chain(model_desc, data, tracemap, cols, previous=None,
+              method='banded', nloop=3, tol=1e-4):
+    """Fit columns in sequence, each starting from the previous one"""
+    results = []
+    for col in cols:
+        result = calc_parallel(model_desc, data, col, tracemap,
+                               nloop=nloop, average=2, method=method,
+                               previous=previous, tol=tol)
+        results.append(result)
+        previous = result[1]
+    return results
+
+
+def fit_model_propagate(model_desc, data, tracemap, cols, ref_col,
+                        processes=20, method='banded', nloop=3, tol=1e-4):
+    """Fit columns outwards from the reference column.
+
+    The column closest to `ref_col` is fitted from the initial
+    values of the model. Then the columns at each side are fitted
+    in sequence, each one starting from the parameters of its
+    neighbour. Both sides are fitted in parallel if processes > 1.
+    With method 'astropy', the loops over the fibers stop when the
+    parameters change less than `tol`.
+
+    Returns
+    -------
+    list
+        Pairs (column, parameters), sorted by column
+    """
+    cols = sorted(cols)
+    if not cols:
+        return []
+    iref = int(np.argmin(np.abs(np.asarray(cols) - ref_col)))
+
+    ref_result = calc_parallel(model_desc, data, cols[iref], tracemap,
+                               nloop=nloop, average=2, method=method, tol=tol)
+    left = cols[:iref][::-1]
+    right = cols[iref + 1:]
+    chains = [left, right]
+    kwds = {'previous': ref_result[1], 'method': method, 'nloop': nloop, 'tol': tol}
+    if processes > 1 and left and right:
+        with mp.Pool(min(processes, len(chains))) as pool:
+            results = [pool.apply_async(
+                fit_chain, args=(model_desc, data, tracemap, chain), kwds=kwds
+            ) for chain in chains]
+            left_res, right_res = [p.get() for p in results]
+    else:
+        left_res, right_res = [fit_chain(model_desc, data, tracemap, chain, **kwds)
+                               for chain in chains]
+
+    return left_res[::-1] + [ref_result] + right_res
+
+
+def spline_errors(g_col, values, deg):
+    """Residuals and leave-one-out errors of the spline of a parameter.
+
+    The leave-one-out error of each interior column is the difference
+    between the value fitted in the column and the spline computed
+    without it. It is zero in the first and last columns.
+    """
+    g_col = np.asarray(g_col)
+    values = np.asarray(values)
+    spl = UnivariateSpline(g_col, values, k=deg)
+    resid = np.abs(values - spl(g_col))
+    cv_err = np.zeros_like(resid)
+    # the spline needs at least deg + 1 points
+    if len(g_col) > deg + 1:
+        mask = np.ones(len(g_col), dtype='bool')
+        for idx in range(1, len(g_col) - 1):
+            mask[idx] = False
+            spl_cv = UnivariateSpline(g_col[mask], values[mask], k=deg)
+            cv_err[idx] = abs(values[idx] - spl_cv(g_col[idx]))
+            mask[idx] = True
+    return resid, cv_err
+
+
+def sampling_errors(model_desc, results):
+    """Maximum spline error of the parameters of all the fibers in each column"""
+    g_col = [calc_col for calc_col, _ in results]
+    fibids = list(results[0][1])
+    errors = np.zeros(len(g_col))
+    for fibid in fibids:
+        for name, deg in zip(model_desc.params_save, model_desc.deg_save):
+            values = [vals[fibid][name] for _, vals in results]
+            resid, cv_err = spline_errors(g_col, values, deg)
+            errors = np.maximum(errors, np.maximum(resid, cv_err))
+    return errors
+
+
+def refine_columns(cols, errors, tol, min_step=50):
+    """New columns, in the middle of the intervals with errors over tol"""
+    new_cols = []
+    for c1, c2, e1, e2 in zip(cols[:-1], cols[1:], errors[:-1], errors[1:]):
+        if max(e1, e2) > tol and c2 - c1 >= 2 * min_step:
+            new_cols.append((c1 + c2) // 2)
+    return new_cols
+
+
+def fit_model_adaptive(model_desc, data, tracemap, cols, ref_col, tol=0.01,
+                       processes=20, method='banded', propagate=True,
+                       min_step=50, max_rounds=4):
+    """Fit columns, adding columns where the parameters change fastest.
+
+    The columns in `cols` are fitted first. Then, the splines of the
+    parameters of each fiber are computed, and new columns are fitted
+    in the middle of the intervals where the residuals or the
+    leave-one-out errors of the splines are larger than `tol`.
+    The refinement stops when the errors are below `tol`, the intervals
+    are shorter than 2 * `min_step` or after `max_rounds` refinements.
+
+    Returns
+    -------
+    tuple
+        Pairs (column, parameters) sorted by column, and a dictionary
+        with the fitted columns and the columns, maximum error and
+        timings of each round
+    """
+    rounds = []
+    t0 = time.perf_counter()
+    if propagate:
+        results = fit_model_propagate(model_desc, data, tracemap, cols, ref_col,
+                                      processes=processes, method=method)
+    else:
+        results = fit_model(model_desc, data, tracemap, sorted(cols),
+                            processes=processes, method=method)
+    new_cols = sorted(cols)
+
+    for nround in range(max_rounds + 1):
+        t1 = time.perf_counter()
+        g_col = [calc_col for calc_col, _ in results]
+        errors = sampling_errors(model_desc, results)
+        t2 = time.perf_counter()
+        rounds.append({
+            'columns': [int(col) for col in new_cols],
+            'max_error': float(errors.max()),
+            'time_fit': t1 - t0,
+            'time_eval': t2 - t1
+        })
+        if nround == max_rounds:
+            break
+        new_cols = refine_columns(g_col, errors, tol, min_step=min_step)
+        if not new_cols:
+            break
+        t0 = time.perf_counter()
+        if propagate:
+            # start from the nearest fitted column
+            previous = [results[np.searchsorted(g_col, col)][1] for col in new_cols]
+        else:
+            previous = None
+        new_results = fit_model(model_desc, data, tracemap, new_cols,
+                                processes=processes, method=method,
+                                previous=previous)
+        results = sorted(results + new_results, key=lambda r: r[0])
+
+    info = {
+        'columns': [int(calc_col) for calc_col, _ in results],
+        'rounds': rounds
+    }
+    return results, info
@@ -11,6 +11,8 @@
 
 
 import logging
+import multiprocessing as mp
+from multiprocessing import shared_memory
 import warnings
 
 import matplotlib.pyplot as plt
@@ -29,7 +31,7 @@ import scipy.signal
 from skimage.feature import peak_local_max
 from skimage.filters import threshold_otsu
 
-from megaradrp.processing.aperture import ApertureExtractor
+from megaradrp.processing.aperture import ApertureExtractor, calc_profile_shift
 from megaradrp.processing.combine import basic_processing_with_combination
 from megaradrp.products import TraceMap
 from megaradrp.products.tracemap import GeometricTrace
@@ -88,7 +90,19 @@ class TraceMapRecipe(MegaraBaseRecipe):
 
     The Y position of the trace is fitted to a polynomial
     of degree `polynomial_degree`. The coefficients of the polynomial are
-    stored in the final `master_traces` object.
+    stored in the final `master_traces` object. The fibers are traced
+    in parallel, being the number of processes controlled by the parameter
+    `processes`, with the default value of 0 meaning to use all the
+    available cores minus 2.
+
+    If `retrace` is True, the traces in `previous_traces` are updated
+    instead. The shift of each box of fibers is measured by
+    cross-correlation of the profile of the image in a few columns
+    with the profile predicted by the traces. A polynomial in the
+    position of the boxes is added to the global offset of the traces,
+    and the rest of the shift of each box to the traces of the box.
+    If the shifts of a box vary between columns more than
+    `retrace_tolerance`, all the fibers are traced.
 
     """
     method = Parameter(
@@ -110,6 +124,10 @@ class TraceMapRecipe(MegaraBaseRecipe):
     reference_column = Parameter(2000, 'Column used to search for peaks')
     reference_column_hw = Parameter(5, 'Half-width (w = 2 * hw + 1) of the region used to search for peaks ')
     debug_plot = Parameter(0, 'Save intermediate tracing plots')
+    processes = Parameter(0, 'Number of processes used for tracing')
+    previous_traces = reqs.MasterTraceMapRequirement(optional=True)
+    retrace = Parameter(False, 'Update previous_traces instead of tracing all the fibers')
+    retrace_tolerance = Parameter(0.2, 'Maximum residual of the shifts in retrace, in pixels')
 
     reduced_image = Result(ProcessedImage)
     reduced_rss = Result(ProcessedRSS)
@@ -187,6 +205,16 @@ class TraceMapRecipe(MegaraBaseRecipe):
 
         debug_plot = rinput.debug_plot if self.intermediate_results else 0
 
+        if rinput.processes == 0:
+            have = mp.cpu_count()
+            if have >= 4:
+                processes = mp.cpu_count() - 2
+            else:
+                processes = 1
+        else:
+            processes = rinput.processes
+        self.logger.debug('using %d processes', processes)
+
         self.logger.info('start basic reduction')
         flow = self.init_filters(rinput, obresult.configuration)
         fmethod = getattr(combine, rinput.method)
@@ -263,20 +291,39 @@ class TraceMapRecipe(MegaraBaseRecipe):
         final.tags['temp'] = round(
             obresult_meta['info'][0]['temp'] - 273.15, 2)
 
-        self.logger.info('START search traces')
-        contents, error_fitting, missing_fibers = self.search_traces(
-            reduced, boxes, box_borders,
-            inactive_fibers=inactive_fibers,
-            cstart=cstart, step=step, hs=hs,
-            threshold=threshold,
-            poldeg=rinput.polynomial_degree,
-            debug_plot=debug_plot
-        )
-        self.logger.info('END search traces')
+        retraced = None
+        if rinput.retrace:
+            if rinput.previous_traces is None:
+                self.logger.warning('retrace requires previous_traces, tracing all fibers')
+            else:
+                self.logger.info('START retrace')
+                retraced = self.update_traces(reduced[0].data, rinput.previous_traces, hs=hs,
+                                              tolerance=rinput.retrace_tolerance)
+                self.logger.info('END retrace')
+
+        if retraced is not None:
+            previous = rinput.previous_traces
+            final.contents, final.global_offset = retraced
+            final.error_fitting = list(previous.error_fitting)
+            final.missing_fibers = list(previous.missing_fibers)
+            final.ref_column = previous.ref_column
+            final.expected_range = previous.expected_range
+        else:
+            self.logger.info('START search traces')
+            contents, error_fitting, missing_fibers = self.search_traces(
+                reduced, boxes, box_borders,
+                inactive_fibers=inactive_fibers,
+                cstart=cstart, step=step, hs=hs,
+                threshold=threshold,
+                poldeg=rinput.polynomial_degree,
+                debug_plot=debug_plot,
+                processes=processes
+            )
+            self.logger.info('END search traces')
 
-        final.contents = contents
-        final.error_fitting = error_fitting
-        final.missing_fibers = missing_fibers
+            final.contents = contents
+            final.error_fitting = error_fitting
+            final.missing_fibers = missing_fibers
         # Perform extraction with own traces
         calibrator_aper = ApertureExtractor(final, self.datamodel)
         reduced_copy = copy_img(reduced)
@@ -296,8 +343,32 @@ class TraceMapRecipe(MegaraBaseRecipe):
                                   reduced_rss=reduced_rss,
                                   master_traces=final)
 
+    def update_traces(self, data, previous, hs=3, tolerance=0.2, ncolumns=5):
+        """Update the traces of a previous TraceMap by cross-correlation.
+
+        Returns
+        -------
+        tuple or None
+            Traces and global offset, None if the residuals of
+            the shifts are larger than `tolerance`
+        """
+        xx_start, xx_end = previous.expected_range
+        columns = numpy.linspace(xx_start + 2 * hs, xx_end - 2 * hs, ncolumns).astype('int')
+        self.logger.info('measure shifts in columns %s', columns.tolist())
+        contents, global_offset, residual = retrace_tracemap(
+            data, previous, columns, hs=hs
+        )
+        if residual > tolerance:
+            self.logger.warning('residual of retrace is %f, larger than %f, tracing all fibers',
+                                residual, tolerance)
+            return None
+        self.logger.info('residual of retrace is %f', residual)
+        self.logger.info('global offset is %s', global_offset.coef.tolist())
+        return contents, global_offset
+
     def search_traces(self, reduced, boxes, box_borders, inactive_fibers=None, cstart=2000,
-                      threshold=0.3, poldeg=5, step=2, hs=3, tol=1.5, debug_plot=0):
+                      threshold=0.3, poldeg=5, step=2, hs=3, tol=1.5, debug_plot=0,
+                      processes=1):
 
         data = reduced[0].data
         if inactive_fibers is None:
@@ -331,16 +402,33 @@ class TraceMapRecipe(MegaraBaseRecipe):
             image2 = data
 
         maxdis = 2.0
+        # FIXME, for traces, the background must be local
+        # the background in the center is not always good
+        local_trace_background = 300  # background
+
+        if processes > 1 and debug_plot:
+            self.logger.info('debug plots require serial processing, using 1 process')
+            processes = 1
+
+        tasks = []
+        for dtrace in central_peaks:
+            conf_ok = dtrace.fibid not in inactive_fibers
+            peak_ok = dtrace.start is not None
+            if peak_ok and conf_ok:
+                tasks.append((dtrace.fibid, dtrace.start[1]))
+
+        self.logger.info('trace peaks from references, using %d processes', processes)
+        traced = trace_fibers(
+            image2, tasks, processes=processes, x=cstart, step=step, hs=hs,
+            background=local_trace_background, maxdis=maxdis, poldeg=poldeg,
+            debug_plot=debug_plot
+        )
+        traced = {result[0]: result for result in traced}
 
         contents = []
         error_fitting = []
         missing_fibers = []
-        self.logger.info('trace peaks from references')
         for dtrace in central_peaks:
-            # FIXME, for traces, the background must be local
-            # the background in the center is not always good
-            local_trace_background = 300  # background
-
             self.logger.debug('trace fiber %d', dtrace.fibid)
             conf_ok = dtrace.fibid not in inactive_fibers
             peak_ok = dtrace.start is not None
@@ -355,31 +443,9 @@ class TraceMapRecipe(MegaraBaseRecipe):
                     self.logger.warning(
                         'found fibid %d, expected to be missing', dtrace.fibid)
                 else:
-                    self.logger.debug(f'start tracing from col={cstart} with {step=}')
-                    mm = trace_func(image2, x=cstart, y=dtrace.start[1], step=step,
-                                    hs=hs, background=local_trace_background, maxdis=maxdis)
-
-                    if debug_plot:
-                        self.logger.debug('plotting x-y and x-z trace')
-                        plt.plot(mm[:, 0], mm[:, 1], '.')
-                        plt.savefig(f'trace-xy-{dtrace.fibid:03d}.png')
-                        plt.close()
-                        plt.plot(mm[:, 0], mm[:, 2], '.')
-                        plt.savefig(f'trace-xz-{dtrace.fibid:03d}.png')
-                        plt.close()
-                    if len(mm) < poldeg + 1:
-                        self.logger.warning('in fibid %d, only %d points to fit pol of degree %d',
-                                            dtrace.fibid, len(mm), poldeg)
-                        pfit = numpy.array([])
-                    else:
-                        self.logger.debug(f'fit polynomial with degree {poldeg=}')
-                        pfit = nppol.polyfit(mm[:, 0], mm[:, 1], deg=poldeg)
-                        self.logger.debug(f'polynomial is {pfit=}')
-
-                    start = mm[0, 0]
-                    stop = mm[-1, 0]
-                    self.logger.debug(
-                        f'trace limits {start=} {stop=}')
+                    _, pfit, start, stop, messages = traced[dtrace.fibid]
+                    for level, msg in messages:
+                        self.logger.log(level, msg)
             else:
                 if conf_ok:
                     self.logger.warning('error tracing fibid %d', dtrace.fibid)
@@ -402,6 +468,224 @@ class TraceMapRecipe(MegaraBaseRecipe):
         return contents, error_fitting, missing_fibers
 
 
+# Image traced by the worker processes
+_trace_image = None
+_trace_shm = None
+
+
+def _init_trace_worker(name, shape, dtype):
+    """Attach a worker process to the shared image"""
+    global _trace_image, _trace_shm
+    _trace_shm = shared_memory.SharedMemory(name=name)
+    # the tracing does not modify the image, but it
+    # does not accept read-only buffers
+    _trace_image = numpy.ndarray(shape, dtype=dtype, buffer=_trace_shm.buf)
+
+
+def trace_fibers(image, tasks, processes=1, **kwds):
+    """Trace fibers from their position in the reference column.
+
+    With more than one process, the image is copied once to
+    shared memory, and read from there by the workers.
+
+    Parameters
+    ----------
+    image : numpy.ndarray
+        Image with native byte order
+    tasks : list of tuple
+        Fiber id and row of the peak in the reference column
+    processes : int
+    kwds
+        Other arguments of trace_fiber
+
+    Returns
+    -------
+    list
+        Results of trace_fiber, in the order of the tasks
+    """
+    global _trace_image
+    tasks = [(fibid, y0, kwds) for fibid, y0 in tasks]
+    if processes > 1 and len(tasks) > 1:
+        shm = shared_memory.SharedMemory(create=True, size=max(image.nbytes, 1))
+        try:
+            shared = numpy.ndarray(image.shape, dtype=image.dtype, buffer=shm.buf)
+            shared[...] = image
+            with mp.Pool(min(processes, len(tasks)), initializer=_init_trace_worker,
+                         initargs=(shm.name, image.shape, image.dtype)) as pool:
+                results = pool.starmap(_trace_fiber_task, tasks)
+            del shared
+        finally:
+            shm.close()
+            shm.unlink()
+        return results
+    else:
+        _trace_image = image
+        try:
+            return [_trace_fiber_task(*task) for task in tasks]
+        finally:
+            _trace_image = None
+
+
+def _trace_fiber_task(fibid, y0, kwds):
+    return trace_fiber(_trace_image, fibid, y0, **kwds)
+
+
+def trace_fiber(image, fibid, y0, x=2000, step=2, hs=3, background=300, maxdis=2.0,
+                poldeg=5, debug_plot=0):
+    """Trace a fiber and fit a polynomial to its center.
+
+    Parameters
+    ----------
+    image : numpy.ndarray
+    fibid : int
+    y0 : float
+        Row of the peak of the fiber in column `x`
+    x : int
+        Reference column
+    step, hs, background, maxdis
+        Arguments of numina.array.trace.traces.trace
+    poldeg : int
+        Degree of the polynomial
+    debug_plot : int
+
+    Returns
+    -------
+    tuple
+        fibid, coefficients of the polynomial (empty if the fit
+        is not possible), first and last traced columns and the
+        log messages, as (level, message) pairs
+    """
+    messages = []
+    messages.append((logging.DEBUG, f'start tracing from col={x} with {step=}'))
+    mm = trace_func(image, x=x, y=y0, step=step,
+                    hs=hs, background=background, maxdis=maxdis)
+
+    if debug_plot:
+        messages.append((logging.DEBUG, 'plotting x-y and x-z trace'))
+        plt.plot(mm[:, 0], mm[:, 1], '.')
+        plt.savefig(f'trace-xy-{fibid:03d}.png')
+        plt.close()
+        plt.plot(mm[:, 0], mm[:, 2], '.')
+        plt.savefig(f'trace-xz-{fibid:03d}.png')
+        plt.close()
+    if len(mm) < poldeg + 1:
+        messages.append((logging.WARNING,
+                         f'in fibid {fibid}, only {len(mm)} points to fit pol of degree {poldeg}'))
+        pfit = numpy.array([])
+    else:
+        messages.append((logging.DEBUG, f'fit polynomial with degree {poldeg=}'))
+        pfit = nppol.polyfit(mm[:, 0], mm[:, 1], deg=poldeg)
+        messages.append((logging.DEBUG, f'polynomial is {pfit=}'))
+
+    start = mm[0, 0]
+    stop = mm[-1, 0]
+    messages.append((logging.DEBUG, f'trace limits {start=} {stop=}'))
+    return fibid, pfit, start, stop, messages
+
+
+def measure_trace_shifts(data, tracemap, columns, hs=3, nsearch=10, sigma=1.5):
+    """Shifts of the boxes of a TraceMap with respect to an image.
+
+    Parameters
+    ----------
+    data : numpy.ndarray
+        Image
+    tracemap : megaradrp.products.TraceMap
+    columns : list of int
+        Columns where the shifts are measured
+    hs : int
+        The profile is the mean of 2 * hs + 1 columns
+    nsearch : int
+        Maximum shift, in pixels
+    sigma : float
+        Width of the fiber profile
+
+    Returns
+    -------
+    tuple
+        Box ids (nbox,), mean row of each box in the reference
+        column, without offset (nbox,), and the shifts (nbox, ncol),
+        nan where the correlation fails
+    """
+    arrays = tracemap.arrays
+    valid = arrays.valid
+    boxids = numpy.unique(arrays.boxid[valid])
+    y_ref = tracemap.centers([tracemap.ref_column], offset=False)[:, 0]
+    all_centers = tracemap.centers(columns)
+    y_box = numpy.zeros(len(boxids))
+    shifts = numpy.full((len(boxids), len(columns)), numpy.nan)
+    for jdx, col in enumerate(columns):
+        profile = data[:, col - hs:col + hs + 1].mean(axis=1)
+        for idx, boxid in enumerate(boxids):
+            mask = valid & (arrays.boxid == boxid) & (arrays.start <= col) & (col <= arrays.stop)
+            if not numpy.any(mask):
+                continue
+            y_box[idx] = y_ref[mask].mean()
+            centers = all_centers[mask, jdx]
+            shift = calc_profile_shift(profile, centers, nsearch=nsearch, sigma=sigma)
+            if shift is not None:
+                shifts[idx, jdx] = shift
+    return boxids, y_box, shifts
+
+
+def retrace_tracemap(data, tracemap, columns, hs=3, nsearch=10, sigma=1.5, deg=1):
+    """Update the traces of a TraceMap with the shifts measured in an image.
+
+    The mean shift of each box is fitted to a polynomial of degree `deg`
+    in the row of the box in the reference column, which is added to the
+    global offset of the TraceMap. The difference between the shift of
+    each box and the polynomial is added to the traces of the box. The
+    residual is the maximum difference between the shift of a box in a
+    column and its mean shift.
+
+    Parameters
+    ----------
+    data : numpy.ndarray
+        Image
+    tracemap : megaradrp.products.TraceMap
+    columns : list of int
+        Columns where the shifts are measured
+    hs, nsearch, sigma
+        Arguments of measure_trace_shifts
+    deg : int
+        Degree of the polynomial of the global offset
+
+    Returns
+    -------
+    tuple
+        Traces, global offset and residual in pixels, which is
+        infinite if the shift is not measured in some box
+    """
+    boxids, y_box, shifts = measure_trace_shifts(
+        data, tracemap, columns, hs=hs, nsearch=nsearch, sigma=sigma
+    )
+    if len(boxids) == 0 or numpy.any(numpy.isnan(shifts)):
+        return None, None, numpy.inf
+
+    box_shift = shifts.mean(axis=1)
+    residual = numpy.abs(shifts - box_shift[:, numpy.newaxis]).max()
+    deg = min(deg, len(boxids) - 1)
+    offset = nppol.Polynomial.fit(y_box, box_shift, deg=deg).convert()
+    box_corr = dict(zip(boxids, box_shift - offset(y_box)))
+
+    contents = []
+    for trace in tracemap.contents:
+        fitparms = list(trace.fitparms)
+        if trace.valid:
+            fitparms[0] += box_corr[trace.boxid]
+        contents.append(
+            GeometricTrace(
+                fibid=trace.fibid,
+                boxid=trace.boxid,
+                start=trace.start,
+                stop=trace.stop,
+                fitparms=fitparms
+            )
+        )
+    global_offset = tracemap.global_offset + offset
+    return contents, global_offset, residual
+
+
 def estimate_background(image, center, hs, boxref):
     """Estimate background from values in boxes between fibers"""
 
@@ -62,6 +62,9 @@ class RecipeInput(recipeio.RecipeInput):
                                  validator=pixel_2d_check)
     continuum_region = Parameter([1900, 1900], 'Subtract this region before normalize the flat-field',
                                  validator=pixel_2d_check_or_none)
+    wl_resampling = Parameter(
+        'linear', 'Interpolation of the accumulated flux in the wavelength resampling',
+        choices=['linear', 'steffen'])
     master_wlcalib = reqs.WavelengthCalibrationRequirement()
     master_fiberflat = reqs.MasterFiberFlatRequirement()
 
@@ -122,13 +125,14 @@ class TwilightFiberFlatRecipe(MegaraBaseRecipe):
         self.set_base_headers(hdr)
         return final_image
 
-    def run_reduction_1d(self, img, tracemap, wlcalib, fiberflat, offset=None):
+    def run_reduction_1d(self, img, tracemap, wlcalib, fiberflat, offset=None,
+                         resampling='linear'):
         # 1D, extraction, Wl calibration, Flat fielding
         correctors = []
         correctors.append(ApertureExtractor(
             tracemap, self.datamodel, offset=offset))
         correctors.append(FlipLR())
-        correctors.append(WavelengthCalibrator(wlcalib, self.datamodel))
+        correctors.append(WavelengthCalibrator(wlcalib, self.datamodel, resampling=resampling))
         correctors.append(FiberFlatCorrector(fiberflat.open(), self.datamodel))
 
         flow_1d = SerialFlow(correctors)
@@ -150,7 +154,8 @@ class TwilightFiberFlatRecipe(MegaraBaseRecipe):
                                             rinput.master_apertures,
                                             rinput.master_wlcalib,
                                             rinput.master_fiberflat,
-                                            offset=rinput.extraction_offset
+                                            offset=rinput.extraction_offset,
+                                            resampling=rinput.wl_resampling
                                             )
 
         self.save_intermediate_img(reduced_rss, 'reduced_rss.fits')
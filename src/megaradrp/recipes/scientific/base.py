@@ -23,6 +23,7 @@ from megaradrp.processing.combine import basic_processing_with_combination
 from megaradrp.processing.aperture import ApertureExtractor
 from megaradrp.processing.wavecalibration import WavelengthCalibrator
 from megaradrp.processing.fiberflat import FlipLR, FiberFlatCorrector
+from megaradrp.processing.fused import FusedRSSCalibrator
 from megaradrp.processing.twilight import TwilightCorrector
 from megaradrp.processing.extractobj import compute_centroid, compute_dar
 from megaradrp.processing.sky import subtract_sky, subtract_sky_rss
@@ -61,6 +62,13 @@ class ImageRecipe(MegaraBaseRecipe):
     relative_threshold = Parameter(0.3, 'Threshold for peak detection')
     diffuse_light_image = reqs.DiffuseLightRequirement()
     crmasks = reqs.CRMasksRequirement(optional=True)
+    fused_reduction = Parameter(
+        False, 'Reduce to RSS with a single operator, requires a trace map')
+    auto_extraction_offset = Parameter(
+        False, 'Measure the extraction offset in each frame, added to extraction_offset')
+    wl_resampling = Parameter(
+        'linear', 'Interpolation of the accumulated flux in the wavelength resampling',
+        choices=['linear', 'steffen'])
 
     def base_run(self, rinput):
 
@@ -84,23 +92,40 @@ class ImageRecipe(MegaraBaseRecipe):
         reduced_rss = self.run_reduction_1d(img,
                                             rinput.master_apertures, rinput.master_wlcalib,
                                             rinput.master_fiberflat, rinput.master_twilight,
-                                            offset=rinput.extraction_offset
+                                            offset=rinput.extraction_offset,
+                                            fused=rinput.fused_reduction,
+                                            auto_offset=rinput.auto_extraction_offset,
+                                            resampling=rinput.wl_resampling
                                             )
         self.save_intermediate_img(reduced_rss, 'reduced_rss.fits')
 
         return reduced2d, reduced_rss
 
-    def run_reduction_1d(self, img, tracemap, wlcalib, fiberflat, twflat=None, offset=None):
+    def run_reduction_1d(self, img, tracemap, wlcalib, fiberflat, twflat=None, offset=None,
+                         fused=False, auto_offset=False, resampling='linear'):
         # 1D, extraction, Wl calibration, Flat fielding
-        correctors = []
-        correctors.append(ApertureExtractor(
-            tracemap, self.datamodel, offset=offset))
-        correctors.append(FlipLR())
-        correctors.append(WavelengthCalibrator(wlcalib, self.datamodel))
-        correctors.append(FiberFlatCorrector(fiberflat.open(), self.datamodel))
+        extractor = ApertureExtractor(tracemap, self.datamodel, offset=offset,
+                                      auto_offset=auto_offset)
+        wlcalibrator = WavelengthCalibrator(wlcalib, self.datamodel, resampling=resampling)
+        flat_correctors = [FiberFlatCorrector(fiberflat.open(), self.datamodel)]
 
         if twflat:
-            correctors.append(TwilightCorrector(twflat.open(), self.datamodel))
+            flat_correctors.append(TwilightCorrector(twflat.open(), self.datamodel))
+
+        if fused and extractor.method_name != 'simple':
+            self.logger.warning('fused reduction requires a trace map, using the chain of steps')
+            fused = False
+
+        if fused and resampling != 'linear':
+            self.logger.warning('fused reduction requires linear resampling, using the chain of steps')
+            fused = False
+
+        if fused:
+            self.logger.debug('fused reduction to RSS')
+            correctors = [FusedRSSCalibrator(extractor, wlcalibrator, flat_correctors,
+                                             self.datamodel)]
+        else:
+            correctors = [extractor, FlipLR(), wlcalibrator] + flat_correctors
 
         flow2 = SerialFlow(correctors)
 
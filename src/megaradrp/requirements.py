@@ -77,11 +77,12 @@ class MasterTwilightRequirement(Requirement):
 
 
 class MasterTraceMapRequirement(Requirement):
-    def __init__(self):
+    def __init__(self, optional=False):
         super(MasterTraceMapRequirement, self).__init__(
             megaradrp.products.TraceMap,
             'Trace information of the Apertures',
-            validation=True
+            validation=True,
+            optional=optional
         )
 
 
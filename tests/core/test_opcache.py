@@ -0,0 +1,42 @@
+import numpy
+import pytest
+
+from megaradrp.core.opcache import ArrayCache, cache_key
+
+
+def test_cache_key():
+    k1 = cache_key('modelmap', 'uuid', numpy.array([0.0, 1.0]), [4112, 4096])
+    k2 = cache_key('modelmap', 'uuid', [0.0, 1.0], [4112, 4096])
+    k3 = cache_key('modelmap', 'uuid', [0.0, 1.5], [4112, 4096])
+    assert k1 == k2
+    assert k1 != k3
+
+
+def test_cache_save_load(tmp_path):
+    cache = ArrayCache(tmp_path)
+    assert cache.load('test', 'key') is None
+    arrays = {'a': numpy.arange(10.0), 'b': numpy.ones((3, 4), dtype='int32')}
+    cache.save('test', 'key', arrays)
+    # saving again does not fail
+    cache.save('test', 'key', arrays)
+    result = cache.load('test', 'key')
+    assert sorted(result) == ['a', 'b']
+    for name in arrays:
+        assert isinstance(result[name], numpy.memmap)
+        assert numpy.all(result[name] == arrays[name])
+        assert result[name].dtype == arrays[name].dtype
+
+
+@pytest.mark.parametrize('value', [None, ''])
+def test_cache_from_environ_disabled(monkeypatch, value):
+    if value is None:
+        monkeypatch.delenv('MEGARADRP_CACHE_DIR', raising=False)
+    else:
+        monkeypatch.setenv('MEGARADRP_CACHE_DIR', value)
+    assert ArrayCache.from_environ() is None
+
+
+def test_cache_from_environ(monkeypatch, tmp_path):
+    monkeypatch.setenv('MEGARADRP_CACHE_DIR', str(tmp_path))
+    cache = ArrayCache.from_environ()
+    assert cache.path == tmp_path
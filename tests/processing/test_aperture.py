@@ -0,0 +1,218 @@
+import numpy
+import numpy.polynomial.polynomial as nppol
+import numina.array.trace.extract as extract
+import pytest
+import astropy.io.fits as fits
+
+from megaradrp.processing.aperture import apextract_tracemap, calc_borders
+from megaradrp.processing.aperture import calc_extraction_pixels, extract_pixels
+from megaradrp.processing.aperture import ApertureExtractor
+from megaradrp.products.tracemap import TraceMap, GeometricTrace
+
+
+def create_tracemap(missing=()):
+    tracemap = TraceMap()
+    tracemap.total_fibers = 30
+    tracemap.ref_column = 50
+    for fibid in range(1, 31):
+        boxid = (fibid - 1) // 10
+        if fibid in missing:
+            fitparms = []
+        else:
+            fitparms = [5 + 6.0 * fibid + 3 * boxid, 0.01]
+        tracemap.contents.append(GeometricTrace(fibid, boxid, 4, 96, fitparms=fitparms))
+    return tracemap
+
+
+def test_calc_borders():
+    tracemap = create_tracemap(missing=[1, 5, 27, 28, 29])
+    xx = numpy.arange(100)
+    fibids, bb1, bb2 = calc_borders(tracemap, xx)
+    # the neighbours of fiber 30 are far away
+    assert 30 not in fibids
+    assert 1 not in fibids
+    assert 2 in fibids
+
+    def center(fibid):
+        boxid = (fibid - 1) // 10
+        return 5 + 6.0 * fibid + 3 * boxid + 0.01 * xx
+
+    def border(fibid):
+        return bb1[fibids == fibid][0], bb2[fibids == fibid][0]
+
+    # contiguous fibers
+    b1, b2 = border(3)
+    assert numpy.allclose(b1, center(3) - 3)
+    assert numpy.allclose(b2, center(3) + 3)
+    # one fiber missing between 4 and 6
+    b1, b2 = border(4)
+    assert numpy.allclose(b2, center(4) + 0.25 * (center(6) - center(4)))
+    # last fiber of a box, the change of box counts as a missing fiber
+    b1, b2 = border(10)
+    assert numpy.allclose(b1, center(10) - 3)
+    assert numpy.allclose(b2, center(10) + 0.25 * (center(11) - center(10)))
+    # last fiber, reflected
+    b1, b2 = border(26)
+    assert numpy.allclose(b1, center(26) - 3)
+    assert numpy.allclose(b2, center(26) + 3)
+
+
+def test_calc_borders_offset():
+    tracemap = create_tracemap()
+    xx = numpy.arange(100)
+    _, bb1, bb2 = calc_borders(tracemap, xx)
+    tracemap.global_offset = nppol.Polynomial([0.7])
+    _, cc1, cc2 = calc_borders(tracemap, xx)
+    assert numpy.allclose(cc1, bb1 + 0.7)
+    assert numpy.allclose(cc2, bb2 + 0.7)
+
+
+@pytest.mark.parametrize("dtype", ["float32", ">f4", "float64"])
+def test_extract_pixels(dtype):
+    rng = numpy.random.default_rng(seed=9)
+    arr = rng.uniform(size=(60, 60)).astype(dtype)
+    xx = numpy.arange(60)
+    bb1 = numpy.array([-3.0, 4.3, 10.5, 30.6, 55.2])[:, numpy.newaxis] + 0.02 * xx
+    bb2 = numpy.array([2.2, 4.4, 16.5, 35.0, 62.0])[:, numpy.newaxis] + 0.02 * xx
+    fibids = numpy.arange(1, 6)
+    pixels = calc_extraction_pixels(fibids, bb1, bb2, arr.shape[0])
+    out = extract_pixels(arr, pixels)
+
+    arr2 = arr.astype('float64')
+    for idx in range(5):
+        b1 = numpy.maximum(bb1[idx], -0.5)
+        b2 = numpy.minimum(bb2[idx], arr.shape[0] - 0.5)
+        expected = numpy.zeros(60)
+        extract.extract_simple_intl(arr2, xx, b1, b2, expected)
+        assert numpy.allclose(out[idx], expected)
+
+
+def test_apextract_tracemap_flux():
+    tracemap = create_tracemap(missing=[12])
+    arr = numpy.ones((200, 100))
+    rss = apextract_tracemap(arr, tracemap)
+    assert rss.shape == (30, 100)
+    assert numpy.allclose(rss[2], 6.0)
+    assert numpy.all(rss[11] == 0)
+
+
+def test_extractor_pixels():
+    tracemap = create_tracemap()
+    extractor = ApertureExtractor(tracemap)
+    pixels1 = extractor.calc_pixels((200, 100))
+    assert extractor.calc_pixels((200, 100)) is pixels1
+    tracemap.global_offset = nppol.Polynomial([1.0])
+    pixels2 = extractor.calc_pixels((200, 100))
+    assert pixels2 is not pixels1
+    assert numpy.all(pixels2[1] >= pixels1[1])
+
+
+def create_image(data):
+    fibers = fits.ImageHDU(name='FIBERS')
+    return fits.HDUList([fits.PrimaryHDU(data), fibers])
+
+
+def test_extractor_stack():
+    tracemap = create_tracemap(missing=[12])
+    extractor = ApertureExtractor(tracemap)
+    rng = numpy.random.default_rng(seed=10)
+    stack = rng.uniform(size=(3, 200, 100))
+    rss = extractor.run_stack(stack)
+    assert rss.shape == (3, 30, 100)
+    for frame, frame_rss in zip(stack, rss):
+        assert numpy.allclose(apextract_tracemap(frame, tracemap), frame_rss)
+
+    imgs = extractor.run_stack([create_image(frame) for frame in stack])
+    assert len(imgs) == 3
+    for img, frame_rss in zip(imgs, rss):
+        assert numpy.allclose(img[0].data, frame_rss)
+        assert img[0].header['NUM-APE'] == tracemap.uuid
+        assert img['FIBERS'].header['FIB012_V'] is False
+    assert extractor.run_stack([]) == []
+
+
+def test_extractor_loaded_tracemap():
+    tracemap = create_tracemap(missing=[12])
+    loaded = TraceMap()
+    loaded.__setstate__(tracemap.__getstate__())
+    data = numpy.random.default_rng(seed=11).uniform(size=(200, 100))
+    img = ApertureExtractor(loaded).run(create_image(data))
+    # the traces are not built
+    assert loaded._contents is None
+    expected = ApertureExtractor(tracemap).run(create_image(data))
+    assert numpy.allclose(img[0].data, expected[0].data)
+    assert img['FIBERS'].header == expected['FIBERS'].header
+    assert img['FIBERS'].header['FIB012_V'] is False
+    assert img['FIBERS'].header['FIB001S2'] == 96
+
+
+def test_calc_extraction_operator():
+    from megaradrp.processing.aperture import calc_extraction_operator
+
+    rng = numpy.random.default_rng(seed=10)
+    arr = rng.uniform(size=(60, 40))
+    xx = numpy.arange(40)
+    # apertures inside one pixel, empty and outside the image
+    bb1 = numpy.array([-3.0, 4.3, 10.5, 30.6, 55.2, 20.1])[:, numpy.newaxis] + 0.02 * xx
+    bb2 = numpy.array([2.2, 4.4, 16.5, 35.0, 62.0, 20.0])[:, numpy.newaxis] + 0.02 * xx
+    fibids = numpy.array([1, 2, 3, 5, 6, 7])
+    pixels = calc_extraction_pixels(fibids, bb1, bb2, arr.shape[0])
+    expected = extract_pixels(arr, pixels, out=numpy.zeros((8, 40)))
+    operator = calc_extraction_operator(pixels, arr.shape, 8, block=4)
+    assert operator.shape == (8 * 40, 60 * 40)
+    result = (operator @ arr.ravel()).reshape(8, 40)
+    assert numpy.allclose(result, expected, rtol=0, atol=1e-12)
+
+
+def test_calc_profile_shift():
+    from megaradrp.processing.aperture import calc_profile_shift
+
+    rows = numpy.arange(200)
+    centers = numpy.array([50.0, 55.0, 60.0, 65.0])
+    for true_shift in [-3.3, 0.0, 0.42, 6.71]:
+        profile = numpy.exp(-0.5 * ((rows - centers[:, None] - true_shift) / 1.5) ** 2).sum(axis=0)
+        shift = calc_profile_shift(profile, centers, nsearch=10)
+        assert abs(shift - true_shift) < 0.02
+    # out of the search range
+    centers = numpy.array([50.0])
+    profile = numpy.exp(-0.5 * ((rows - 56.0) / 1.5) ** 2)
+    assert calc_profile_shift(profile, centers, nsearch=3) is None
+
+
+def create_fibers_image(tracemap, offset, shape=(200, 100), sigma=1.5):
+    yy, xx = numpy.mgrid[0:shape[0], 0:shape[1]]
+    data = numpy.full(shape, 10.0)
+    for trace in tracemap.contents:
+        if trace.valid:
+            center = trace.polynomial(xx) + offset
+            data += 100 * numpy.exp(-0.5 * ((yy - center) / sigma) ** 2)
+    return data
+
+
+def test_estimate_extraction_offset():
+    from megaradrp.processing.aperture import estimate_extraction_offset
+
+    tracemap = create_tracemap(missing=[5, 12])
+    data = create_fibers_image(tracemap, 1.3)
+    offset = estimate_extraction_offset(data, tracemap, hw=3)
+    assert abs(offset - 1.3) < 0.02
+
+    # relative to the global offset of the apertures
+    tracemap.global_offset = nppol.Polynomial([0.5])
+    offset = estimate_extraction_offset(data, tracemap, hw=3)
+    assert abs(offset - 0.8) < 0.02
+
+
+def test_extractor_auto_offset():
+    tracemap = create_tracemap()
+    extractor = ApertureExtractor(tracemap, offset=[0.2], auto_offset=True)
+    for true_offset in [0.9, -0.4]:
+        data = create_fibers_image(tracemap, true_offset)
+        img = extractor.run(create_image(data))
+        measured = img[0].header['APE-OFF']
+        assert abs(measured - (true_offset - 0.2)) < 0.02
+        assert numpy.allclose(tracemap.global_offset.coef, [0.2 + measured])
+
+        reference = ApertureExtractor(create_tracemap(), offset=[true_offset])
+        expected = reference.run(create_image(data))
+        assert numpy.allclose(img[0].data, expected[0].data, rtol=1e-2)
@@ -5,7 +5,35 @@ import astropy.wcs
 from megaradrp.testing.create_header import create_spec_header2, create_sky_header2
 from megaradrp.processing.wavecalibration import header_add_barycentric_correction
 
+from megaradrp.instrument.focalplane import FocalPlaneConf
+from megaradrp.testing.create_image import create_rss
+import megaradrp.processing.cube as cube
+import megaradrp.processing.hexgrid as hg
+import megaradrp.processing.hexspline as hspline
 from megaradrp.processing.cube import create_cube, merge_wcs
+from megaradrp.processing.cube import calc_cube_operator, cube_operator
+from megaradrp.processing.cube import calc_matrix_from_fiberconf
+
+
+def create_cube_loop(r0l, zval, p, target_scale):
+    """Interpolate each spaxel from all the fibers"""
+    (i1min, i1max), (j1min, j1max) = hg.hexgrid_extremes(r0l, target_scale)
+    kernel = hspline.rescaling_kernel_table(p, scale=target_scale)
+    dk = np.zeros((i1max - i1min + 1, j1max - j1min + 1, zval.shape[-1]))
+    for i in range(i1min, i1max + 1):
+        for j in range(j1min, j1max + 1):
+            dx = target_scale * j - r0l[0]
+            dy = target_scale * i - r0l[1]
+            we = kernel(dy, dx)
+            dk[i - i1min, j - j1min] = we @ zval
+    return dk
+
+
+@pytest.fixture
+def lcb_rss():
+    rng = np.random.default_rng(1)
+    scene = rng.uniform(1, 2, (623, 20)).astype('float32')
+    return create_rss(scene, np.zeros((623, 20)))
 
 
 def test_create_cube_raise():
@@ -60,3 +88,231 @@ def test_merge_wcs():
         [out["CDELT1B"], out["CDELT2B"], out["CDELT3B"]],
         [hdr_sky["CDELT1"], hdr_sky["CDELT2"], hdr_spec["CDELT1B"]],
     )
+
+
+@pytest.mark.parametrize("target_scale", [0.4, 1.0])
+def test_create_cube_operator(lcb_rss, target_scale):
+    fiberconf = FocalPlaneConf.from_img(lcb_rss)
+    r0l, _ = calc_matrix_from_fiberconf(fiberconf)
+    rows = [conf.fibid - 1 for conf in fiberconf.connected_fibers()]
+    zval = lcb_rss[0].data[rows]
+
+    expected = create_cube_loop(r0l, zval, 1, target_scale)
+    result = create_cube(r0l, zval, 1, target_scale)
+    assert result.shape == expected.shape
+    assert np.allclose(result, expected)
+
+
+def test_calc_cube_operator_shape(lcb_rss):
+    fiberconf = FocalPlaneConf.from_img(lcb_rss)
+    r0l, _ = calc_matrix_from_fiberconf(fiberconf)
+    matrix, (crow, ccol) = calc_cube_operator(r0l, 2, 0.5)
+    (i1min, i1max), (j1min, j1max) = hg.hexgrid_extremes(r0l, 0.5)
+    assert (crow, ccol) == (i1max - i1min + 1, j1max - j1min + 1)
+    assert matrix.shape == (crow * ccol, r0l.shape[1])
+    # each fiber contributes only to the spaxels around it
+    assert matrix.nnz < 0.1 * matrix.shape[0] * matrix.shape[1]
+
+
+def test_cube_operator_cache(lcb_rss):
+    fiberconf = FocalPlaneConf.from_img(lcb_rss)
+    cube._operator_cache.clear()
+    op1 = cube_operator(fiberconf, 1, 0.5)
+    op2 = cube_operator(fiberconf, 1, 0.5)
+    assert op1 is op2
+    op3 = cube_operator(fiberconf, 2, 0.5)
+    assert op3 is not op1
+    op4 = cube_operator(fiberconf, 1, 0.5, refid=1)
+    assert op4 is not op1
+    # three operators and the geometries of two reference fibers
+    assert len(cube._operator_cache) == 5
+
+
+@pytest.mark.parametrize("p", [1, 2])
+def test_write_cube_from_rss(lcb_rss, tmp_path, p):
+    from astropy.io import fits
+    from megaradrp.testing.create_header import create_spec_header2
+    from megaradrp.processing.cube import create_cube_from_rss, write_cube_from_rss
+
+    lcb_rss[0].header.update(create_spec_header2())
+    expected = create_cube_from_rss(lcb_rss, p, 0.5)
+    outfile = tmp_path / 'cube.fits'
+    # a few planes in each slab
+    write_cube_from_rss(lcb_rss, outfile, p, 0.5, max_memory=100000)
+
+    with fits.open(outfile) as result:
+        assert len(result) == len(expected)
+        assert np.array_equal(result[0].data, expected[0].data)
+        assert result[0].header == expected[0].header
+        for hdu1, hdu2 in zip(result[1:], expected[1:]):
+            assert hdu1.name == hdu2.name
+
+    with pytest.raises(FileExistsError):
+        write_cube_from_rss(lcb_rss, outfile, p, 0.5)
+
+
+def test_cube_slab_planes(lcb_rss):
+    from megaradrp.processing.cube import cube_slab_planes
+
+    fiberconf = FocalPlaneConf.from_img(lcb_rss)
+    assert cube_slab_planes(fiberconf, 1, 0.5) is None
+    n1 = cube_slab_planes(fiberconf, 1, 0.5, max_memory=1000000)
+    n2 = cube_slab_planes(fiberconf, 2, 0.5, max_memory=1000000)
+    assert n1 == n2 > 1
+    assert cube_slab_planes(fiberconf, 1, 0.5, max_memory=1) == 1
+
+
+@pytest.mark.parametrize("workers", [1, 3])
+def test_spline_postfilter(workers):
+    from scipy import signal
+    from megaradrp.processing.cube import spline_postfilter
+
+    rng = np.random.default_rng(2)
+    dk = rng.uniform(0, 1, (20, 23, 7))
+    expected = np.stack([signal.cspline2d(dk[..., k], 0.0, 1e-10) for k in range(dk.shape[-1])], axis=-1)
+    result = spline_postfilter(dk.copy(), workers=workers)
+    assert np.allclose(result, expected, rtol=0, atol=1e-9)
+
+
+def test_create_cube_linear(lcb_rss):
+    from scipy import signal
+
+    fiberconf = FocalPlaneConf.from_img(lcb_rss)
+    r0l, _ = calc_matrix_from_fiberconf(fiberconf)
+    rows = [conf.fibid - 1 for conf in fiberconf.connected_fibers()]
+    zval = lcb_rss[0].data[rows]
+
+    dk = create_cube_loop(r0l, zval, 2, 0.5)
+    expected = np.stack([signal.cspline2d(dk[..., k], 0.0, 1e-10) for k in range(dk.shape[-1])], axis=-1)
+    result = create_cube(r0l, zval, 2, 0.5, workers=2)
+    assert np.allclose(result, expected)
+
+
+def create_rss_files(lcb_rss, path, nfiles):
+    from megaradrp.testing.create_header import create_spec_header2
+
+    lcb_rss[0].header.update(create_spec_header2())
+    names = []
+    for idx in range(nfiles):
+        lcb_rss[0].data = lcb_rss[0].data * (idx + 1)
+        name = path / f'rss_{idx}.fits'
+        lcb_rss.writeto(name)
+        names.append(name)
+    return names
+
+
+@pytest.mark.parametrize("processes", [1, 2])
+def test_convert_rss_batch(lcb_rss, tmp_path, processes):
+    from astropy.io import fits
+    from megaradrp.processing.cube import convert_rss_batch, create_cube_from_rss
+
+    names = create_rss_files(lcb_rss, tmp_path, 3)
+    outdir = tmp_path / 'out'
+    outdir.mkdir()
+    reports = convert_rss_batch(names, outdir=outdir, processes=processes,
+                                p=1, target_scale_arcsec=0.5, pa_from_header=True)
+    assert len(reports) == 3
+    for name, report in zip(names, reports):
+        assert report['error'] is None
+        assert report['time'] > 0
+        with fits.open(name) as rss, fits.open(report['cube']) as result:
+            expected = create_cube_from_rss(rss, 1, 0.5)
+            assert np.array_equal(result[0].data, expected[0].data)
+
+
+def test_convert_rss_batch_error(lcb_rss, tmp_path):
+    from megaradrp.processing.cube import convert_rss_batch
+
+    names = create_rss_files(lcb_rss, tmp_path, 1)
+    # without IPA in the header
+    reports = convert_rss_batch(names, outdir=tmp_path, p=1, target_scale_arcsec=0.5)
+    assert reports[0]['error'] is not None
+
+
+def test_expand_rss_files(tmp_path):
+    from megaradrp.processing.cube import expand_rss_files
+
+    for idx in range(3):
+        (tmp_path / f'rss_{idx}.fits').touch()
+    listfile = tmp_path / 'list.txt'
+    listfile.write_text('# files\none.fits\n\ntwo.fits\n')
+    names = [str(tmp_path / 'rss_*.fits'), 'other.fits']
+    result = expand_rss_files(names, listfile)
+    assert result[:3] == [str(tmp_path / f'rss_{idx}.fits') for idx in range(3)]
+    assert result[3:] == ['other.fits', 'one.fits', 'two.fits']
+    assert len(names) == 2
+
+
+def dithered_rss(rss, offset_arcsec):
+    from astropy.io import fits
+
+    result = fits.HDUList([hdu.copy() for hdu in rss])
+    hdr = result['FIBERS'].header
+    hdr['CRVAL1'] += offset_arcsec / 3600.0 / np.cos(np.deg2rad(hdr['CRVAL2']))
+    return result
+
+
+@pytest.mark.parametrize("p", [1, 2])
+def test_combiner_single(lcb_rss, p):
+    from megaradrp.testing.create_header import create_spec_header2
+    from megaradrp.processing.cube import DitheredCubeCombiner, create_cube_from_rss
+
+    lcb_rss[0].header.update(create_spec_header2())
+    combiner = DitheredCubeCombiner([lcb_rss], p, 0.5, min_weight=0.0)
+    result = combiner.create_cube(nplanes=3)
+    expected = create_cube_from_rss(lcb_rss, p, 0.5)
+    assert result[0].data.shape == expected[0].data.shape
+    assert result[0].header['CRPIX1'] == expected[0].header['CRPIX1']
+    assert result[0].header['CRPIX2'] == expected[0].header['CRPIX2']
+    assert result[0].header['NCOMBINE'] == 1
+    weight = result['WEIGHT'].data
+    if p == 1:
+        # the cube is the interpolated flux divided by the weight
+        assert np.allclose(result[0].data * weight, expected[0].data, atol=1e-5)
+
+
+def test_combiner_dithered(lcb_rss, tmp_path):
+    from astropy.io import fits
+    from megaradrp.testing.create_header import create_spec_header2
+    from megaradrp.processing.cube import DitheredCubeCombiner
+
+    lcb_rss[0].data[...] = 1.0
+    lcb_rss[0].header.update(create_spec_header2())
+    # one spaxel of the grid is 0.5 arcsec
+    rss2 = dithered_rss(lcb_rss, 1.0)
+    rss3 = dithered_rss(lcb_rss, -1.0)
+
+    combiner = DitheredCubeCombiner([lcb_rss], 1, 0.5, conserve_flux=False)
+    nrow, ncol = combiner.grid_shape
+    combiner = DitheredCubeCombiner([lcb_rss, rss2, rss3], 1, 0.5, conserve_flux=False,
+                                    scales=[1.0, 2.0, 3.0])
+    # the grid is wider, in the direction of RA
+    assert combiner.grid_shape[0] == nrow
+    assert combiner.grid_shape[1] > ncol
+    assert combiner.weight.max() > 2.5
+
+    result = combiner.create_cube()
+    data = result[0].data
+    covered = combiner.weight >= combiner.min_weight
+    assert np.all(data[:, ~covered] == 0)
+    # values are averages of the scaled RSS
+    assert np.all(data[:, covered] < 3.0 + 1e-3)
+    assert np.all(data[:, covered] > 1.0 - 1e-3)
+    assert np.any(data[:, covered] > 1.9)
+
+    outfile = tmp_path / 'combined.fits'
+    combiner.write_cube(outfile, max_memory=50000)
+    with fits.open(outfile) as hdul:
+        assert np.array_equal(hdul[0].data, data)
+        assert np.array_equal(hdul['WEIGHT'].data, result['WEIGHT'].data)
+
+
+def test_combiner_errors(lcb_rss):
+    from megaradrp.processing.cube import DitheredCubeCombiner
+
+    with pytest.raises(ValueError):
+        DitheredCubeCombiner([])
+    with pytest.raises(ValueError):
+        DitheredCubeCombiner([lcb_rss], p=3)
+    with pytest.raises(ValueError):
+        DitheredCubeCombiner([lcb_rss, lcb_rss], scales=[1.0])
@@ -0,0 +1,174 @@
+import numpy
+import pytest
+import astropy.io.fits as fits
+from numina.frame.utils import copy_img
+from numina.util.flow import SerialFlow
+
+from megaradrp.datamodel import MegaraDataModel
+from megaradrp.processing.aperture import ApertureExtractor
+from megaradrp.processing.fiberflat import FlipLR, FiberFlatCorrector
+from megaradrp.processing.fused import FusedRSSCalibrator
+from megaradrp.processing.twilight import TwilightCorrector
+from megaradrp.processing.wavecalibration import WavelengthCalibrator
+from megaradrp.products.tracemap import TraceMap, GeometricTrace
+import megaradrp.products.wavecalibration as wcal
+from megaradrp.testing.create_image import create_simple_img
+from megaradrp.testing.create_wavecalib import create_solution, orig
+
+NFIBERS = 30
+SHAPE = (220, 120)
+
+
+def create_tracemap():
+    tracemap = TraceMap()
+    tracemap.total_fibers = NFIBERS
+    tracemap.ref_column = 60
+    for fibid in range(1, NFIBERS + 1):
+        boxid = (fibid - 1) // 10
+        # fiber 12 is missing
+        fitparms = [] if fibid == 12 else [5 + 6.5 * fibid + 3 * boxid, 0.01, -1e-5]
+        tracemap.contents.append(GeometricTrace(fibid, boxid, 4, 116, fitparms=fitparms))
+    return tracemap
+
+
+def create_wavecalib():
+    solutionwl = wcal.WavelengthCalibration(instrument='MEGARA')
+    for fibid in range(1, NFIBERS + 1):
+        if fibid == 12:
+            continue
+        solution = create_solution(orig)
+        solution.coeff = [7200.0 + 0.3 * fibid, 3.9, 1e-3]
+        solutionwl.contents.append(wcal.FiberSolutionArcCalibration(fibid, solution))
+    return solutionwl
+
+
+def create_flat(value, seed):
+    rng = numpy.random.default_rng(seed)
+    data = rng.uniform(0.8, 1.2, (NFIBERS, 4300)).astype('float32')
+    data[3, :10] = 0.0
+    hdu = fits.PrimaryHDU(data)
+    hdu.header['UUID'] = value
+    return fits.HDUList([hdu])
+
+
+def create_image():
+    img = create_simple_img('LCB')
+    img[0].header['VPH'] = 'LR-I'
+    rng = numpy.random.default_rng(1)
+    img[0].data = rng.uniform(100, 200, SHAPE).astype('float32')
+    return img
+
+
+def create_chain(tracemap, solutionwl, flats):
+    datamodel = MegaraDataModel()
+    extractor = ApertureExtractor(tracemap, datamodel)
+    wlcalibrator = WavelengthCalibrator(solutionwl, datamodel)
+    flat_correctors = [FiberFlatCorrector(flats[0], datamodel)]
+    flat_correctors += [TwilightCorrector(flat, datamodel) for flat in flats[1:]]
+    return extractor, wlcalibrator, flat_correctors
+
+
+@pytest.mark.parametrize("ntwilight", [0, 1])
+def test_fused_equals_chain(ntwilight):
+    tracemap = create_tracemap()
+    solutionwl = create_wavecalib()
+    flats = [create_flat(f'fiberflat-{ntwilight}', 1), create_flat(f'twilight-{ntwilight}', 2)]
+    flats = flats[:1 + ntwilight]
+    img = create_image()
+
+    extractor, wlcalibrator, flat_correctors = create_chain(tracemap, solutionwl, flats)
+    chain = SerialFlow([extractor, FlipLR(), wlcalibrator] + flat_correctors)
+    expected = chain(copy_img(img))
+
+    extractor, wlcalibrator, flat_correctors = create_chain(tracemap, solutionwl, flats)
+    fused = FusedRSSCalibrator(extractor, wlcalibrator, flat_correctors)
+    result = fused(copy_img(img))
+
+    assert result[0].data.dtype == expected[0].data.dtype
+    assert numpy.allclose(result[0].data, expected[0].data, rtol=1e-5, atol=1e-5)
+    assert numpy.all(result[0].data[11] == 0)
+    assert [hdu.name for hdu in result] == [hdu.name for hdu in expected]
+    assert numpy.array_equal(result['WLMAP'].data, expected['WLMAP'].data)
+    for key in ['NUM-APE', 'NUM-WAV', 'NUM-FIBF', 'CRVAL1', 'CDELT1', 'CRPIX1']:
+        assert result[0].header[key] == expected[0].header[key]
+    if ntwilight:
+        assert result[0].header['NUM-TWIF'] == expected[0].header['NUM-TWIF']
+    for key in ['FIB001W1', 'FIB001W2', 'FIB012_V', 'FIB030S1']:
+        assert result['FIBERS'].header[key] == expected['FIBERS'].header[key]
+
+
+def test_fused_operator_cache():
+    tracemap = create_tracemap()
+    solutionwl = create_wavecalib()
+    flats = [create_flat('fiberflat-cache', 1)]
+    img = create_image()
+
+    fused = FusedRSSCalibrator(*create_chain(tracemap, solutionwl, flats))
+    operator1 = fused.operator(img[0].header, SHAPE)
+    operator2 = fused.operator(img[0].header, SHAPE)
+    assert operator1 is operator2
+    # a new calibrator with the same calibrations
+    fused = FusedRSSCalibrator(*create_chain(tracemap, solutionwl, flats))
+    assert fused.operator(img[0].header, SHAPE) is operator1
+    # other shape
+    operator3 = fused.operator(img[0].header, (SHAPE[0] + 10, SHAPE[1]))
+    assert operator3 is not operator1
+    assert operator3[0].shape == (NFIBERS * 4300, (SHAPE[0] + 10) * SHAPE[1])
+
+
+def test_fused_operator_cache_twilight_data():
+    tracemap = create_tracemap()
+    solutionwl = create_wavecalib()
+    flats = [create_flat('fiberflat-twdata', 1)]
+    img = create_image()
+    datamodel = MegaraDataModel()
+
+    def create_fused(seed):
+        # a twilight correction without calibid
+        twilight = TwilightCorrector(create_flat('', seed)[0].data, datamodel)
+        assert twilight.calibid == 'calibid-unknown'
+        extractor, wlcalibrator, flat_correctors = create_chain(tracemap, solutionwl, flats)
+        return FusedRSSCalibrator(extractor, wlcalibrator, flat_correctors + [twilight])
+
+    operator1 = create_fused(2).operator(img[0].header, SHAPE)
+    assert create_fused(2).operator(img[0].header, SHAPE) is operator1
+    assert create_fused(3).operator(img[0].header, SHAPE) is not operator1
+
+
+def test_fused_model_map():
+    from megaradrp.products.modelmap import ModelMap
+
+    datamodel = MegaraDataModel()
+    model_map = ModelMap()
+    extractor = ApertureExtractor(model_map, datamodel)
+    wlcalibrator = WavelengthCalibrator(create_wavecalib(), datamodel)
+    fused = FusedRSSCalibrator(extractor, wlcalibrator)
+    with pytest.raises(ValueError):
+        fused.operator(create_image()[0].header, SHAPE)
+
+
+def test_fused_auto_offset():
+    tracemap = create_tracemap()
+    solutionwl = create_wavecalib()
+    flats = [create_flat('fiberflat-auto', 1)]
+    img = create_image()
+    yy, xx = numpy.mgrid[0:SHAPE[0], 0:SHAPE[1]]
+    for trace in tracemap.contents:
+        if trace.valid:
+            center = trace.polynomial(xx) + 0.7
+            img[0].data += 1000 * numpy.exp(-0.5 * ((yy - center) / 1.5) ** 2)
+
+    extractor, wlcalibrator, flat_correctors = create_chain(tracemap, solutionwl, flats)
+    extractor.auto_offset = True
+    chain = SerialFlow([extractor, FlipLR(), wlcalibrator] + flat_correctors)
+    expected = chain(copy_img(img))
+
+    # the extractor updates the global offset of its trace map
+    extractor, wlcalibrator, flat_correctors = create_chain(create_tracemap(), solutionwl, flats)
+    extractor.auto_offset = True
+    fused = FusedRSSCalibrator(extractor, wlcalibrator, flat_correctors)
+    result = fused(copy_img(img))
+
+    assert abs(result[0].header['APE-OFF'] - 0.7) < 0.02
+    assert result[0].header['APE-OFF'] == expected[0].header['APE-OFF']
+    assert numpy.allclose(result[0].data, expected[0].data, rtol=1e-5, atol=1e-5)
@@ -27,3 +27,59 @@ def test_hexspline2():
     ]
     res = hexspline2(x, y)
     assert np.allclose(res, expected_res, rtol=1e-2)
+
+
+def test_hexspline_table():
+    from megaradrp.processing.hexspline import hexspline_table, hexspline_support
+
+    table = hexspline_table(2)
+    (ylow, yhigh), (xlow, xhigh) = table.bbox
+    rng = np.random.default_rng(1)
+    x = rng.uniform(xlow, xhigh, 20000)
+    y = rng.uniform(ylow, yhigh, 20000)
+    # the analytic form is only valid inside the support
+    inside = hexspline_support(x, y, 2)
+    expected = np.where(inside, hexspline2(x, y), 0.0)
+    error = np.abs(table(y, x) - expected)
+    assert error.max() <= table.error_bound
+    assert table.error_bound < 5e-3
+    assert np.allclose(table(0, 0), 1.0)
+    assert np.all(table([0, 0, 2.0], [2.0, -2.0, 0]) == 0)
+    assert table.integral() == pytest.approx(math.sqrt(3) / 2, rel=1e-3)
+
+
+@pytest.mark.parametrize("p", [1, 2])
+def test_rescaling_kernel_table(p):
+    from megaradrp.processing.hexspline import rescaling_kernel_table
+
+    table = rescaling_kernel_table(p, scale=0.8)
+    rbs = rescaling_kernel(p, scale=0.8)
+    (ylow, yhigh), (xlow, xhigh) = table.bbox
+    # the kernel vanishes in the borders of the table
+    assert np.abs(table.values[[0, -1]]).max() < 1e-12
+    assert np.abs(table.values[:, [0, -1]]).max() < 1e-12
+    # the tables match the samples
+    yy, xx = np.meshgrid(table.ys[::7], table.xs[::7], indexing='ij')
+    assert np.allclose(table(yy, xx), table.values[::7, ::7], rtol=0, atol=1e-12)
+    assert np.allclose(rbs.ev(yy, xx), table.values[::7, ::7], rtol=0, atol=1e-8)
+    rng = np.random.default_rng(2)
+    y = rng.uniform(ylow, yhigh, 5000)
+    x = rng.uniform(xlow, xhigh, 5000)
+    assert np.allclose(table(y, x), rbs.ev(y, x), rtol=0, atol=1e-3)
+
+
+def test_kernel_cache(monkeypatch):
+    import megaradrp.processing.hexspline as hspline
+
+    monkeypatch.setattr(hspline, 'KERNEL_CACHE_SIZE', 2)
+    hspline.clear_kernel_cache()
+    table1 = hspline.rescaling_kernel_table(1, scale=0.5)
+    assert hspline.rescaling_kernel_table(1, scale=0.5) is table1
+    hspline.rescaling_kernel_table(1, scale=0.6)
+    hspline.rescaling_kernel_table(1, scale=0.5)
+    # the least recently used kernel is removed
+    hspline.rescaling_kernel_table(1, scale=0.7)
+    assert len(hspline._kernel_cache) == 2
+    assert hspline.rescaling_kernel_table(1, scale=0.5) is table1
+    hspline.clear_kernel_cache()
+    assert hspline.rescaling_kernel_table(1, scale=0.5) is not table1
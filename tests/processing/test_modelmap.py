@@ -1,8 +1,16 @@
 from astropy.modeling.functional_models import Moffat1D
+import io
 import math
 import numpy as np
+import numpy.polynomial.polynomial as nppol
 import pytest
-from megaradrp.processing.modelmap import calc1d_model, calc_matrix
+from megaradrp.core.opcache import ArrayCache
+from megaradrp.processing.modelmap import calc1d_model, calc_matrix, calc_matrix_block, aper_extract
+from megaradrp.processing.modelmap import calc_matrix_cols, calc_factor_cols
+from megaradrp.processing.modelmap import pack_matrix_cols, unpack_matrix_cols, load_matrix_cols
+from megaradrp.processing.modelmap import ParallelColumnExtractor
+from megaradrp.products.modelmap import ModelMap, GeometricModel
+from megaradrp.products.tracemap import TraceMap, GeometricTrace
 from megaradrp.processing.modeldesc.moffat import MoffatModelDescription
 from megaradrp.processing.modeldesc.gaussbox import GaussBoxModelDescription
 
@@ -85,3 +93,217 @@ def test_calc1():
     params["stddev"] = g_std
     wm = calc_matrix(wshape, model, params, valid)
     assert isinstance(wm, scipy.sparse.csr_matrix)
+
+
+
+def test_calc_matrix_values():
+    model = GaussBoxModelDescription().model_cls
+    g_mean = np.array([3.2, 20.0, 26.5, 60.3])
+    g_std = np.array([1.0, 1.5, 2.0, 1.2])
+    wshape = (80, 4)
+    params = {"mean": g_mean, "stddev": g_std}
+    valid = [1, 2, 4]
+    wm = calc_matrix(wshape, model, params, valid, extra=10)
+
+    expected = np.zeros(wshape)
+    for fibid in valid:
+        idx = fibid - 1
+        rows = np.ceil(g_mean[idx] - 0.5).astype(int) + np.arange(-10, 10)
+        rows = rows[rows >= 0]
+        val = model.evaluate(rows, 1.0, g_mean[idx], g_std[idx], 0.5)
+        val[val < 1e-6] = 0.0
+        expected[rows, idx] = val
+    assert np.allclose(wm.toarray(), expected)
+    assert wm.has_sorted_indices
+
+
+def test_calc_matrix_block():
+    model = GaussBoxModelDescription().model_cls
+    nfib = 100
+    ncol = 7
+    g_mean = 20 + 6 * np.arange(nfib)[:, np.newaxis] + 0.3 * np.arange(ncol)
+    g_std = 1.2 + 0.05 * np.arange(ncol) + np.zeros((nfib, 1))
+    wshape = (650, nfib)
+    valid = [fibid for fibid in range(1, nfib + 1) if fibid != 33]
+    params = {"mean": g_mean, "stddev": g_std}
+    wcols = calc_matrix_block(wshape, model, params, valid)
+    assert len(wcols) == ncol
+    for col in range(ncol):
+        params_col = {"mean": g_mean[:, col], "stddev": g_std[:, col]}
+        wm = calc_matrix(wshape, model, params_col, valid)
+        assert np.allclose(wcols[col].toarray(), wm.toarray())
+
+    wop = calc_matrix_block(wshape, model, params, valid, block_diag=True)
+    assert wop.shape == (650 * ncol, nfib * ncol)
+    rss = np.random.default_rng(seed=34).uniform(size=(nfib, ncol))
+    img = np.stack([wcols[col] @ rss[:, col] for col in range(ncol)], axis=1)
+    assert np.allclose(wop @ rss.T.ravel(), img.T.ravel())
+
+
+class _ModelMapStub:
+    total_fibers = 623
+
+
+@pytest.mark.parametrize("invalid", [[], [10, 11, 300]])
+def test_aper_extract_banded(invalid):
+    model = GaussBoxModelDescription().model_cls
+    nfib = 623
+    g_mean = 100 + 6.33 * np.arange(nfib)
+    wshape = (4112, nfib)
+    valid = [fibid for fibid in range(1, nfib + 1) if fibid not in invalid]
+    wcols = {}
+    for col in range(3):
+        params = {"mean": g_mean, "stddev": 1.5 + 0.2 * col + np.zeros_like(g_mean)}
+        wcols[col] = calc_matrix(wshape, model, params, valid)
+
+    rng = np.random.default_rng(seed=1203)
+    flux = rng.uniform(100, 1000, size=(nfib, 3))
+    img = np.zeros((4112, 3))
+    for col, wcol in wcols.items():
+        img[:, col] = wcol @ flux[:, col]
+
+    rss1 = aper_extract(_ModelMapStub(), wcols, img, method="banded")
+    rss2 = aper_extract(_ModelMapStub(), wcols, img, method="lsqr")
+    assert rss1.shape == (nfib, 3)
+    assert np.allclose(rss1, rss2, rtol=1e-4)
+    mask = np.zeros(nfib, dtype=bool)
+    mask[[fibid - 1 for fibid in valid]] = True
+    assert np.allclose(rss1[mask], flux[mask])
+    assert np.all(rss1[~mask] == 0)
+
+
+def test_aper_extract_method():
+    with pytest.raises(ValueError):
+        aper_extract(_ModelMapStub(), {}, np.zeros((10, 10)), method="cg")
+
+
+def create_model_map(nfib=50, ncol=300, invalid=(7,)):
+    model_map = ModelMap()
+    model_map.total_fibers = nfib
+    model_map.ref_column = ncol // 2
+    for fibid in range(1, nfib + 1):
+        if fibid in invalid:
+            model = {}
+        else:
+            model = {
+                'model_name': 'gaussbox',
+                'params': {
+                    'mean': nppol.Polynomial([10 + 8 * fibid, 0.001]),
+                    'stddev': nppol.Polynomial([1.5, 0.001])
+                }
+            }
+        model_map.contents.append(GeometricModel(fibid, 1, 3, ncol - 3, model))
+    return model_map
+
+
+def test_pack_matrix_cols():
+    model_map = create_model_map()
+    wcols = calc_matrix_cols(model_map, (450, 300))
+    factors = calc_factor_cols(wcols)
+    factors[5] = None
+    wcols2, factors2 = unpack_matrix_cols(pack_matrix_cols(wcols, factors))
+    assert sorted(wcols2) == sorted(wcols)
+    for col, wcol in wcols.items():
+        assert np.all(wcols2[col].toarray() == wcol.toarray())
+    assert factors2[5] is None
+    img = np.random.default_rng(seed=4).uniform(size=(450, 300))
+    rss1 = aper_extract(model_map, wcols, img, factors=factors)
+    rss2 = aper_extract(model_map, wcols2, img, factors=factors2)
+    assert np.allclose(rss1, rss2)
+
+
+def test_load_matrix_cols_cache(tmp_path):
+    cache = ArrayCache(tmp_path)
+    model_map = create_model_map()
+    wcols1, factors1 = load_matrix_cols(model_map, (450, 300), cache=cache)
+    assert len(list((tmp_path / 'modelmap').iterdir())) == 1
+    wcols2, factors2 = load_matrix_cols(model_map, (450, 300), cache=cache)
+    # views of the memory maps
+    assert not wcols2[10].data.flags.writeable
+    for col, wcol in wcols1.items():
+        assert np.all(wcols2[col].toarray() == wcol.toarray())
+    # a different offset is a different entry
+    model_map.global_offset = nppol.Polynomial([0.3])
+    load_matrix_cols(model_map, (450, 300), cache=cache)
+    assert len(list((tmp_path / 'modelmap').iterdir())) == 2
+
+
+def test_model_map_ds9():
+    model_map = create_model_map()
+    tracemap = TraceMap()
+    for aper in model_map.contents:
+        fitparms = aper.polynomial.coef.tolist() if aper.valid else []
+        tracemap.contents.append(GeometricTrace(aper.fibid, aper.boxid, aper.start, aper.stop,
+                                                fitparms=fitparms))
+    for obj in [model_map, tracemap]:
+        obj.tags = {'insmode': 'LCB', 'vph': 'LR-I'}
+        obj.uuid = 'uuid'
+
+    ds9reg = io.StringIO()
+    model_map.to_ds9_reg(ds9reg, fibid_at=100)
+    expected = io.StringIO()
+    tracemap.to_ds9_reg(expected, fibid_at=100)
+    assert ds9reg.getvalue() == expected.getvalue()
+    assert '# fibid: 7\n#' in ds9reg.getvalue()
+
+
+def test_model_map_offset():
+    model_map = create_model_map()
+    img = np.zeros((450, 300))
+    model_map.aper_extract(img)
+    wcols = model_map._wcols
+    model_map.global_offset = nppol.Polynomial([0.3])
+    model_map.aper_extract(img)
+    assert model_map._wcols is not wcols
+
+
+def test_parallel_extractor(tmp_path):
+    model_map = create_model_map()
+    wcols = calc_matrix_cols(model_map, (450, 300))
+    factors = calc_factor_cols(wcols)
+    img = np.random.default_rng(seed=5).uniform(size=(450, 300))
+    rss1 = aper_extract(model_map, wcols, img, factors=factors)
+    with ParallelColumnExtractor(wcols, factors, 50, processes=2, tmpdir=tmp_path) as extractor:
+        workdir = extractor.workdir
+        rss2 = extractor.extract(img)
+        pool = extractor.pool
+        rss3 = extractor.extract(2 * img)
+        # the pool is reused
+        assert extractor.pool is pool
+    assert np.allclose(rss1, rss2)
+    assert np.allclose(2 * rss1, rss3)
+    assert not (tmp_path / workdir).exists()
+
+
+def test_model_map_parallel():
+    model_map = create_model_map()
+    img = np.random.default_rng(seed=6).uniform(size=(450, 300))
+    rss1 = model_map.aper_extract(img)
+    rss2 = model_map.aper_extract(img, processes=2)
+    extractor = model_map._wpar
+    assert extractor is not None
+    model_map.close()
+    assert model_map._wpar is None
+    assert extractor.pool is None
+    assert np.allclose(rss1, rss2)
+
+
+@pytest.mark.parametrize("method", ["banded", "lsqr"])
+def test_aper_extract_stack(method):
+    model_map = create_model_map()
+    wcols = calc_matrix_cols(model_map, (450, 300))
+    stack = np.random.default_rng(seed=7).uniform(size=(3, 450, 300))
+    rss = aper_extract(model_map, wcols, stack, method=method)
+    assert rss.shape == (3, 50, 300)
+    for frame, frame_rss in zip(stack, rss):
+        assert np.allclose(aper_extract(model_map, wcols, frame, method=method), frame_rss)
+
+
+def test_model_map_parallel_stack():
+    model_map = create_model_map()
+    stack = np.random.default_rng(seed=8).uniform(size=(2, 450, 300))
+    rss1 = model_map.aper_extract(stack)
+    rss2 = model_map.aper_extract(stack, processes=2)
+    model_map.close()
+    assert rss1.shape == (2, 50, 300)
+    assert np.allclose(rss1, rss2)
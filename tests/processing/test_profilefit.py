@@ -0,0 +1,158 @@
+import numpy
+import pytest
+
+from numina.modeling.gaussbox import gauss_box_model
+
+from megaradrp.processing.modeldesc.gaussbox import GaussBoxModelDescription
+from megaradrp.processing.modelmap import calc1d_model
+from megaradrp.processing.profilefit import calc1d_model_banded, fit_profiles
+
+
+def create_column(centers, amplitudes, sigmas, nrows=4112, noise=0.0, seed=1):
+    xx = numpy.arange(nrows)
+    column = numpy.zeros(nrows)
+    for center, amp, sig in zip(centers, amplitudes, sigmas):
+        column += gauss_box_model(xx, amp, center, sig, 0.5)
+    if noise > 0:
+        rng = numpy.random.default_rng(seed)
+        column += rng.normal(0, noise, nrows)
+    return column
+
+
+def test_calc1d_model_banded_recover():
+    rng = numpy.random.default_rng(2)
+    nfib = 60
+    centers = 40 + 6.5 * numpy.arange(nfib)
+    amplitudes = rng.uniform(0.5, 1.0, nfib)
+    sigmas = rng.uniform(1.1, 1.4, nfib)
+    column = create_column(centers, amplitudes, sigmas, nrows=500)
+    valid = list(range(1, nfib + 1))
+
+    model_desc = GaussBoxModelDescription(sigma=1.25)
+    result = calc1d_model_banded(model_desc, column, centers, valid, 100)
+
+    assert set(result) == set(valid)
+    fit_sig = numpy.array([result[fibid]['stddev'] for fibid in valid])
+    fit_amp = numpy.array([result[fibid]['amplitude'] for fibid in valid])
+    assert numpy.allclose(fit_sig, sigmas, atol=1e-6)
+    assert numpy.allclose(fit_amp, amplitudes, rtol=1e-6)
+    # fixed parameters are not modified
+    for fibid, center in zip(valid, centers):
+        assert result[fibid]['mean'] == center
+        assert result[fibid]['hpix'] == 0.5
+
+
+def test_calc1d_model_banded_free_center():
+    rng = numpy.random.default_rng(3)
+    nfib = 40
+    centers = 40 + 6.5 * numpy.arange(nfib)
+    true_centers = centers + rng.uniform(-0.3, 0.3, nfib)
+    column = create_column(true_centers, numpy.ones(nfib), 1.2 * numpy.ones(nfib), nrows=400)
+    valid = list(range(1, nfib + 1))
+
+    model_desc = GaussBoxModelDescription(fixed_center=False, sigma=1.2)
+    result = calc1d_model_banded(model_desc, column, centers, valid, 100)
+    fit_centers = numpy.array([result[fibid]['mean'] for fibid in valid])
+    assert numpy.allclose(fit_centers, true_centers, atol=1e-6)
+
+
+def test_calc1d_model_banded_bounds():
+    nfib = 30
+    centers = 40 + 6.5 * numpy.arange(nfib)
+    column = create_column(centers, numpy.ones(nfib), 2.5 * numpy.ones(nfib), nrows=300)
+    valid = list(range(1, nfib + 1))
+
+    # the initial sigma is too far, stddev must stop at the bound
+    model_desc = GaussBoxModelDescription(sigma=1.5)
+    result = calc1d_model_banded(model_desc, column, centers, valid, 100)
+    fit_sig = numpy.array([result[fibid]['stddev'] for fibid in valid])
+    assert numpy.all(fit_sig <= 2.0 + 1e-12)
+    assert numpy.allclose(fit_sig[2:-2], 2.0)
+
+
+def test_calc1d_model_banded_astropy():
+    rng = numpy.random.default_rng(4)
+    nfib = 20
+    centers = 2000 + 6.5 * numpy.arange(nfib)
+    amplitudes = rng.uniform(0.5, 1.0, nfib)
+    sigmas = rng.uniform(1.1, 1.4, nfib)
+    column = create_column(centers, amplitudes, sigmas, noise=0.005)
+    valid = list(range(1, nfib + 1))
+
+    model_desc = GaussBoxModelDescription(sigma=1.25)
+    result1 = calc1d_model_banded(model_desc, column, centers, valid, 100)
+    result2 = calc1d_model(model_desc, column, centers, valid, 100, lateral=2, nloop=3)
+    for fibid in valid:
+        for name in ['amplitude', 'stddev']:
+            assert result1[fibid][name] == pytest.approx(result2[fibid][name], rel=1e-3)
+
+
+def test_calc1d_model_banded_len():
+    model_desc = GaussBoxModelDescription()
+    with pytest.raises(ValueError):
+        calc1d_model_banded(model_desc, numpy.zeros(100), [10.0, 20.0], [1], 100)
+
+
+def test_fit_profiles_no_deriv():
+    class NoDeriv:
+        fit_deriv = None
+
+    with pytest.raises(ValueError):
+        fit_profiles(NoDeriv, numpy.zeros(10), numpy.zeros((4, 1)),
+                     numpy.ones((1, 4), dtype='bool'),
+                     numpy.zeros((1, 4)), numpy.ones((1, 4)), 'mean')
+
+
+class Gauss:
+    """Gaussian profile, with the center as the last parameter"""
+    param_names = ('stddev', 'amplitude', 'mean')
+
+    @staticmethod
+    def evaluate(x, stddev, amplitude, mean):
+        return amplitude * numpy.exp(-0.5 * ((x - mean) / stddev) ** 2)
+
+    @staticmethod
+    def fit_deriv(x, stddev, amplitude, mean):
+        arg = (x - mean) / stddev
+        d_amplitude = numpy.exp(-0.5 * arg ** 2)
+        d_mean = amplitude * d_amplitude * arg / stddev
+        return [d_mean * arg, d_amplitude, d_mean]
+
+
+class GaussWrongDeriv(Gauss):
+    @staticmethod
+    def fit_deriv(x, stddev, amplitude, mean):
+        return [-d for d in Gauss.fit_deriv(x, stddev, amplitude, mean)]
+
+
+def create_gauss_problem(nfib=20):
+    centers = 20 + 7.0 * numpy.arange(nfib)
+    amplitudes = numpy.linspace(0.5, 1.0, nfib)
+    column = Gauss.evaluate(numpy.arange(180)[:, numpy.newaxis], 1.3, amplitudes, centers).sum(axis=1)
+    params = numpy.array([numpy.full(nfib, 1.0), numpy.full(nfib, 0.7), centers])
+    free = numpy.ones((nfib, 3), dtype='bool')
+    free[:, 2] = False
+    lower = numpy.full((nfib, 3), -numpy.inf)
+    upper = numpy.full((nfib, 3), numpy.inf)
+    return column, params, free, lower, upper, amplitudes
+
+
+def test_fit_profiles_center_by_name():
+    column, params, free, lower, upper, amplitudes = create_gauss_problem()
+    fitted, info = fit_profiles(Gauss, column, params, free, lower, upper, 'mean')
+    assert info['converged']
+    assert numpy.allclose(fitted[0], 1.3)
+    assert numpy.allclose(fitted[1], amplitudes)
+    assert numpy.all(fitted[2] == params[2])
+    with pytest.raises(ValueError):
+        fit_profiles(Gauss, column, params, free, lower, upper, 'x_0')
+
+
+def test_fit_profiles_not_converged():
+    column, params, free, lower, upper, _ = create_gauss_problem()
+    # the steps always increase the cost, the damping blows up
+    fitted, info = fit_profiles(GaussWrongDeriv, column, params, free, lower, upper, 'mean',
+                                ftol=0.0, xtol=0.0)
+    assert not info['converged']
+    assert info['niter'] < 100
+    assert numpy.all(fitted == params)
@@ -0,0 +1,209 @@
+import warnings
+
+import numpy
+import pytest
+import numpy.polynomial.polynomial as nppol
+from numpy.polynomial.polynomial import polyval
+from numina.array.interpolation import SteffenInterpolator
+import numina.array.utils as utils
+
+import megaradrp.products.wavecalibration as wcal
+from megaradrp.processing.wavecalibration import SimpleWcs1D
+from megaradrp.processing.wavecalibration import resample_rss_flux, pixel_borders
+from megaradrp.processing.wavecalibration import steffen_interpolate_rows
+from megaradrp.testing.create_wavecalib import create_solution, orig
+
+
+def resample_rss_flux_loop(arr, solutionwl, npix, finalwcs, span=0, fill=0):
+    """Resample each fiber with its own interpolator"""
+    nfibers, nsamples = arr.shape
+    subwcs = finalwcs.sub(['spectral'])
+    new_wl, = subwcs.all_pix2world(numpy.arange(npix), 0)
+    old_x_borders_1 = numpy.arange(-0.5, nsamples) + 1.0
+    new_wl_borders = pixel_borders(new_wl)
+
+    accum_flux = numpy.empty((nfibers, nsamples + 1))
+    accum_flux[:, 1:] = numpy.cumsum(arr, axis=1)
+    accum_flux[:, 0] = 0.0
+    rss_resampled = numpy.zeros((nfibers, npix))
+    limits = []
+    for fibsol in solutionwl.contents:
+        fibid = fibsol.fibid
+        idx = fibid - 1
+        coeff = numpy.array(fibsol.solution.coeff, dtype='float')
+        coeff[0] -= solutionwl.global_offset(fibid)
+        old_wl_borders = polyval(old_x_borders_1, coeff)
+        ss_vals, = subwcs.all_world2pix(old_wl_borders[[0, -1]], 0)
+        s1, s2 = ss_vals
+        lower = max(0, min(utils.coor_to_pix_1d(s1), npix - 1))
+        upper = max(0, min(utils.coor_to_pix_1d(s2), npix - 1))
+        interpolator = SteffenInterpolator(old_wl_borders, accum_flux[idx], extrapolate='border')
+        fl_borders = interpolator(new_wl_borders)
+        rss_resampled[idx] = fl_borders[1:] - fl_borders[:-1]
+        rss_resampled[idx, lower:lower + span] = fill
+        rss_resampled[idx, upper + 1 - span:upper + 1] = fill
+        limits.append((fibid, (lower + span, upper - span)))
+    return rss_resampled, limits
+
+
+def create_wavecalib(fibids, nsamples=4300, offset=(0.0,), seed=1):
+    rng = numpy.random.default_rng(seed)
+    solutionwl = wcal.WavelengthCalibration(instrument='TEST1')
+    solutionwl.global_offset = nppol.Polynomial(offset)
+    for fibid in fibids:
+        solution = create_solution(orig)
+        # a smooth dispersion, different in each fiber
+        wl0 = 7140.0 + rng.uniform(-20, 20)
+        disp = 0.4 + rng.uniform(-0.01, 0.01)
+        coeff = [wl0, disp, -5e-6, 2e-10]
+        # solutions of different degree
+        solution.coeff = coeff[:2 + fibid % 3]
+        solutionwl.contents.append(wcal.FiberSolutionArcCalibration(fibid, solution))
+    return solutionwl
+
+
+@pytest.mark.parametrize("span", [0, 2])
+@pytest.mark.parametrize("offset", [(0.0,), (1.5, 1e-3)])
+def test_resample_rss_flux(span, offset):
+    nfibers, nsamples, npix = 40, 4300, 4200
+    fibids = [fibid for fibid in range(1, nfibers + 1) if fibid != 7]
+    rng = numpy.random.default_rng(2)
+    arr = rng.uniform(0, 100, (nfibers, nsamples))
+    targetwcs = SimpleWcs1D(crval=7200.0, crpix=1.0, cdelt=0.39)
+    finalwcs = targetwcs.create_internal_wcs_()
+
+    expected, expected_limits = resample_rss_flux_loop(
+        arr, create_wavecalib(fibids, offset=offset), npix, finalwcs, span=span)
+    result, limits = resample_rss_flux(
+        arr, create_wavecalib(fibids, offset=offset), npix, finalwcs, span=span)
+
+    assert limits == expected_limits
+    assert numpy.allclose(result, expected, rtol=1e-9, atol=1e-8)
+    # fibers without solution are not resampled
+    assert numpy.all(result[6] == 0)
+
+
+def test_steffen_interpolate_rows():
+    rng = numpy.random.default_rng(3)
+    x = numpy.cumsum(rng.uniform(0.5, 1.5, (5, 30)), axis=1)
+    y = numpy.cumsum(rng.uniform(0, 2, (5, 30)), axis=1)
+    # includes points outside the range and points in the samples
+    x_new = numpy.sort(numpy.concatenate([rng.uniform(-2, 40, 200), x[2, [0, 5, -1]]]))
+    result = steffen_interpolate_rows(x, y, x_new)
+    for row in range(5):
+        interpolator = SteffenInterpolator(x[row], y[row], extrapolate='border')
+        assert numpy.allclose(result[row], interpolator(x_new), rtol=0, atol=1e-12)
+
+
+def test_resample_rss_flux_empty():
+    finalwcs = SimpleWcs1D(crval=7200.0, crpix=1.0, cdelt=0.39).create_internal_wcs_()
+    solutionwl = wcal.WavelengthCalibration(instrument='TEST1')
+    with warnings.catch_warnings():
+        warnings.simplefilter('error')
+        result, limits = resample_rss_flux(numpy.ones((3, 100)), solutionwl, 50, finalwcs)
+    assert limits == []
+    assert numpy.all(result == 0)
+
+
+def resample_linear(arr, solutionwl, npix, finalwcs, span=0):
+    """Linear interpolation of the accumulated flux of each fiber"""
+    nfibers, nsamples = arr.shape
+    subwcs = finalwcs.sub(['spectral'])
+    new_wl, = subwcs.all_pix2world(numpy.arange(npix), 0)
+    new_wl_borders = pixel_borders(new_wl)
+    old_x_borders_1 = numpy.arange(-0.5, nsamples) + 1.0
+    result = numpy.zeros((nfibers, npix))
+    for fibsol in solutionwl.contents:
+        idx = fibsol.fibid - 1
+        coeff = numpy.array(fibsol.solution.coeff, dtype='float')
+        coeff[0] -= solutionwl.global_offset(fibsol.fibid)
+        accum_flux = numpy.concatenate([[0.0], numpy.cumsum(arr[idx])])
+        fl_borders = numpy.interp(new_wl_borders, polyval(old_x_borders_1, coeff), accum_flux)
+        result[idx] = numpy.diff(fl_borders)
+    return result
+
+
+@pytest.mark.parametrize("span", [0, 2])
+def test_resampling_operator(span):
+    from megaradrp.processing.wavecalibration import calc_resampling_operator
+
+    nfibers, nsamples, npix = 20, 4300, 4200
+    fibids = [fibid for fibid in range(1, nfibers + 1) if fibid != 3]
+    rng = numpy.random.default_rng(4)
+    arr = rng.uniform(0, 100, (nfibers, nsamples))
+    finalwcs = SimpleWcs1D(crval=7200.0, crpix=1.0, cdelt=0.39).create_internal_wcs_()
+    solutionwl = create_wavecalib(fibids, offset=(1.5, 1e-3))
+
+    operator = calc_resampling_operator(solutionwl, arr.shape, npix, finalwcs, span=span)
+    result = operator(arr)
+    _, limits = resample_rss_flux(arr, solutionwl, npix, finalwcs, span=span)
+    expected = resample_linear(arr, solutionwl, npix, finalwcs)
+    for fibid, (lower, upper) in limits:
+        expected[fibid - 1, lower - span:lower] = 0
+        expected[fibid - 1, upper + 1:upper + 1 + span] = 0
+
+    assert operator.limits == limits
+    assert numpy.allclose(result, expected, rtol=1e-10, atol=1e-8)
+    assert numpy.all(result[2] == 0)
+
+
+def test_resampling_operator_smooth():
+    from megaradrp.processing.wavecalibration import calc_resampling_operator
+
+    nfibers, nsamples, npix = 10, 4300, 4200
+    xx = numpy.arange(nsamples)
+    arr = numpy.tile(100 + 20 * numpy.sin(xx / 300.0), (nfibers, 1))
+    finalwcs = SimpleWcs1D(crval=7200.0, crpix=1.0, cdelt=0.39).create_internal_wcs_()
+    solutionwl = create_wavecalib(range(1, nfibers + 1))
+
+    operator = calc_resampling_operator(solutionwl, arr.shape, npix, finalwcs)
+    result = operator(arr)
+    expected, limits = resample_rss_flux(arr, solutionwl, npix, finalwcs)
+    for fibid, (lower, upper) in limits:
+        sl = slice(lower + 2, upper - 1)
+        assert numpy.allclose(result[fibid - 1, sl], expected[fibid - 1, sl], rtol=1e-4)
+
+
+def test_resampling_operator_cache(tmp_path):
+    import megaradrp.processing.wavecalibration as wavecal
+    from megaradrp.core.opcache import ArrayCache
+
+    nfibers, nsamples, npix = 5, 500, 400
+    targetwcs = SimpleWcs1D(crval=7200.0, crpix=1.0, cdelt=0.39)
+    solutionwl = create_wavecalib(range(1, nfibers + 1), nsamples=nsamples)
+    arr = numpy.random.default_rng(5).uniform(0, 100, (nfibers, nsamples))
+    cache = ArrayCache(tmp_path)
+
+    wavecal._resampling_cache.clear()
+    operator = wavecal.resampling_operator(solutionwl, arr.shape, npix, targetwcs, span=2, cache=cache)
+    assert wavecal.resampling_operator(
+        solutionwl, arr.shape, npix, targetwcs, span=2, cache=cache) is operator
+    # a different offset is a different operator
+    solutionwl.global_offset = nppol.Polynomial([0.5])
+    other = wavecal.resampling_operator(solutionwl, arr.shape, npix, targetwcs, span=2, cache=cache)
+    assert other is not operator
+    solutionwl.global_offset = nppol.Polynomial([0.0])
+
+    # loaded from disk
+    wavecal._resampling_cache.clear()
+    loaded = wavecal.resampling_operator(solutionwl, arr.shape, npix, targetwcs, span=2, cache=cache)
+    assert loaded is not operator
+    assert loaded.limits == operator.limits
+    assert numpy.array_equal(loaded(arr), operator(arr))
+    wavecal._resampling_cache.clear()
+
+    with pytest.raises(ValueError):
+        operator(arr[:, :-1])
+
+
+def test_resample_rss_flux_coeff():
+    nfibers, nsamples, npix = 5, 500, 400
+    finalwcs = SimpleWcs1D(crval=7200.0, crpix=1.0, cdelt=0.39).create_internal_wcs_()
+    solutionwl = create_wavecalib(range(1, nfibers + 1), nsamples=nsamples, offset=(1.5,))
+    coeffs = [list(fibsol.solution.coeff) for fibsol in solutionwl.contents]
+    arr = numpy.random.default_rng(6).uniform(0, 100, (nfibers, nsamples))
+    result1, _ = resample_rss_flux(arr, solutionwl, npix, finalwcs)
+    result2, _ = resample_rss_flux(arr, solutionwl, npix, finalwcs)
+    # the offset is not applied to the solutions
+    assert [list(fibsol.solution.coeff) for fibsol in solutionwl.contents] == coeffs
+    assert numpy.array_equal(result1, result2)
@@ -147,3 +147,82 @@ def test_query_ds9(tmpdir, tracemap_data):
     with p.open("w") as ds9reg:
         tracemap_data.to_ds9_reg(ds9reg)
     assert True
+
+
+def create_tracemap_arrays():
+    tracemap = tm.TraceMap()
+    tracemap.ref_column = 100
+    tracemap.global_offset = nppol.Polynomial([0.5, 0.01])
+    tracemap.contents = [
+        tm.GeometricTrace(1, 1, 4, 180, fitparms=[20.0, 0.01]),
+        tm.GeometricTrace(2, 1, 4, 190, fitparms=[30.0, 0.01, 1e-5]),
+        tm.GeometricTrace(3, 1, 4, 190, fitparms=[]),
+        tm.GeometricTrace(4, 1, 6, 190, fitparms=[50.0, 0.02]),
+        tm.GeometricTrace(7, 2, 6, 190, fitparms=[70.0, 0.01]),
+    ]
+    return tracemap
+
+
+def test_tracemap_arrays():
+    tracemap = create_tracemap_arrays()
+    arrays = tracemap.arrays
+    assert len(arrays) == 5
+    assert arrays.fibid.tolist() == [1, 2, 3, 4, 7]
+    assert arrays.boxid.tolist() == [1, 1, 1, 1, 2]
+    assert arrays.start.tolist() == [4, 4, 4, 6, 6]
+    assert arrays.valid.tolist() == [True, True, False, True, True]
+    assert arrays.coeffs.shape == (5, 3)
+    assert numpy.allclose(arrays.coeffs[1], [30.0, 0.01, 1e-5])
+    assert numpy.allclose(arrays.coeffs[2], 0.0)
+
+
+def test_tracemap_centers():
+    tracemap = create_tracemap_arrays()
+    xx = numpy.arange(0, 200, 7)
+    centers = tracemap.centers(xx)
+    raw = tracemap.centers(xx, offset=False)
+    assert centers.shape == (5, len(xx))
+    for trace, c, r in zip(tracemap.contents, centers, raw):
+        if trace.valid:
+            y_ref = trace.polynomial(tracemap.ref_column)
+            assert numpy.allclose(r, trace.polynomial(xx))
+            assert numpy.allclose(c, trace.polynomial(xx) + tracemap.global_offset(y_ref))
+        else:
+            assert numpy.all(numpy.isnan(c))
+
+    # different columns for each trace
+    xx2 = numpy.arange(10.0)[numpy.newaxis, :] + numpy.arange(5)[:, numpy.newaxis]
+    centers = tracemap.centers(xx2, offset=False)
+    assert numpy.allclose(centers[3], tracemap.contents[3].polynomial(xx2[3]))
+
+
+def test_tracemap_borders():
+    tracemap = create_tracemap_arrays()
+    xx = numpy.array([100])
+    fibid, lower, upper = tracemap.borders(xx)
+    centers = tracemap.centers(xx)[:, 0]
+    # 7 has no neighbours
+    assert fibid.tolist() == [1, 2, 4]
+    assert numpy.allclose(upper[0], 0.5 * (centers[0] + centers[1]))
+    assert numpy.allclose(lower[1], upper[0])
+    # 3 is missing, the border is at a quarter of the distance
+    assert numpy.allclose(upper[1], 0.75 * centers[1] + 0.25 * centers[3])
+    # reflection of the other border
+    assert numpy.allclose(lower[0], 2 * centers[0] - upper[0])
+
+
+def test_tracemap_lazy_contents(tracemap_data_state):
+    data, state = tracemap_data_state
+    result = tm.TraceMap(instrument="unknown")
+    result.__setstate__(state)
+    # the traces are not created until used
+    assert result._contents is None
+    arrays = result.arrays
+    assert len(arrays) == len(state["contents"])
+    assert result._contents is None
+    assert result.__getstate__() == state
+
+    contents = result.contents
+    assert [t.fibid for t in contents] == arrays.fibid.tolist()
+    assert result.__getstate__() == state
+    assert result.arrays.fibid.tolist() == arrays.fibid.tolist()
@@ -0,0 +1,211 @@
+#
+# Copyright 2025 Universidad Complutense de Madrid
+#
+# This file is part of Megara DRP
+#
+# SPDX-License-Identifier: GPL-3.0-or-later
+# License-Filename: LICENSE.txt
+#
+
+"""Tests for the parallel identification of arc lines."""
+
+import numpy
+import pytest
+
+from numina.array.wavecalib.arccalibration import arccalibration_direct
+from numina.array.wavecalib.arccalibration import gen_triplets_master
+
+from megaradrp.core.opcache import ArrayCache
+import megaradrp.recipes.calibration.arc as arc
+
+
+def create_arc_rss(nfib=4, naxis1=4096, seed=1):
+    rng = numpy.random.default_rng(seed)
+    wl = numpy.sort(rng.uniform(4000, 6000, 60))
+    flux = rng.uniform(100, 1000, len(wl))
+    x = numpy.arange(1, naxis1 + 1)
+    rss = numpy.zeros((nfib, naxis1))
+    for i in range(nfib):
+        xc = (wl - (3900 + 0.5 * i)) / 0.55
+        for xi, f in zip(xc, flux):
+            rss[i] += f * numpy.exp(-0.5 * ((x - xi) / 2.0) ** 2)
+    return rss, wl
+
+
+def create_context(wl, naxis1):
+    ntriplets_master, ratios_master_sorted, triplets_master_sorted_list = \
+        gen_triplets_master(wl)
+    return dict(
+        wv_master=wl, wv_master_all=wl,
+        ntriplets_master=ntriplets_master,
+        ratios_master_sorted=ratios_master_sorted,
+        triplets_master_sorted_list=triplets_master_sorted_list,
+        nlines=[25], naxis1=naxis1,
+        wv_ini_search=3600, wv_end_search=6400,
+        poldeg_initial=3, poldeg_refined=3, debugplot=0
+    )
+
+
+def read_context(idx, name):
+    return idx, len(arc._fiber_context[name])
+
+
+@pytest.mark.parametrize('processes', [1, 2])
+def test_map_fibers_order(processes):
+    context = {'table': numpy.arange(7)}
+    tasks = [(idx, 'table') for idx in range(10)]
+    result = arc.map_fibers(read_context, tasks, context, processes=processes)
+    assert result == [(idx, 7) for idx in range(10)]
+    # the context is not kept in this process
+    assert arc._fiber_context == {}
+
+
+def test_identify_and_refine_parallel():
+    rss, wl = create_arc_rss()
+    context = create_context(wl, rss.shape[1])
+    trace_pol = numpy.polynomial.Polynomial([100.0])
+    tasks = [(idx + 1, rss[idx], trace_pol) for idx in range(rss.shape[0])]
+
+    serial = arc.map_fibers(arc.identify_fiber_lines, tasks, context, processes=1)
+    parallel = arc.map_fibers(arc.identify_fiber_lines, tasks, context, processes=2)
+
+    assert [r[0] for r in parallel] == [1, 2, 3, 4]
+    for (fibid, npeaks, sol, error), r2 in zip(serial, parallel):
+        assert error is None
+        assert npeaks == r2[1]
+        assert numpy.allclose(sol.coeff, r2[2].coeff)
+        assert numpy.allclose(sol.coeff[:2], [3900 + 0.5 * (fibid - 1), 0.55], rtol=1e-3)
+        assert all(feature.ypos == 100.0 for feature in sol.features)
+
+    tasks = [(fibid, rss[fibid - 1], sol.coeff) for fibid, _, sol, _ in serial]
+    refined = arc.map_fibers(arc.refine_fiber_solution, tasks, context, processes=2)
+    for (fibid, sol), task in zip(refined, tasks):
+        assert fibid == task[0]
+        assert numpy.allclose(sol.coeff[:2], [3900 + 0.5 * (fibid - 1), 0.55], rtol=1e-5)
+        assert sol.npoints_eff > 0
+
+
+def test_identify_error():
+    rss, wl = create_arc_rss(nfib=1)
+    context = create_context(wl, rss.shape[1])
+    row = numpy.zeros(rss.shape[1])
+    trace_pol = numpy.polynomial.Polynomial([0.0])
+    [(fibid, npeaks, sol, error)] = arc.map_fibers(
+        arc.identify_fiber_lines, [(1, row, trace_pol)], context)
+    assert fibid == 1
+    assert sol is None
+    assert error
+
+
+def test_select_anchor_fibers():
+    boxes = [1] * 10 + [2] * 2 + [3]
+    anchors = arc.select_anchor_fibers(boxes, 3)
+    assert numpy.flatnonzero(anchors).tolist() == [0, 4, 9, 10, 11, 12]
+
+
+def test_seed_coefficients():
+    fibids = [1, 2, 3, 4, 5]
+    boxes = [1, 1, 1, 2, 2]
+    anchors = numpy.array([True, False, True, False, False])
+    solutions = [type('Solution', (), {'coeff': numpy.array([10.0, 1.0])}),
+                 type('Solution', (), {'coeff': numpy.array([14.0, 2.0])})]
+    anchor_results = [(1, 20, solutions[0], None), (3, 20, solutions[1], None)]
+    seeds = arc.seed_coefficients(fibids, boxes, anchors, anchor_results)
+    assert numpy.allclose(seeds[1], [12.0, 1.5])
+    # box without anchors uses the anchors of all the boxes
+    assert numpy.allclose(seeds[4], [14.0, 2.0])
+
+    anchor_results = [(1, 20, None, 'error'), (3, 20, None, 'error')]
+    seeds = arc.seed_coefficients(fibids, boxes, anchors, anchor_results)
+    assert seeds == [None] * 5
+
+
+def test_match_fiber_lines():
+    rss, wl = create_arc_rss(nfib=2)
+    context = create_context(wl, rss.shape[1])
+    context['match_tolerance'] = (3.0, 1.0)
+    trace_pol = numpy.polynomial.Polynomial([100.0])
+    [(_, _, anchor, _)] = arc.map_fibers(
+        arc.identify_fiber_lines, [(1, rss[0], trace_pol)], context)
+
+    # the solution of the first fiber predicts the second
+    [(fibid, npeaks, sol, error, seeded)] = arc.map_fibers(
+        arc.match_fiber_lines, [(2, rss[1], trace_pol, anchor.coeff)], context)
+    assert seeded
+    assert error is None
+    assert numpy.allclose(sol.coeff[:2], [3900.5, 0.55], rtol=1e-3)
+    [(_, _, full, _)] = arc.map_fibers(
+        arc.identify_fiber_lines, [(2, rss[1], trace_pol)], context)
+    assert numpy.allclose(sol.coeff, full.coeff)
+
+    # a wrong prediction falls back to the triplet method
+    coeff = anchor.coeff + [40.0, 0, 0, 0]
+    [(fibid, npeaks, sol, error, seeded)] = arc.map_fibers(
+        arc.match_fiber_lines, [(2, rss[1], trace_pol, coeff)], context)
+    assert not seeded
+    assert numpy.allclose(sol.coeff, full.coeff)
+
+
+def test_triplets_master_cache(tmp_path):
+    wl = numpy.linspace(4000.0, 6000.0, 30) + numpy.arange(30) ** 1.5
+    ntriplets, ratios, triplets = gen_triplets_master(wl)
+    cache = ArrayCache(tmp_path)
+
+    computed = arc.triplets_master(wl, cache=cache)
+    assert len(list((tmp_path / 'triplets').iterdir())) == 1
+    loaded = arc.triplets_master(wl, cache=cache)
+    assert isinstance(loaded[1], numpy.memmap)
+
+    for result in [computed, loaded]:
+        assert result[0] == ntriplets
+        assert numpy.array_equal(result[1], ratios)
+        assert numpy.array_equal(result[2], triplets)
+
+    # a different list of lines is a different entry
+    arc.triplets_master(wl[1:], cache=cache)
+    assert len(list((tmp_path / 'triplets').iterdir())) == 2
+
+
+def test_identify_with_cached_triplets(tmp_path):
+    rss, wl = create_arc_rss(nfib=1)
+    context = create_context(wl, rss.shape[1])
+    trace_pol = numpy.polynomial.Polynomial([100.0])
+    [(_, _, ref, _)] = arc.map_fibers(
+        arc.identify_fiber_lines, [(1, rss[0], trace_pol)], context)
+
+    cache = ArrayCache(tmp_path)
+    arc.triplets_master(wl, cache=cache)
+    tables = arc.triplets_master(wl, cache=cache)
+    context.update(ntriplets_master=tables[0], ratios_master_sorted=tables[1],
+                   triplets_master_sorted_list=tables[2])
+    [(_, _, sol, _)] = arc.map_fibers(
+        arc.identify_fiber_lines, [(1, rss[0], trace_pol)], context)
+    assert numpy.allclose(sol.coeff, ref.coeff)
+
+
+def test_arccalibration_direct_cached_triplets(tmp_path):
+    rss, wl = create_arc_rss(nfib=1)
+    xpos = arc.find_fiber_peaks(rss[0], [25]) + 1.0
+    cache = ArrayCache(tmp_path)
+    arc.triplets_master(wl, cache=cache)
+
+    solutions = []
+    # the list of numina and the array loaded from the cache
+    for tables in [gen_triplets_master(wl), arc.triplets_master(wl, cache=cache)]:
+        ntriplets, ratios, triplets = tables
+        features = arccalibration_direct(
+            wv_master=wl, ntriplets_master=ntriplets,
+            ratios_master_sorted=ratios, triplets_master_sorted_list=triplets,
+            xpos_arc=xpos, naxis1_arc=rss.shape[1], crpix1=1.0,
+            wv_ini_search=3600, wv_end_search=6400,
+            error_xpos_arc=3.0, times_sigma_r=3.0, frac_triplets_for_sum=0.50,
+            times_sigma_theil_sen=10.0, poly_degree_wfit=3,
+            times_sigma_polfilt=10.0, times_sigma_cook=10.0,
+            times_sigma_inclusion=10.0
+        )
+        solutions.append([vars(feature) for feature in features])
+
+    assert isinstance(triplets, numpy.memmap)
+    assert len(solutions[0]) == len(xpos)
+    assert sum(feature['line_ok'] for feature in solutions[0]) > 20
+    assert solutions[0] == solutions[1]
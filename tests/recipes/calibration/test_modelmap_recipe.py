@@ -0,0 +1,147 @@
+
+"""Tests for the model map recipe module."""
+
+import gc
+import multiprocessing as mp
+import warnings
+
+import numpy
+
+from numina.modeling.gaussbox import gauss_box_model
+
+from megaradrp.processing.modeldesc.gaussbox import GaussBoxModelDescription
+from megaradrp.products.tracemap import TraceMap, GeometricTrace
+from megaradrp.recipes.calibration.modelmap import calc_parallel, fit_model
+from megaradrp.recipes.calibration.modelmap import fit_model_propagate
+from megaradrp.recipes.calibration.modelmap import fit_model_adaptive
+from megaradrp.recipes.calibration.modelmap import refine_columns, spline_errors
+
+
+def create_tracemap(nfib=40):
+    tracemap = TraceMap()
+    tracemap.total_fibers = nfib
+    tracemap.ref_column = 250
+    for fibid in range(1, nfib + 1):
+        fitparms = [20 + 6.5 * fibid, 0.002]
+        tracemap.contents.append(GeometricTrace(fibid, 0, 0, 499, fitparms=fitparms))
+    return tracemap
+
+
+def create_image(tracemap, shape=(300, 500), wave=0.0):
+    nrow, ncol = shape
+    yy = numpy.arange(nrow)
+    xx = numpy.arange(ncol)
+    data = numpy.zeros(shape)
+    for trace in tracemap.contents:
+        centers = trace.polynomial(xx)
+        sigma = 1.1 + 0.3 * xx / ncol + 0.002 * trace.fibid
+        # fast variation in the middle of the image
+        sigma += wave * numpy.exp(-0.5 * ((xx - 250) / 20) ** 2)
+        amp = 1000.0 + 10 * trace.fibid
+        data += gauss_box_model(yy[:, numpy.newaxis], amp, centers, sigma, 0.5)
+    return data
+
+
+def test_fit_model_propagate():
+    tracemap = create_tracemap()
+    data = create_image(tracemap)
+    model_desc = GaussBoxModelDescription(sigma=1.3)
+    cols = [450, 50, 150, 250, 350]
+
+    result = fit_model_propagate(model_desc, data, tracemap, cols,
+                                 tracemap.ref_column, processes=1)
+    assert [col for col, _ in result] == sorted(cols)
+
+    for col, values in result:
+        _, expected = calc_parallel(model_desc, data, col, tracemap,
+                                    average=2)
+        for fibid, params in expected.items():
+            for name in ['amplitude', 'stddev']:
+                assert numpy.isclose(values[fibid][name], params[name], rtol=1e-6)
+            assert values[fibid]['mean'] == params['mean']
+
+
+def test_fit_model_pool():
+    tracemap = create_tracemap()
+    data = create_image(tracemap)
+    model_desc = GaussBoxModelDescription(sigma=1.3)
+    cols = [100, 300]
+    with warnings.catch_warnings(record=True) as records:
+        warnings.simplefilter('always', ResourceWarning)
+        result = fit_model(model_desc, data, tracemap, cols, processes=2)
+        gc.collect()
+    # the pool is closed, the workers are not left behind
+    assert not [rec for rec in records if issubclass(rec.category, ResourceWarning)]
+    assert mp.active_children() == []
+    for (col, values), ref_col in zip(result, cols):
+        expected_col, expected = calc_parallel(model_desc, data, ref_col, tracemap,
+                                               nloop=3, average=2)
+        assert col == expected_col
+        for fibid, params in expected.items():
+            assert numpy.isclose(values[fibid]['stddev'], params['stddev'])
+
+
+def test_calc_parallel_previous():
+    tracemap = create_tracemap()
+    data = create_image(tracemap)
+    model_desc = GaussBoxModelDescription(sigma=1.3)
+
+    _, previous = calc_parallel(model_desc, data, 200, tracemap, average=2)
+    _, final = calc_parallel(model_desc, data, 250, tracemap, average=2,
+                             previous=previous)
+    _, expected = calc_parallel(model_desc, data, 250, tracemap, average=2)
+    for fibid, params in expected.items():
+        # the centers are moved to the traces
+        assert final[fibid]['mean'] == params['mean']
+        assert numpy.isclose(final[fibid]['stddev'], params['stddev'], rtol=1e-6)
+        assert numpy.isclose(final[fibid]['amplitude'], params['amplitude'], rtol=1e-6)
+
+
+def test_spline_errors():
+    g_col = numpy.arange(100, 1000, 100)
+    values = 1 + 1e-3 * g_col
+    resid, cv_err = spline_errors(g_col, values, 3)
+    assert numpy.allclose(resid, 0)
+    assert numpy.allclose(cv_err, 0)
+    values[4] += 0.5
+    resid, cv_err = spline_errors(g_col, values, 3)
+    assert cv_err.argmax() == 4
+    assert cv_err[0] == 0 and cv_err[-1] == 0
+
+
+def test_refine_columns():
+    cols = [100, 200, 300, 400, 500]
+    errors = [0.0, 0.0, 0.5, 0.0, 0.0]
+    assert refine_columns(cols, errors, 0.1) == [250, 350]
+    assert refine_columns(cols, errors, 1.0) == []
+    # intervals are not split below min_step
+    assert refine_columns(cols, errors, 0.1, min_step=60) == []
+
+
+def test_fit_model_adaptive():
+    tracemap = create_tracemap(nfib=30)
+    model_desc = GaussBoxModelDescription(sigma=1.3)
+    cols = list(range(25, 500, 60))
+
+    data = create_image(tracemap, shape=(240, 500))
+    result, info = fit_model_adaptive(model_desc, data, tracemap, cols,
+                                      tracemap.ref_column, tol=0.01,
+                                      processes=1, min_step=10)
+    # smooth parameters, no new columns
+    assert info['columns'] == cols
+    assert len(info['rounds']) == 1
+    assert [col for col, _ in result] == cols
+
+    data = create_image(tracemap, shape=(240, 500), wave=0.05)
+    result, info = fit_model_adaptive(model_desc, data, tracemap, cols,
+                                      tracemap.ref_column, tol=0.01,
+                                      processes=1, min_step=10, max_rounds=2)
+    assert len(info['rounds']) == 3
+    assert info['rounds'][0]['columns'] == cols
+    assert info['rounds'][1]['max_error'] < info['rounds'][0]['max_error']
+    # the second refinement is around the fast variation
+    new_cols = info['rounds'][2]['columns']
+    assert 250 in new_cols
+    assert all(col > 150 for col in new_cols)
+    assert info['columns'] == sorted(info['columns'])
+    assert [col for col, _ in result] == info['columns']
@@ -0,0 +1,89 @@
+#
+# Copyright 2025 Universidad Complutense de Madrid
+#
+# This file is part of Megara DRP
+#
+# SPDX-License-Identifier: GPL-3.0-or-later
+# License-Filename: LICENSE.txt
+#
+
+"""Tests for the update of a TraceMap by cross-correlation."""
+
+import numpy
+
+from megaradrp.products import TraceMap
+from megaradrp.products.tracemap import GeometricTrace
+import megaradrp.recipes.calibration.trace as trace
+
+
+SHAPE = (300, 800)
+
+
+def create_tracemap(nboxes=3, nfib=8, sep=5.0, gap=20.0):
+    tracemap = TraceMap()
+    tracemap.ref_column = 400
+    tracemap.expected_range = [4, 796]
+    fibid = 1
+    for boxid in range(nboxes):
+        for _ in range(nfib):
+            y0 = 30.0 + (fibid - 1) * sep + boxid * gap
+            tracemap.contents.append(
+                GeometricTrace(fibid, boxid, 4, 796, fitparms=[y0, 0.02, -2e-5])
+            )
+            fibid += 1
+    return tracemap
+
+
+def create_image(tracemap, shift=lambda y, x: 0.0, sigma=1.5):
+    yy, xx = numpy.mgrid[0:SHAPE[0], 0:SHAPE[1]]
+    data = numpy.zeros(SHAPE)
+    for t in tracemap.contents:
+        y_ref = t.polynomial(tracemap.ref_column)
+        center = t.polynomial(xx) + shift(y_ref, xx)
+        data += 1000 * numpy.exp(-0.5 * ((yy - center) / sigma) ** 2)
+    return data + 50
+
+
+def test_retrace_tracemap():
+    tracemap = create_tracemap()
+    box_corr = {0: 0.1, 1: -0.15, 2: 0.05}
+    box_of = {}
+    for t in tracemap.contents:
+        box_of[round(t.polynomial(tracemap.ref_column), 3)] = t.boxid
+
+    def shift(y_ref, x):
+        return 1.5 + 0.01 * y_ref + box_corr[box_of[round(y_ref, 3)]]
+
+    data = create_image(tracemap, shift)
+    columns = [100, 400, 700]
+    contents, global_offset, residual = trace.retrace_tracemap(data, tracemap, columns)
+    assert residual < 0.05
+
+    xx = numpy.arange(SHAPE[1])
+    for old, new in zip(tracemap.contents, contents):
+        assert new.fibid == old.fibid
+        y_ref = old.polynomial(tracemap.ref_column)
+        y_new = new.polynomial(tracemap.ref_column)
+        expected = old.polynomial(xx) + shift(y_ref, xx)
+        computed = new.polynomial(xx) + global_offset(y_new)
+        assert numpy.allclose(computed, expected, atol=0.05)
+
+
+def test_retrace_tracemap_residual():
+    tracemap = create_tracemap()
+    # shift depends on the column
+    data = create_image(tracemap, lambda y, x: 1.0 + 0.002 * x)
+    contents, global_offset, residual = trace.retrace_tracemap(data, tracemap, [100, 400, 700])
+    assert abs(residual - 0.6) < 0.05
+
+
+def test_update_traces_fallback():
+    tracemap = create_tracemap()
+    recipe = trace.TraceMapRecipe()
+    data = create_image(tracemap, lambda y, x: 2.0)
+    contents, global_offset = recipe.update_traces(data, tracemap, tolerance=0.2)
+    assert numpy.allclose(global_offset.coef[0], 2.0, atol=0.05)
+    assert len(contents) == len(tracemap.contents)
+
+    data = create_image(tracemap, lambda y, x: 1.0 + 0.002 * x)
+    assert recipe.update_traces(data, tracemap, tolerance=0.2) is None
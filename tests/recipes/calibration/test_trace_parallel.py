@@ -0,0 +1,56 @@
+#
+# Copyright 2025 Universidad Complutense de Madrid
+#
+# This file is part of Megara DRP
+#
+# SPDX-License-Identifier: GPL-3.0-or-later
+# License-Filename: LICENSE.txt
+#
+
+"""Tests for the parallel tracing of fibers."""
+
+import logging
+
+import numpy
+import pytest
+
+import megaradrp.recipes.calibration.trace as trace
+
+
+def create_traces_image(nfibers=6, shape=(200, 600), sep=30.0, sigma=2.0):
+    yy, xx = numpy.mgrid[0:shape[0], 0:shape[1]]
+    data = numpy.zeros(shape)
+    centers = []
+    for i in range(nfibers):
+        pol = numpy.polynomial.Polynomial([20.0 + sep * i, 0.01, -1e-5])
+        data += 10000 * numpy.exp(-0.5 * ((yy - pol(xx)) / sigma) ** 2)
+        centers.append(pol)
+    return data, centers
+
+
+@pytest.mark.parametrize('processes', [1, 3])
+def test_trace_fibers(processes):
+    data, centers = create_traces_image()
+    tasks = [(fibid, centers[fibid - 1](300)) for fibid in range(1, 7)]
+    results = trace.trace_fibers(data, tasks, processes=processes, x=300, step=2,
+                                 hs=3, background=300, maxdis=2.0, poldeg=2)
+    assert [res[0] for res in results] == [1, 2, 3, 4, 5, 6]
+    for (fibid, pfit, start, stop, messages), pol in zip(results, centers):
+        assert numpy.allclose(pfit, pol.coef, rtol=1e-3, atol=1e-3)
+        assert start < 10
+        assert stop > 590
+        assert messages[0][0] == logging.DEBUG
+    # the image is not kept after tracing
+    assert trace._trace_image is None
+
+
+def test_trace_fibers_serial_parallel():
+    data, centers = create_traces_image()
+    tasks = [(fibid, centers[fibid - 1](300)) for fibid in range(1, 7)]
+    kwds = dict(x=300, step=2, hs=3, background=300, maxdis=2.0, poldeg=3)
+    serial = trace.trace_fibers(data, tasks, processes=1, **kwds)
+    parallel = trace.trace_fibers(data, tasks, processes=2, **kwds)
+    for res1, res2 in zip(serial, parallel):
+        assert res1[0] == res2[0]
+        assert numpy.array_equal(res1[1], res2[1])
+        assert res1[2:] == res2[2:]
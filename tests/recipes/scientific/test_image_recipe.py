@@ -0,0 +1,72 @@
+#
+# Copyright 2025 Universidad Complutense de Madrid
+#
+# This file is part of Megara DRP
+#
+# SPDX-License-Identifier: GPL-3.0-or-later
+# License-Filename: LICENSE.txt
+#
+
+"""Tests for the reduction to RSS of ImageRecipe."""
+
+import numpy
+import astropy.io.fits as fits
+from numina.frame.utils import copy_img
+from numina.types.frame import DataFrame
+
+from megaradrp.products.tracemap import TraceMap, GeometricTrace
+import megaradrp.products.wavecalibration as wcal
+from megaradrp.recipes.scientific.base import ImageRecipe
+from megaradrp.testing.create_image import create_simple_img
+from megaradrp.testing.create_wavecalib import create_solution, orig
+
+NFIBERS = 10
+SHAPE = (100, 120)
+
+
+def create_calibrations():
+    tracemap = TraceMap()
+    tracemap.total_fibers = NFIBERS
+    tracemap.ref_column = 60
+    solutionwl = wcal.WavelengthCalibration(instrument='MEGARA')
+    for fibid in range(1, NFIBERS + 1):
+        fitparms = [5 + 8.0 * fibid, 0.01]
+        tracemap.contents.append(GeometricTrace(fibid, 0, 4, 116, fitparms=fitparms))
+        solution = create_solution(orig)
+        solution.coeff = [7200.0 + 0.3 * fibid, 3.9, 1e-3]
+        solutionwl.contents.append(wcal.FiberSolutionArcCalibration(fibid, solution))
+    hdu = fits.PrimaryHDU(numpy.ones((NFIBERS, 4300), dtype='float32'))
+    hdu.header['UUID'] = 'fiberflat'
+    fiberflat = DataFrame(frame=fits.HDUList([hdu]))
+    return tracemap, solutionwl, fiberflat
+
+
+def create_image():
+    img = create_simple_img('LCB')
+    img[0].header['VPH'] = 'LR-I'
+    rng = numpy.random.default_rng(2)
+    img[0].data = rng.uniform(100, 200, SHAPE).astype('float32')
+    return img
+
+
+def test_image_recipe_wl_resampling():
+    recipe = ImageRecipe()
+    assert recipe.requirements()['wl_resampling'].default == 'linear'
+
+    img = create_image()
+    tracemap, solutionwl, fiberflat = create_calibrations()
+    results = {}
+    for resampling in ['linear', 'steffen']:
+        rss = recipe.run_reduction_1d(copy_img(img), tracemap, solutionwl, fiberflat,
+                                      resampling=resampling)
+        assert f'{resampling} interpolation' in str(rss[0].header['history'])
+        results[resampling] = rss[0].data
+    assert not numpy.allclose(results['linear'], results['steffen'], rtol=1e-6)
+
+    # the fused reduction is linear, it is not used with steffen
+    rss = recipe.run_reduction_1d(copy_img(img), tracemap, solutionwl, fiberflat,
+                                  fused=True, resampling='steffen')
+    assert numpy.array_equal(rss[0].data, results['steffen'])
+    rss = recipe.run_reduction_1d(copy_img(img), tracemap, solutionwl, fiberflat,
+                                  fused=True)
+    assert numpy.allclose(rss[0].data, results['linear'], rtol=1e-5, atol=1e-5)
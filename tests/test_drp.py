@@ -37,7 +37,7 @@ expected_tags = {
     "MegaraDarkImage": set(),
     "MegaraArcCalibration": {"insmode", "speclamp", "vph"},
     "MegaraSlitFlat": set(),
-    "MegaraTraceMap": set(),
+    "MegaraTraceMap": {"insmode", "vph"},
     "MegaraModelMap": {"insmode", "vph"},
     "MegaraFiberFlatImage": {"insmode", "vph"},
     "MegaraTwilightFlatImage": {"confid", "insmode", "vph"},